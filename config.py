@@ -19,12 +19,59 @@ SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(BASEDIR.joinpath('db.sqlite'))
 # True or False to suppress this warning.
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Add the number of SQL queries and the time spent on them to every response
+# as a Server-Timing header, see flasquelistan/querystats.py. It is always
+# added in debug mode and for admins, this adds it for everyone.
+SERVER_TIMING_HEADER = False
+# Log a warning for requests running more SQL queries than this, None to
+# disable.
+QUERY_COUNT_THRESHOLD = None
+
+# Message queue for SocketIO events, needed when running more than one worker
+# process, see flasquelistan/messagequeue.py and docs/DEPLOYMENT.md. For
+# example 'redis://localhost:6379/0'. None keeps events within the process.
+SOCKETIO_MESSAGE_QUEUE = None
+# Channel on the message queue, change if several sites share one Redis
+SOCKETIO_CHANNEL = 'flasquelistan'
+
+# Build and emit SocketIO events in a background task instead of before
+# responding, see flasquelistan/outbox.py
+EMIT_EVENTS_IN_BACKGROUND = True
+# Seconds the background task waits for more events to emit together
+EVENT_BATCH_WINDOW = 0.1
+
 BABEL_DEFAULT_LOCALE = 'sv_SE'
 BABEL_DEFAULT_TIMEZONE = 'CET'
 
+# Signed image URLs stay the same for this many seconds, so that browsers can
+# cache the images. They are valid for IMAGE_EXPIRY (set in the instance
+# config) after that.
+IMAGE_URL_WINDOW = 60 * 60
+
 UPLOADS_DEFAULT_DEST = BASEDIR.joinpath('flasquelistan/static/uploads')
 UPLOADS_DEFAULT_URL = '/static/uploads/'
 
+# Profile picture thumbnails made when uploading, see
+# flasquelistan/thumbnails.py. The widths are the ones the templates use.
+THUMBNAIL_WIDTHS = [200, 600, 800]
+# 'webp' or 'jpeg'
+THUMBNAIL_FORMAT = 'webp'
+THUMBNAIL_QUALITY = 80
+
+# Process uploaded profile pictures (rotate, convert GIFs, make thumbnails)
+# in background tasks, see flasquelistan/imageprocessing.py
+PROCESS_IMAGES_IN_BACKGROUND = True
+# Pictures processed at the same time, and waiting to be
+IMAGE_PROCESSING_WORKERS = 2
+IMAGE_PROCESSING_QUEUE_SIZE = 100
+
+# Versions of the static files for cache-busting URLs, written by
+# `flask cachebust`, see flasquelistan/cachebust.py
+CACHE_BUST_MANIFEST = BASEDIR.joinpath('flasquelistan/cachebust.json')
+# Directories in the static folder without cache-busting URLs. Uploads have
+# URLs of their own, served by nginx.
+CACHE_BUST_EXCLUDE = ['uploads']
+
 WTF_CSRF_TIME_LIMIT = 21600  # 6 hours
 
 # Email settings
@@ -36,6 +83,20 @@ SMTP_PORT = 25
 SYSTEM_EMAILADDR = 'system-noreply@example.com'
 # address to send from and to send admin notifications to
 ADMIN_EMAILADDR = 'webmaster@example.com'
+# Where to send email, see flasquelistan/mail.py: 'smtp', 'debug' or
+# 'memory'. None prints messages in debug mode and sends them otherwise.
+MAIL_TRANSPORT = None
+# At most this many messages per second, None for no limit
+MAIL_RATE_LIMIT = 5
+# Retries of a message failing with a temporary error, waiting
+# MAIL_RETRY_DELAY seconds, doubled for every retry
+MAIL_RETRIES = 3
+MAIL_RETRY_DELAY = 2
+# Messages waiting to be sent, and the seconds to wait for room when full
+MAIL_QUEUE_SIZE = 1000
+MAIL_QUEUE_TIMEOUT = 5
+# Close the SMTP connection after this many seconds without messages
+MAIL_IDLE_TIMEOUT = 30
 
 # Discord integration settings
 DISCORD_REDIRECT_URI = "https://localhost/discord/callback"
@@ -0,0 +1,78 @@
+"""Work through a queue with background tasks.
+
+The event outbox (outbox.py) and the image processor (imageprocessing.py)
+both take work off the request path by putting it in a queue that background
+tasks work through. The queue and the tasks are of the SocketIO async mode,
+so under gevent the tasks are greenlets, which wait on the queue without
+blocking the rest of the process. They are started when the first item is
+put, so that apps that never put anything (like the CLI) start no tasks.
+"""
+import contextlib
+import threading
+
+from flasquelistan import models
+from flasquelistan.factory import socketio
+
+
+class BackgroundQueue:
+    """A queue of items worked through by background tasks. Subclasses
+    implement work(items)."""
+
+    # Number of background tasks working through the queue
+    workers = 1
+    # Most items in the queue, 0 for no limit
+    maxsize = 0
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = None
+        self._lock = threading.Lock()
+
+    def put_in_queue(self, item, block=True):
+        """Put item in the queue, starting the background tasks if needed.
+        Without block, raises queue.Full if the queue is full."""
+        with self._lock:
+            if self.queue is None:
+                self.queue = socketio.server.eio.create_queue(self.maxsize)
+                for _ in range(self.workers):
+                    socketio.start_background_task(self._run)
+
+        self.queue.put(item, block=block)
+
+    def join(self):
+        """Wait until every item put so far has been worked on."""
+        if self.queue is not None:
+            self.queue.join()
+
+    @contextlib.contextmanager
+    def app_context(self):
+        """A new app context to work in. It has a database session of its
+        own, even when working from within a request, like when not working
+        in the background."""
+        with self.app.app_context():
+            try:
+                yield
+            finally:
+                models.db.session.remove()
+
+    def get_items(self):
+        """Wait for the next items to work on, by default one at a time."""
+        return [self.queue.get()]
+
+    def work(self, items):
+        raise NotImplementedError
+
+    def work_failed(self, items):
+        """Called from an except block when work(items) raised."""
+        self.app.logger.exception("Could not work on %r", items)
+
+    def _run(self):
+        while True:
+            items = self.get_items()
+            try:
+                self.work(items)
+            except Exception:
+                self.work_failed(items)
+            finally:
+                for _ in items:
+                    self.queue.task_done()
@@ -22,9 +22,95 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+#
+# Changed to read the versions from a manifest written by `flask cachebust`
+# instead of hashing the whole static folder whenever an app is created.
+
 import hashlib
+import json
 import os
 
+MANIFEST_FORMAT = 1
+
+
+def file_version(path):
+    with open(path, 'rb') as f:
+        return 'c' + hashlib.md5(f.read()).hexdigest()[:7]
+
+
+def compute_manifest(static_folder, exclude=(), previous=None):
+    """
+    Return a dict from every filename in `static_folder`, relative to it, to
+    its cache-busting version and the size and modification time it was
+    computed from. Directories in `exclude`, relative to `static_folder`, are
+    skipped. Files with the same size and modification time as in the
+    `previous` manifest keep their version without being read again.
+    """
+    previous = previous or {}
+    excluded = {os.path.join(static_folder, path) for path in exclude}
+    manifest = {}
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        dirnames[:] = [dirname for dirname in dirnames
+                       if os.path.join(dirpath, dirname) not in excluded]
+        for filename in filenames:
+            rooted_filename = os.path.join(dirpath, filename)
+            unbusted = os.path.relpath(rooted_filename, static_folder)
+            unbusted = unbusted.replace(os.sep, '/')
+
+            stat = os.stat(rooted_filename)
+            entry = previous.get(unbusted)
+            if (entry is None or entry['size'] != stat.st_size
+                    or entry['mtime'] != stat.st_mtime_ns):
+                entry = {
+                    'version': file_version(rooted_filename),
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime_ns,
+                }
+            manifest[unbusted] = entry
+
+    return manifest
+
+
+def read_manifest(path):
+    """Return the manifest in the file at `path`, or None if there is none."""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if data.get('format') != MANIFEST_FORMAT:
+        return None
+    return data['files']
+
+
+def write_manifest(path, manifest):
+    # Replace the file in one go, a worker starting meanwhile reads either
+    # the old or the new manifest
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'format': MANIFEST_FORMAT, 'files': manifest}, f,
+                  indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def update_manifest(app):
+    """
+    Hash the static files that changed since the manifest was last written
+    and write it again. Return the manifest and the number of files hashed.
+    """
+    path = app.config['CACHE_BUST_MANIFEST']
+    previous = read_manifest(path) or {}
+    manifest = compute_manifest(app.static_folder,
+                                app.config.get('CACHE_BUST_EXCLUDE', ()),
+                                previous)
+    write_manifest(path, manifest)
+
+    hashed = sum(1 for filename, entry in manifest.items()
+                 if previous.get(filename) != entry)
+    return manifest, hashed
+
 
 def setup_cache_busting(app):
     """
@@ -33,6 +119,11 @@ def setup_cache_busting(app):
     static files.
     This allows setting long cache expiration values on static resources
     because whenever the resource changes, so does its URL.
+
+    The versions are read from the CACHE_BUST_MANIFEST file, written by
+    `flask cachebust`. Without one, or in debug mode where static files
+    change while the app runs, they are computed from the files instead,
+    only hashing the files that differ from the manifest.
     """
     # the rooted path to the static file folder
     static_folder = app.static_folder
@@ -41,23 +132,20 @@ def setup_cache_busting(app):
     # map from a busted filename to an unbusted one
     unbust_table = {}
 
-    app.logger.debug('Computing cache-busting values...')
-    # compute (un)bust tables.
-    for dirpath, dirnames, filenames in os.walk(static_folder):
-        for filename in filenames:
-            # compute version component
-            rooted_filename = os.path.join(dirpath, filename)
-            with open(rooted_filename, 'rb') as f:
-                version = 'c' + hashlib.md5(f.read()).hexdigest()[:7]
-
-            # add version
-            unbusted = os.path.relpath(rooted_filename, static_folder)
-            busted = os.path.join(version, unbusted)
+    manifest_path = app.config.get('CACHE_BUST_MANIFEST')
+    manifest = read_manifest(manifest_path) if manifest_path else None
+    if manifest is None or app.debug:
+        app.logger.debug('Computing cache-busting values...')
+        manifest = compute_manifest(static_folder,
+                                    app.config.get('CACHE_BUST_EXCLUDE', ()),
+                                    manifest)
+        app.logger.debug('Finished computing cache-busting values')
 
-            # save computation to tables
-            bust_table[unbusted] = busted
-            unbust_table[busted] = unbusted
-    app.logger.debug('Finished computing cache-busting values')
+    # compute (un)bust tables.
+    for unbusted, entry in manifest.items():
+        busted = entry['version'] + '/' + unbusted
+        bust_table[unbusted] = busted
+        unbust_table[busted] = unbusted
 
     def bust_filename(filename):
         return bust_table.get(filename, filename)
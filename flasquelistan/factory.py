@@ -3,7 +3,7 @@ import flask
 from flask_socketio import SocketIO
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from flasquelistan import cachebust
+from flasquelistan import cachebust, messagequeue, querystats
 
 socketio = SocketIO()
 
@@ -28,7 +28,9 @@ def create_app(config=None, instance_config=None):
         models.TESTING = True
 
     models.db.init_app(app)
+    setup_sqlite(app)
     init_db(app)
+    querystats.setup_query_stats(app)
 
     views.auth.login_manager.init_app(app)
 
@@ -39,11 +41,17 @@ def create_app(config=None, instance_config=None):
     setup_flask_babel(app)
     setup_flask_uploads(app)
     setup_csrf_protection(app)
+    setup_bac_cache(app)
+    setup_event_outbox(app)
+    setup_mailer(app)
+    setup_image_processor(app)
     cachebust.setup_cache_busting(app)
 
     app.wsgi_app = ProxyFix(app.wsgi_app, x_host=1)
 
-    socketio.init_app(app)
+    # Always pass a client manager, init_app remembers options from earlier
+    # apps otherwise
+    socketio.init_app(app, client_manager=messagequeue.client_manager(app))
     return app
 
 
@@ -121,6 +129,28 @@ def register_cli(app):
     def initdb_command():
         init_db(app)
 
+    @app.cli.command('createindexes')
+    def createindexes_command():
+        create_indexes(app)
+
+    @app.cli.command('cachebust')
+    def cachebust_command():
+        manifest, hashed = cachebust.update_manifest(app)
+        click.echo(f"Hashed {hashed} of {len(manifest)} static files, "
+                   f"wrote {app.config['CACHE_BUST_MANIFEST']}")
+
+    @app.cli.command('makethumbnails')
+    def makethumbnails_command():
+        from flasquelistan import thumbnails
+        done, failed = thumbnails.make_missing_thumbnails()
+        click.echo(f"Made thumbnails of {done} pictures, {failed} failed")
+
+    @app.cli.command('processimages')
+    def processimages_command():
+        from flasquelistan import imageprocessing
+        done, failed = imageprocessing.process_pending()
+        click.echo(f"Processed {done} pictures, {failed} failed")
+
     @app.cli.command('dropdb')
     def dropdb_command():
         from flasquelistan import models
@@ -133,6 +163,33 @@ def register_cli(app):
         from flasquelistan.scripts import testdata
         testdata.populate()
 
+    @app.cli.command('populatesyntheticdb')
+    @click.option('--users', default=500, type=click.IntRange(min=1))
+    @click.option('--transactions', default=1000000,
+                  type=click.IntRange(min=0))
+    @click.option('--notifications', default=50000,
+                  type=click.IntRange(min=0))
+    @click.option('--quotes', default=10000, type=click.IntRange(min=0))
+    @click.option('--profile-pictures', default=20000,
+                  type=click.IntRange(min=0))
+    @click.option('--seed', default=0)
+    def populatesyntheticdb_command(**counts):
+        from flasquelistan.scripts import syntheticdata
+        if click.confirm("You are about to add a LOT of fake data to the "
+                         "database, are you sure you want to do this?",
+                         abort=True):
+            syntheticdata.populate(**counts)
+
+    @app.cli.command('benchmark')
+    @click.option('--rounds', default=20, type=click.IntRange(min=1))
+    @click.option('--bac', is_flag=True)
+    def benchmark_command(rounds, bac):
+        from flasquelistan.scripts import benchmark
+        if bac:
+            benchmark.run_bac(rounds)
+        else:
+            benchmark.run(rounds)
+
     @app.cli.command('createadmin')
     def createadmin_command():
         from flasquelistan import models
@@ -154,12 +211,61 @@ def register_cli(app):
         models.db.session.commit()
 
 
+def setup_sqlite(app):
+    """Let several worker processes share an SQLite database.
+
+    In WAL mode, reading does not block writing and the other way around.
+    Writers still take turns, waiting up to five seconds (the sqlite3
+    module's default timeout) for each other.
+    """
+    import sqlalchemy as sqla
+    from flasquelistan import models
+
+    with app.app_context():
+        engine = models.db.engine
+
+    if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        return
+
+    @sqla.event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+
 def init_db(app):
     from flasquelistan import models
     with app.app_context():
         models.db.create_all()
 
 
+def create_indexes(app):
+    """Add indexes missing from existing tables.
+
+    create_all only creates indexes together with new tables, so indexes
+    added to models later have to be created on existing databases with
+    this. Indexes that already exist are left alone.
+    """
+    import sqlalchemy as sqla
+    from flasquelistan import models
+    with app.app_context():
+        engine = models.db.engine
+        inspector = sqla.inspect(engine)
+        for table in models.db.metadata.sorted_tables:
+            existing = {index['name']
+                        for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    click.echo(f"Creating index {index.name}...")
+                    index.create(engine)
+
+        if engine.dialect.name == 'sqlite':
+            # Let the query planner know how selective the indexes are
+            with engine.begin() as connection:
+                connection.exec_driver_sql('ANALYZE')
+
+
 def setup_jinja(app):
     app.jinja_env.globals['site_title'] = \
         lambda: app.config.get('SITE_TITLE', 'Strequelistan')
@@ -194,7 +300,7 @@ def setup_flask_admin(app, db):
         pass
 
     class UserModelView(LoginModelView):
-        form_excluded_columns = ['transactions']
+        form_excluded_columns = ['transactions', 'bac_state']
         column_exclude_list = [
             '_password_hash', 'body_mass', 'profile_picture', 'y_chromosome',
             '_password_timestamp'
@@ -275,11 +381,38 @@ def setup_flask_uploads(app):
     flask_uploads.configure_uploads(app, util.profile_pictures)
 
     app.jinja_env.globals['url_for_image'] = util.url_for_image
+    app.jinja_env.globals['url_for_profile_picture'] = (
+        util.url_for_profile_picture
+    )
     app.jinja_env.globals['gallery_page_for_image'] = (
         gallery.gallery_page_for_image
     )
 
 
+def setup_bac_cache(app):
+    from flasquelistan.models import user
+
+    # flask.g may outlive a request (see setup_flask_babel), so start every
+    # request with an empty cache.
+    app.before_request(user.reset_bac_cache)
+    app.teardown_request(user.log_bac_cache_stats)
+
+
+def setup_event_outbox(app):
+    from flasquelistan import outbox
+    outbox.setup_outbox(app)
+
+
+def setup_mailer(app):
+    from flasquelistan import mail
+    mail.setup_mailer(app)
+
+
+def setup_image_processor(app):
+    from flasquelistan import imageprocessing
+    imageprocessing.setup_image_processor(app)
+
+
 def setup_csrf_protection(app):
     from flask_wtf.csrf import CSRFProtect
     csrf = CSRFProtect(app)
@@ -0,0 +1,233 @@
+"""Process uploaded profile pictures in the background.
+
+Decoding and encoding a large picture takes a while, and the app runs on a
+single gevent worker, so doing it before responding to an upload holds up
+everyone else. Instead, the upload saves the picture as it is, marks it as
+processing with an ImageProcessingJob and puts it in the app's processing
+queue. IMAGE_PROCESSING_WORKERS background tasks take pictures from the
+queue and
+
+- rotate JPEGs according to their EXIF orientation, saved under a new
+  filename so that cached and signed URLs of the original do not show it,
+- convert GIFs to (animated) WebP, which is a lot smaller,
+- save thumbnails, see thumbnails.py,
+
+in an OS thread, so that the gevent loop keeps serving requests meanwhile.
+Then the picture is updated and the job removed. A picture that cannot be
+processed keeps a failed job, and is shown as uploaded. The files made for a
+picture deleted while it was processed are removed again.
+
+The queue holds at most IMAGE_PROCESSING_QUEUE_SIZE pictures. Pictures that
+do not fit, and pictures still in the queue when the process exits, stay
+marked as processing until `flask processimages` processes them.
+
+With PROCESS_IMAGES_IN_BACKGROUND set to False, pictures are processed right
+away instead, which is simpler to test.
+"""
+import os
+import queue
+
+import flask
+from PIL import Image, ImageOps
+from sqlalchemy.orm.exc import StaleDataError
+
+from flasquelistan import background, models, thumbnails, util
+from flasquelistan.factory import socketio
+
+# The EXIF tag of how the camera was held
+ORIENTATION_TAG = 0x0112
+
+
+def unused_filename(directory, stem, extension):
+    """Return stem.extension, or stem_<n>.extension if that is taken, like
+    Flask-Uploads does."""
+    new_filename = f'{stem}.{extension}'
+    suffix = 0
+    while os.path.exists(os.path.join(directory, new_filename)):
+        suffix += 1
+        new_filename = f'{stem}_{suffix}.{extension}'
+    return new_filename
+
+
+def rotate_jpeg(directory, filename):
+    """Save the JPEG filename in directory rotated according to its EXIF
+    orientation, under a new filename so that its URL changes. Return the
+    filename of the rotated picture, filename if it needs no rotation."""
+    with Image.open(os.path.join(directory, filename)) as img:
+        if img.getexif().get(ORIENTATION_TAG, 1) == 1:
+            return filename
+
+        stem, extension = os.path.splitext(filename)
+        rotated_filename = unused_filename(directory, f'{stem}_rotated',
+                                           extension.lstrip('.'))
+        rotated = ImageOps.exif_transpose(img)
+        rotated.save(os.path.join(directory, rotated_filename), format='JPEG',
+                     exif=rotated.getexif())
+
+    return rotated_filename
+
+
+def gif_to_webp(directory, filename):
+    """Save the GIF filename in directory as a WebP, keeping any animation.
+    Return the filename of the WebP."""
+    webp_filename = unused_filename(directory, os.path.splitext(filename)[0],
+                                    'webp')
+
+    with Image.open(os.path.join(directory, filename)) as img:
+        img.save(os.path.join(directory, webp_filename), format='WEBP',
+                 save_all=True, loop=0)
+
+    return webp_filename
+
+
+def process_picture(directory, filename, settings):
+    """Rotate or convert the picture filename in directory and save its
+    thumbnails. Return the filename of the processed picture and the
+    thumbnails, see thumbnails.save_thumbnails. Raises one of
+    thumbnails.IMAGE_ERRORS if the picture cannot be read.
+
+    Needs no app context, so that it can run in a thread of its own.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.jpg', '.jpeg'):
+        filename = rotate_jpeg(directory, filename)
+    elif extension == '.gif':
+        filename = gif_to_webp(directory, filename)
+
+    return filename, thumbnails.save_thumbnails(directory, filename, settings)
+
+
+def run_in_thread(func, *args):
+    """Call func(*args) in an OS thread and wait for it to return.
+
+    Under gevent, the background tasks are greenlets, which would block the
+    whole process while working on a picture.
+    """
+    if socketio.server.eio.async_mode in ('gevent', 'gevent_uwsgi'):
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+
+class ImageProcessor(background.BackgroundQueue):
+    @property
+    def workers(self):
+        return self.app.config.get('IMAGE_PROCESSING_WORKERS', 2)
+
+    @property
+    def maxsize(self):
+        return self.app.config.get('IMAGE_PROCESSING_QUEUE_SIZE', 100)
+
+    def put(self, picture_id):
+        """Process the picture, which should have an ImageProcessingJob."""
+        if not self.app.config.get('PROCESS_IMAGES_IN_BACKGROUND', True):
+            self.process(picture_id)
+            return
+
+        try:
+            self.put_in_queue(picture_id, block=False)
+        except queue.Full:
+            self.app.logger.warning(
+                "Image processing queue full, profile picture %s is left "
+                "for `flask processimages`", picture_id)
+
+    def work(self, picture_ids):
+        for picture_id in picture_ids:
+            self.process(picture_id)
+
+    def work_failed(self, picture_ids):
+        self.app.logger.exception(
+            "Could not process profile picture %s", picture_ids[0])
+
+    def process(self, picture_id):
+        """Process the picture and record the result. Return whether it was
+        processed."""
+        with self.app_context():
+            return self._process(picture_id)
+
+    def _process(self, picture_id):
+        picture = models.db.session.get(models.ProfilePicture, picture_id)
+        if picture is None or picture.processing_job is None:
+            # Deleted, or processed already
+            return False
+
+        directory = util.profile_pictures.config.destination
+        filename = picture.filename
+        settings = thumbnails.thumbnail_settings(self.app.config)
+        # Do not keep the database transaction open while working
+        models.db.session.commit()
+
+        try:
+            new_filename, saved = run_in_thread(process_picture, directory,
+                                                filename, settings)
+        except thumbnails.IMAGE_ERRORS:
+            self.app.logger.exception(
+                "Could not process profile picture %s", picture_id)
+            job = models.db.session.get(models.ImageProcessingJob,
+                                        picture_id, populate_existing=True)
+            if job is not None:
+                job.failed = True
+                self._commit()
+            return False
+
+        # The picture may have been deleted while it was processed
+        picture = models.db.session.get(models.ProfilePicture, picture_id,
+                                        populate_existing=True)
+        if picture is not None:
+            picture.filename = new_filename
+            picture.thumbnails = [
+                models.ProfilePictureThumbnail(width=width, filename=filename)
+                for width, filename in saved
+            ]
+            picture.processing_job = None
+            if self._commit():
+                return True
+
+        self.app.logger.info("Profile picture %s was deleted while being "
+                             "processed", picture_id)
+        generated = [thumbnail for _, thumbnail in saved]
+        if new_filename != filename:
+            generated.append(new_filename)
+        for generated_filename in generated:
+            try:
+                os.remove(os.path.join(directory, generated_filename))
+            except FileNotFoundError:
+                pass
+        return False
+
+    def _commit(self):
+        """Commit, return False if a row was deleted meanwhile."""
+        try:
+            models.db.session.commit()
+        except StaleDataError:
+            models.db.session.rollback()
+            return False
+        return True
+
+
+def process_later(picture):
+    """Mark the picture as processing and put it in the current app's
+    processing queue. Commits."""
+    # Before committing, which would load the picture again
+    picture_id = picture.id
+    picture.processing_job = models.ImageProcessingJob()
+    models.db.session.commit()
+    flask.current_app.extensions['image_processor'].put(picture_id)
+
+
+def process_pending():
+    """Process every picture marked as processing, also those that failed
+    before. Return the number of pictures processed and failed."""
+    picture_ids = models.db.session.scalars(
+        models.db.select(models.ImageProcessingJob.profile_picture_id)
+        .order_by(models.ImageProcessingJob.timestamp)
+    ).all()
+
+    processor = flask.current_app.extensions['image_processor']
+    done = sum(1 for picture_id in picture_ids
+               if processor.process(picture_id))
+    return done, len(picture_ids) - done
+
+
+def setup_image_processor(app):
+    app.extensions['image_processor'] = ImageProcessor(app)
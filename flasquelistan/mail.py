@@ -0,0 +1,218 @@
+"""Send email from a queue, over one SMTP connection.
+
+util.send_email puts the message in the app's mail queue and returns. A
+single background worker sends the queued messages one at a time, reusing
+one authenticated SMTP connection (one STARTTLS handshake, one login) until
+it has been idle for MAIL_IDLE_TIMEOUT seconds. Sending 200 balance
+reminders is 200 messages over one connection, instead of 200 threads with
+a connection each.
+
+The worker sends at most MAIL_RATE_LIMIT messages per second. A message
+that fails with a temporary error (a dropped connection, a 4xx reply) is
+retried up to MAIL_RETRIES times, after MAIL_RETRY_DELAY seconds, doubled
+for every attempt. Other errors are logged and the message is dropped.
+
+The queue holds at most MAIL_QUEUE_SIZE messages. When it is full,
+send_email waits up to MAIL_QUEUE_TIMEOUT seconds for room and then raises
+queue.Full. Messages still in the queue when the process exits are lost.
+
+MAIL_TRANSPORT is where the messages go: 'smtp', 'debug' (print them) or
+'memory' (keep them in a list, for tests). By default it is 'debug' in debug
+mode and 'smtp' otherwise.
+"""
+import queue
+import smtplib
+import ssl
+import threading
+import time
+
+
+class SMTPTransport:
+    """An SMTP connection, opened when first needed and then kept open."""
+
+    def __init__(self, config):
+        self.config = config
+        self.smtp = None
+
+    def send(self, msg):
+        if self.smtp is None:
+            self.smtp = self.connect()
+        self.smtp.send_message(msg)
+
+    def connect(self):
+        """Connect with SMTP & STARTTLS.
+
+        Uses the best security defaults according to the python documentation
+        at the time of writing:
+        https://docs.python.org/3/library/ssl.html#ssl-security
+
+        "[ssl.create_default_context()] will load the system’s trusted CA
+        certificates, enable certificate validation and hostname checking,
+        and try to choose reasonably secure protocol and cipher settings."
+        """
+        config = self.config
+        smtp = smtplib.SMTP(config['SMTP_MAILSERVER'],
+                            port=config['SMTP_PORT'])
+        try:
+            if config.get('SMTP_USE_STARTTLS'):
+                context = ssl.create_default_context()
+                smtp.starttls(context=context)
+
+            username = config.get('SMTP_USERNAME')
+            password = config.get('SMTP_PASSWORD')
+            if username and password:
+                smtp.login(username, password)
+        except Exception:
+            smtp.close()
+            raise
+
+        return smtp
+
+    def close(self):
+        if self.smtp is None:
+            return
+
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            # Most likely closed by the server already
+            self.smtp.close()
+        finally:
+            self.smtp = None
+
+
+class DebugTransport:
+    """Print messages instead of sending them."""
+
+    def send(self, msg):
+        print("\n===== DEBUG: Did not send the "
+              "following email message: =====\n")
+        print(msg)
+        print("===== DEBUG: Content is: =====\n")
+        print(msg.get_content())
+        print("===== END DEBUG =====\n")
+
+    def close(self):
+        pass
+
+
+class MemoryTransport:
+    """Keep messages in a list instead of sending them."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append(msg)
+
+    def close(self):
+        pass
+
+
+def make_transport(app):
+    name = app.config.get('MAIL_TRANSPORT')
+    if name is None:
+        name = 'debug' if app.debug else 'smtp'
+
+    if name == 'smtp':
+        return SMTPTransport(app.config)
+    elif name == 'debug':
+        return DebugTransport()
+    elif name == 'memory':
+        return MemoryTransport()
+    else:
+        raise ValueError(f"Unknown MAIL_TRANSPORT {name!r}")
+
+
+def is_temporary(error):
+    """Return whether sending again later could work."""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500
+                   for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    # Could not connect, timeouts
+    return isinstance(error, OSError)
+
+
+class Mailer:
+    def __init__(self, app, transport=None):
+        self.app = app
+        self.transport = transport or make_transport(app)
+        self.queue = queue.Queue(
+            maxsize=app.config.get('MAIL_QUEUE_SIZE', 1000))
+        self._worker = None
+        self._lock = threading.Lock()
+        self._last_sent = None
+
+    def put(self, msg):
+        """Queue a message to be sent."""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run,
+                                                name='mailer', daemon=True)
+                self._worker.start()
+
+        self.queue.put(msg,
+                       timeout=self.app.config.get('MAIL_QUEUE_TIMEOUT', 5))
+
+    def join(self):
+        """Wait until every message queued so far has been sent, or given
+        up on."""
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            try:
+                msg = self.queue.get(
+                    timeout=self.app.config.get('MAIL_IDLE_TIMEOUT', 30))
+            except queue.Empty:
+                self.transport.close()
+                continue
+
+            try:
+                self._send(msg)
+            except Exception:
+                self.app.logger.exception("Could not send email to %s",
+                                          msg['To'])
+            finally:
+                self.queue.task_done()
+
+    def _send(self, msg):
+        config = self.app.config
+        attempt = 0
+        while True:
+            self._wait_for_rate_limit()
+            try:
+                self.transport.send(msg)
+                return
+            except Exception as error:
+                # Start over with a new connection, whatever state this one
+                # is in
+                self.transport.close()
+                if attempt >= config.get('MAIL_RETRIES', 3) or \
+                        not is_temporary(error):
+                    raise
+
+                delay = config.get('MAIL_RETRY_DELAY', 2) * 2 ** attempt
+                self.app.logger.warning(
+                    "Could not send email to %s, retrying in %s s: %r",
+                    msg['To'], delay, error)
+                time.sleep(delay)
+                attempt += 1
+
+    def _wait_for_rate_limit(self):
+        rate = self.app.config.get('MAIL_RATE_LIMIT')
+        if rate and self._last_sent is not None:
+            wait = self._last_sent + 1 / rate - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self._last_sent = time.monotonic()
+
+
+def setup_mailer(app):
+    app.extensions['mailer'] = Mailer(app)
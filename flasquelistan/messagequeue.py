@@ -0,0 +1,73 @@
+"""Share SocketIO events between worker processes.
+
+A SocketIO client is connected to one worker process, but balance changes
+and notifications are emitted by whichever worker handled the request. With
+SOCKETIO_MESSAGE_QUEUE set, every emit is published on a message queue that
+all workers listen to, and each worker passes it on to its own clients.
+
+In production the queue is Redis (redis://host:port/db). The local:// queue
+only connects SocketIO servers in the same process. It needs no server and
+is meant for tests and development, to run the same code paths as with
+Redis.
+"""
+import collections
+import threading
+
+import socketio
+
+LOCAL_QUEUE_URL = 'local://'
+
+
+class LocalManager(socketio.PubSubManager):
+    """Message queue between the SocketIO servers of one process."""
+    name = 'local'
+
+    # Channel name -> queues of the listening managers
+    _listeners = collections.defaultdict(list)
+    _lock = threading.Lock()
+
+    def __init__(self, url=LOCAL_QUEUE_URL, channel='flasquelistan',
+                 write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only,
+                         logger=logger, json=json)
+        self.queue = None
+
+    def initialize(self):
+        if not self.write_only:
+            # _listen runs in the server's own background task, see
+            # background.py for why the queue comes from the server
+            self.queue = self.server.eio.create_queue()
+            with self._lock:
+                self._listeners[self.channel].append(self.queue)
+        super().initialize()
+
+    def _publish(self, data):
+        # Encode like a real queue would, so that anything Redis could not
+        # carry fails here too
+        message = self.json.dumps(data)
+        with self._lock:
+            queues = list(self._listeners[self.channel])
+        for queue in queues:
+            queue.put(message)
+
+    def _listen(self):
+        while True:
+            yield self.queue.get()
+
+
+def client_manager(app):
+    """Return the SocketIO client manager for the configured message queue,
+    or None to keep the clients in this process only."""
+    url = app.config.get('SOCKETIO_MESSAGE_QUEUE')
+    if not url:
+        return None
+
+    channel = app.config.get('SOCKETIO_CHANNEL', 'flasquelistan')
+    if url.startswith(LOCAL_QUEUE_URL):
+        manager_class = LocalManager
+    elif url.startswith(('redis://', 'rediss://')):
+        manager_class = socketio.RedisManager
+    else:
+        manager_class = socketio.KombuManager
+
+    return manager_class(url, channel=channel)
@@ -1,9 +1,12 @@
 from flasquelistan.models.base import db
 from flasquelistan.models.user import (
+    BacState,
     Group,
+    ImageProcessingJob,
     NicknameChange,
     NicknameChangeStatus,
     ProfilePicture,
+    ProfilePictureThumbnail,
     RegistrationRequest,
     User,
 )
@@ -30,11 +33,14 @@ __all__ = [
     'db',
     'TESTING',
     'User',
+    'BacState',
     'RegistrationRequest',
     'Group',
     'NicknameChangeStatus',
     'NicknameChange',
     'ProfilePicture',
+    'ProfilePictureThumbnail',
+    'ImageProcessingJob',
     'Article',
     'Transaction',
     'Streque',
@@ -1,14 +1,31 @@
 import datetime
 import hashlib
 import secrets
+import time
 
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import make_transient_to_detached
 from sqlalchemy.orm.exc import NoResultFound
 
 from flasquelistan.models.base import db
 from flasquelistan.models.transactions import Transaction
 
 
+# Seconds an authenticated key is remembered without asking the database.
+# Edits through the profile pages clear the cache at once, other changes
+# (another worker process, flask-admin) are picked up within this time.
+AUTHENTICATION_CACHE_TTL = 60
+
+# Seconds between writes of last_used_timestamp for the same key
+LAST_USED_INTERVAL = 5 * 60
+
+# Key hash -> (time.monotonic() when cached, column values of the key)
+_authentication_cache = {}
+
+# Key id -> when its last_used_timestamp was last written
+_last_used_written = {}
+
+
 class ApiKey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -85,19 +102,65 @@ class ApiKey(db.Model):
     @staticmethod
     def authenticate(key):
         """If key is a valid and active api key, return the corresponding
-        ApiKey. If not, return None."""
-        try:
-            api_key = ApiKey.query.filter_by(
-                _api_key_hash=ApiKey.hash_key(key)).one()
-        except NoResultFound:
-            return None
+        ApiKey. If not, return None.
+
+        Every API request and SocketIO connection authenticates, so keys are
+        cached for AUTHENTICATION_CACHE_TTL seconds, and last_used_timestamp
+        is written at most every LAST_USED_INTERVAL seconds.
+        """
+        key_hash = ApiKey.hash_key(key)
+
+        cached = _authentication_cache.get(key_hash)
+        if cached and time.monotonic() - cached[0] < AUTHENTICATION_CACHE_TTL:
+            api_key = ApiKey._from_cached_values(cached[1])
+        else:
+            try:
+                api_key = ApiKey.query.filter_by(_api_key_hash=key_hash).one()
+            except NoResultFound:
+                return None
+            _authentication_cache[key_hash] = (
+                time.monotonic(),
+                {attr.key: getattr(api_key, attr.key)
+                 for attr in db.inspect(ApiKey).column_attrs}
+            )
 
         if not api_key.is_enabled:
             return None
 
-        api_key.last_used_timestamp = datetime.datetime.utcnow()
-        db.session.commit()
+        api_key.mark_used()
+        return api_key
+
+    @staticmethod
+    def _from_cached_values(values):
+        """Return the key with the cached values, without loading it from
+        the database, unless the session already has it."""
+        api_key = db.session.identity_map.get(
+            db.session.identity_key(ApiKey, values['id']))
+        if api_key is None:
+            api_key = ApiKey(**values)
+            make_transient_to_detached(api_key)
+            db.session.add(api_key)
         return api_key
 
+    @staticmethod
+    def clear_authentication_cache():
+        """Forget all cached keys. Must be called when a key is changed."""
+        _authentication_cache.clear()
+
+    def mark_used(self):
+        now = datetime.datetime.utcnow()
+        last_written = _last_used_written.get(self.id)
+        if (last_written is not None and
+                (now - last_written).total_seconds() < LAST_USED_INTERVAL):
+            return
+
+        db.session.execute(
+            db.update(ApiKey)
+            .where(ApiKey.id == self.id)
+            .values(last_used_timestamp=now)
+        )
+        db.session.commit()
+        _last_used_written[self.id] = now
+
     def __str__(self):
         return f"ApiKey \"{self.name}\" belonging to {self.user}"
@@ -3,6 +3,7 @@ import datetime
 import flask_babel
 import markdown
 from sqlalchemy.ext.hybrid import hybrid_method
+from sqlalchemy.orm.attributes import set_committed_value
 
 from flasquelistan import util
 from flasquelistan.models.base import db
@@ -79,20 +80,53 @@ class Transaction(db.Model):
         'polymorphic_on': type,
     }
 
+    __table_args__ = (
+        # A user's transactions, newest first (history, profile, BAC)
+        db.Index('ix_transaction_user_id_timestamp', 'user_id', 'timestamp'),
+        # Recent streques of everyone (index page, admin listings)
+        db.Index('ix_transaction_type_voided_timestamp',
+                 'type', 'voided', 'timestamp'),
+        db.Index('ix_transaction_api_key_id', 'api_key_id'),
+        # Everything within a date range (admin transaction listing)
+        db.Index('ix_transaction_timestamp', 'timestamp'),
+    )
+
     @property
     def formatted_value(self):
         return flask_babel.format_currency(self.value / 100, 'SEK')
 
     def void_and_refund(self):
-        if self.voided:
+        """Void the transaction and refund it. Return False if it was voided
+        already.
+
+        Voiding is a single UPDATE ... WHERE voided = 0, so that when
+        several worker processes void the same transaction at once, only
+        one of them refunds it.
+        """
+        voided = db.session.execute(
+            db.update(Transaction)
+            .where(Transaction.id == self.id,
+                   Transaction.voided.is_not(True))
+            .values(voided=True)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        set_committed_value(self, 'voided', True)
+        if voided != 1:
             return False
 
-        self.user.balance -= self.value
+        new_balance = self.user.change_balance(-self.value)
+
+        if self.type == 'streque' and self.standardglas:
+            # A voided streque can be anywhere in the history, replay to
+            # get the alcohol state right. The UPDATE above holds the
+            # database's write lock, so no other worker can add a streque
+            # between the replay and writing its result.
+            self.user.rebuild_bac_state()
 
-        self.voided = True
         db.session.commit()
+        self.user.invalidate_bac()
 
-        util.emit_balance_change_event(self.user, self.user.balance + self.value)
+        util.emit_balance_change_event(self.user, new_balance + self.value)
 
         return True
 
@@ -123,6 +157,9 @@ class Streque(Transaction):
 
     __mapper_args__ = {
         'polymorphic_identity': 'streque',
+        # Load standardglas with every Transaction query, instead of once
+        # per streque when it is first accessed
+        'polymorphic_load': 'inline',
     }
 
     @hybrid_method
@@ -144,6 +181,14 @@ class AdminTransaction(Transaction):
     }
 
     def create_notification(self):
+        notification = Notification(**self.notification_values())
+        db.session.add(notification)
+        db.session.commit()
+        util.emit_notification_event(notification)
+
+    def notification_values(self):
+        """Return the column values of a notification about this
+        transaction."""
         if self.value >= 0:
             with flask_babel.force_locale('sv_SE'):
                 text = (
@@ -161,15 +206,12 @@ class AdminTransaction(Transaction):
                     )
                 )
 
-        notification = Notification(
-            text=text,
-            user_id=self.user_id,
-            type='admintransaction',
-            reference=str(self.id)
-        )
-        db.session.add(notification)
-        db.session.commit()
-        util.emit_notification_event(notification)
+        return {
+            'text': text,
+            'user_id': self.user_id,
+            'type': 'admintransaction',
+            'reference': str(self.id),
+        }
 
 
 class UserTransaction(Transaction):
@@ -226,16 +268,14 @@ class CreditTransfer(db.Model):
             )
         )
 
-        payer.balance -= value
-        payee.balance += value
-
-        util.emit_balance_change_event(payer, payer.balance + value)
-        util.emit_balance_change_event(payee, payee.balance - value)
-
         db.session.add(payer_tx)
         db.session.add(payee_tx)
-        db.session.commit()
+        new_payer_balance = payer.change_balance(-value)
+        new_payee_balance = payee.change_balance(value)
 
+        # Flush to get the ids of the transactions, the credit transfer is
+        # committed together with them.
+        db.session.flush()
         credit_transfer = cls(
             payer_transaction_id=payer_tx.id,
             payee_transaction_id=payee_tx.id
@@ -244,6 +284,10 @@ class CreditTransfer(db.Model):
         db.session.add(credit_transfer)
         db.session.commit()
 
+        with util.batched_events():
+            util.emit_balance_change_event(payer, new_payer_balance + value)
+            util.emit_balance_change_event(payee, new_payee_balance - value)
+
         return credit_transfer
 
     def void(self):
@@ -6,17 +6,66 @@ import random
 import string
 
 import bcrypt
+import flask
 import flask_babel
 import flask_login
 import vobject
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm.attributes import set_committed_value
 
-from flasquelistan import models, util
+from flasquelistan import alcohol, models, util
 from flasquelistan.models.base import db
-from flasquelistan.models.social import Poke
+from flasquelistan.models.social import Notification, Poke
 from flasquelistan.models.transactions import AdminTransaction, Streque
 
 
+def alcoholic_streques_query(now=None):
+    """Return a query for (user_id, timestamp, standardglas) of the
+    non-voided alcoholic streques within the BAC window."""
+    now = now or datetime.datetime.utcnow()
+    return (db.session.query(Streque.user_id,
+                             Streque.timestamp,
+                             Streque.standardglas)
+            .filter(Streque.voided.is_(False),
+                    Streque.timestamp >= now - alcohol.BAC_WINDOW,
+                    Streque.standardglas > 0))
+
+
+def bac_cache():
+    """Return the per-request cache of user id -> BAC, or None outside of
+    requests.
+
+    BAC is read several times per request for the same user (the template,
+    bac_emoji, api_dict, balance change events), this makes all but the
+    first read free. Writes that change the BAC must call
+    User.invalidate_bac.
+    """
+    if not flask.has_request_context():
+        return None
+
+    if 'bac_cache' not in flask.g:
+        reset_bac_cache()
+
+    return flask.g.bac_cache
+
+
+def reset_bac_cache():
+    """Empty the BAC cache. Run at the start of every request, since the
+    app context (and flask.g) may outlive a single request."""
+    flask.g.bac_cache = {}
+    flask.g.bac_cache_hits = 0
+    flask.g.bac_cache_misses = 0
+
+
+def log_bac_cache_stats(exception=None):
+    hits = flask.g.get('bac_cache_hits', 0)
+    misses = flask.g.get('bac_cache_misses', 0)
+    if hits or misses:
+        flask.current_app.logger.debug(
+            "BAC cache: %d hits, %d misses", hits, misses)
+
+
 class User(flask_login.UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(254), unique=True)
@@ -65,6 +114,12 @@ class User(flask_login.UserMixin, db.Model):
         lazy='dynamic',
         foreign_keys='NicknameChange.user_id'
     )
+    bac_state = db.relationship(
+        'BacState',
+        back_populates='user',
+        uselist=False,
+        lazy='joined'
+    )
 
     # Do not change the following directly, use User.password
     _password_hash = db.Column(db.String(128))
@@ -95,7 +150,8 @@ class User(flask_login.UserMixin, db.Model):
                 'id': self.profile_picture_id,
                 'url': util.url_for_image(
                     self.profile_picture.filename, 'profilepicture'
-                )}
+                ),
+                'processing': self.profile_picture.is_processing}
         else:
             data['profile_picture'] = None
         return data
@@ -244,25 +300,188 @@ class User(flask_login.UserMixin, db.Model):
 
         return None
 
+    def change_balance(self, delta):
+        """Add delta to the balance and return the new balance.
+
+        The addition is done by the database in a single UPDATE, so
+        concurrent changes of the same balance (e.g. from several worker
+        processes) cannot overwrite each other, like reading, changing and
+        writing back self.balance could. Not committed.
+        """
+        new_balance = db.session.execute(
+            db.update(User)
+            .where(User.id == self.id)
+            .values(balance=User.balance + delta)
+            .returning(User.balance)
+            .execution_options(synchronize_session=False)
+        ).scalar_one()
+        set_committed_value(self, 'balance', new_balance)
+        return new_balance
+
+    @staticmethod
+    def change_balances(deltas):
+        """Add to the balances of many users in a single UPDATE, like
+        change_balance. deltas is a dict of user -> delta. Return a dict of
+        user -> new balance. Not committed.
+        """
+        if not deltas:
+            return {}
+
+        users = {user.id: user for user in deltas}
+        rows = db.session.execute(
+            db.update(User)
+            .where(User.id.in_(users))
+            .values(balance=User.balance + db.case(
+                {user.id: delta for user, delta in deltas.items()},
+                value=User.id
+            ))
+            .returning(User.id, User.balance)
+            .execution_options(synchronize_session=False)
+        )
+
+        new_balances = {}
+        for user_id, new_balance in rows:
+            user = users[user_id]
+            set_committed_value(user, 'balance', new_balance)
+            new_balances[user] = new_balance
+        return new_balances
+
     def strequa(self, article, by_user, by_api_key=None):
-        value = article.value
+        streque = self._add_streque(article, by_user, by_api_key)
+        new_balance = self.change_balance(-article.value)
+        db.session.commit()
+        self.invalidate_bac()
+
+        util.emit_balance_change_event(self, new_balance + article.value)
 
+        return streque
+
+    @staticmethod
+    def bulk_strequa(orders, by_user, by_api_key=None):
+        """Add a streque for every (user, article) pair in orders.
+
+        Either all streques are added or, if anything fails, none. Each
+        user's balance is changed once and gets a single balance change
+        event, however many streques they got. Return the streques in the
+        same order as orders, and a dict of user -> new balance.
+        """
+        orders = list(orders)
+        # The whole round at once, so that each user's alcohol can be
+        # absorbed together
+        timestamp = datetime.datetime.utcnow()
+        deltas = {}
+        standardglas = {}
+        for user, article in orders:
+            deltas[user] = deltas.get(user, 0) - article.value
+            if article.standardglas and article.standardglas > 0:
+                standardglas[user] = (standardglas.get(user, 0)
+                                      + article.standardglas)
+
+        # A bulk insert, since SQLite cannot insert several ORM objects in
+        # one statement when their ids are needed back
+        streques = db.session.scalars(
+            db.insert(Streque).returning(Streque),
+            [{'value': -article.value, 'text': article.name,
+              'user_id': user.id, 'created_by_id': by_user.id,
+              'api_key_id': by_api_key.id if by_api_key else None,
+              'standardglas': article.standardglas, 'timestamp': timestamp}
+             for user, article in orders]
+        ).all()
+        User.absorb_alcohol(standardglas, timestamp)
+        new_balances = User.change_balances(deltas)
+
+        user_ids = [user.id for user in deltas]
+        streque_ids = [streque.id for streque in streques]
+        db.session.commit()
+
+        # The commit expired everything, load it again in one query per
+        # table instead of one per row
+        User.query.filter(User.id.in_(user_ids)).all()
+        reloaded = {streque.id: streque for streque in
+                    Streque.query.filter(Streque.id.in_(streque_ids))}
+
+        with util.batched_events():
+            for user, delta in deltas.items():
+                user.invalidate_bac()
+                util.emit_balance_change_event(user, new_balances[user] - delta)
+
+        return [reloaded[streque_id] for streque_id in streque_ids], \
+            new_balances
+
+    def _add_streque(self, article, by_user, by_api_key):
+        """Add a streque of article, without charging for it or
+        committing."""
         streque = Streque(
-            value=-value,
+            value=-article.value,
             text=article.name,
             user_id=self.id,
             created_by_id=by_user.id,
             api_key_id=by_api_key.id if by_api_key else None,
-            standardglas=article.standardglas
+            standardglas=article.standardglas,
+            timestamp=datetime.datetime.utcnow()
         )
-        self.balance -= value
 
         db.session.add(streque)
-        db.session.commit()
+        self.absorb_streque(streque)
+        return streque
 
-        util.emit_balance_change_event(self, self.balance + value)
+    @staticmethod
+    def bulk_admin_transactions(transactions, by_user):
+        """Make an admin transaction, with a notification, for every
+        (user, value, message) in transactions.
+
+        The transactions and the notifications are inserted with a statement
+        each and everything is committed at once, so either every user gets
+        their transaction or, if anything fails, nobody does. Events are
+        emitted afterwards, batched. Return the transactions.
+        """
+        transactions = list(transactions)
+        if not transactions:
+            return []
+
+        deltas = {}
+        for user, value, message in transactions:
+            deltas[user] = deltas.get(user, 0) + value
+
+        # Bulk inserts, since SQLite cannot insert several ORM objects in
+        # one statement when their ids are needed back
+        admin_transactions = db.session.scalars(
+            db.insert(AdminTransaction).returning(AdminTransaction),
+            [{'value': value, 'text': message, 'created_by_id': by_user.id,
+              'user_id': user.id}
+             for user, value, message in transactions]
+        ).all()
+        notifications = db.session.scalars(
+            db.insert(Notification).returning(Notification),
+            [transaction.notification_values()
+             for transaction in admin_transactions]
+        ).all()
+        new_balances = User.change_balances(deltas)
+
+        user_ids = [user.id for user in deltas]
+        transaction_ids = [transaction.id for transaction in admin_transactions]
+        notification_ids = [notification.id for notification in notifications]
+        db.session.commit()
 
-        return streque
+        # The commit expired everything, load it again in one query per
+        # table instead of one per row
+        User.query.filter(User.id.in_(user_ids)).all()
+        notifications = (Notification.query
+                         .filter(Notification.id.in_(notification_ids))
+                         .order_by(Notification.id)
+                         .all())
+
+        with util.batched_events():
+            for user, delta in deltas.items():
+                user.invalidate_bac()
+                util.emit_balance_change_event(user, new_balances[user] - delta)
+            for notification in notifications:
+                util.emit_notification_event(notification)
+
+        return (AdminTransaction.query
+                .filter(AdminTransaction.id.in_(transaction_ids))
+                .order_by(AdminTransaction.id)
+                .all())
 
     def admin_transaction(self, value, message, by_user):
         transaction = AdminTransaction(value=value,
@@ -270,37 +489,113 @@ class User(flask_login.UserMixin, db.Model):
                                        created_by_id=by_user.id,
                                        user_id=self.id)
 
-        self.balance += value  # Value can be negative!
-
         db.session.add(transaction)
+        new_balance = self.change_balance(value)  # Value can be negative!
         db.session.commit()
+        self.invalidate_bac()
 
-        util.emit_balance_change_event(self, self.balance - value)
+        util.emit_balance_change_event(self, new_balance - value)
 
         return transaction
 
-    @property
-    def bac(self):
-        too_old = datetime.datetime.utcnow() - datetime.timedelta(days=7)
-        streques = (Streque.query
-                    .filter(Streque.user_id == self.id,
-                            Streque.voided.is_(False),
-                            Streque.timestamp >= too_old,
-                            Streque.standardglas > 0)
+    def replay_streques(self):
+        """Replay the last week of alcoholic streques.
+
+        Return the alcohol (kg) in the body right after the last streque and
+        the timestamp of that streque, or (0, None) if there are none.
+        """
+        streques = (alcoholic_streques_query()
+                    .filter(Streque.user_id == self.id)
                     .order_by(Streque.timestamp)
                     .all())
 
-        if not streques:
-            # No drinks with alcohol within the time threshold, return 0 to
-            # skip lots of logic below
-            return 0
+        return alcohol.replay_alcohol((timestamp, standardglas)
+                                      for _, timestamp, standardglas in streques)
+
+    def rebuild_bac_state(self):
+        """Recalculate the persisted alcohol state from the streques. Not
+        committed.
 
-        # 1 unit of alcohol (12 g of pure ethanol) in kg
-        standardglas_alcohol_content = 0.012
+        Written with a single INSERT ... ON CONFLICT, so that a state added
+        meanwhile by another worker process is replaced instead of making
+        the insert fail.
+        """
+        in_body, timestamp = self.replay_streques()
+        timestamp = timestamp or datetime.datetime.utcnow()
+
+        db.session.execute(
+            sqlite.insert(BacState)
+            .values(user_id=self.id, alcohol=in_body, timestamp=timestamp)
+            .on_conflict_do_update(
+                index_elements=[BacState.user_id],
+                set_={'alcohol': in_body, 'timestamp': timestamp})
+        )
+        self._set_bac_state(in_body, timestamp)
 
-        # kg of alcohol burned/second
-        burn_constant = 1.667e-06
+    def absorb_streque(self, streque):
+        """Add a new streque to the persisted alcohol state, see
+        absorb_alcohol. Not committed."""
+        if streque.standardglas and streque.standardglas > 0:
+            User.absorb_alcohol({self: streque.standardglas},
+                                streque.timestamp)
 
+    @staticmethod
+    def absorb_alcohol(standardglas, timestamp):
+        """Add the alcohol of streques at timestamp to the persisted alcohol
+        states. standardglas is a dict of user -> standardglas. Not
+        committed.
+
+        Streques are normally added in chronological order, in which case
+        only the burn-off since the previous update has to be applied. Like
+        change_balances, this is done by the database in a single UPDATE, so
+        that streques added at the same time by several worker processes
+        are all counted. A missing state, or a streque older than the state,
+        means we have to replay the streques of that user instead.
+        """
+        if not standardglas:
+            return
+
+        users = {user.id: user for user in standardglas}
+        timestamp = db.literal(timestamp, db.DateTime)
+        elapsed_seconds = 86400 * (db.func.julianday(timestamp)
+                                   - db.func.julianday(BacState.timestamp))
+        # SQLite's max() with two arguments is the larger one of them
+        burned = db.func.max(
+            BacState.alcohol - alcohol.BURN_CONSTANT * elapsed_seconds, 0)
+        added = db.case(
+            {user.id: glas * alcohol.STANDARDGLAS_ALCOHOL_CONTENT
+             for user, glas in standardglas.items()},
+            value=BacState.user_id
+        )
+        rows = db.session.execute(
+            db.update(BacState)
+            .where(BacState.user_id.in_(users),
+                   BacState.timestamp <= timestamp)
+            .values(alcohol=burned + added, timestamp=timestamp)
+            .returning(BacState.user_id, BacState.alcohol, BacState.timestamp)
+            .execution_options(synchronize_session=False)
+        ).all()
+
+        for user_id, alcohol_in_body, state_timestamp in rows:
+            users.pop(user_id)._set_bac_state(alcohol_in_body, state_timestamp)
+        for user in users.values():
+            user.rebuild_bac_state()
+
+    def _set_bac_state(self, alcohol_in_body, timestamp):
+        """Show the state just written to the database in self.bac_state,
+        without loading it again."""
+        state = self.bac_state
+        if state is None:
+            # Added by rebuild_bac_state, or by another worker process
+            db.session.expire(self, ['bac_state'])
+            return
+
+        set_committed_value(state, 'alcohol', alcohol_in_body)
+        set_committed_value(state, 'timestamp', timestamp)
+
+    @property
+    def bac_divisor(self):
+        """Body mass (kg) times the Widmark factor, BAC = 1000 * alcohol / this."""
         if self.y_chromosome is False:
             # Female
             body_mass_constant = 0.55
@@ -311,43 +606,26 @@ class User(flask_login.UserMixin, db.Model):
             # Somewhere in between
             body_mass_constant = 0.62
 
-        # No alcohol starting out
-        alcohol_in_body = 0
-        # No streque before first one
-        previous_streque_time = None
-        for streque in streques:
-            if previous_streque_time:
-                elapsed_seconds = (streque.timestamp
-                                   - previous_streque_time).total_seconds()
-            else:
-                elapsed_seconds = 0
-
-            # burn_constant will multiply by 0 first iteration, not burning
-            # away any alcohol.
-            alcohol_in_body -= burn_constant * elapsed_seconds
-
-            # Algorithm will burn away more alcohol that there is in the body
-            # which is not possible.
-            if alcohol_in_body < 0:
-
-                alcohol_in_body = 0
-
-            alcohol_in_body += (streque.standardglas
-                                * standardglas_alcohol_content)
+        body_mass = self.body_mass or 70
+        return body_mass * body_mass_constant
 
-            previous_streque_time = streque.timestamp
+    def bac_from_alcohol(self, alcohol_in_body, last_update, now=None):
+        """Convert alcohol (kg) in the body at last_update to BAC at now."""
+        if not alcohol_in_body:
+            # No drinks with alcohol within the time threshold, return 0 to
+            # skip the logic below
+            return 0
 
-        # Same as the loop above but burning away alcohol since last streque
-        elapsed_seconds = (datetime.datetime.utcnow()
-                           - previous_streque_time).total_seconds()
+        # Burn away alcohol since the last streque
+        now = now or datetime.datetime.utcnow()
+        elapsed_seconds = (now - last_update).total_seconds()
 
-        alcohol_in_body -= burn_constant * elapsed_seconds
+        alcohol_in_body = alcohol.burn_alcohol(alcohol_in_body, elapsed_seconds)
 
-        if alcohol_in_body < 0:
+        if not alcohol_in_body:
             return 0
 
-        body_mass = self.body_mass or 70
-        final_bac = 1000 * alcohol_in_body / (body_mass * body_mass_constant)
+        final_bac = 1000 * alcohol_in_body / self.bac_divisor
 
         # Round to 2 decimals ("#.## permille")
         blood_alcohol_concentration = round(final_bac, 2)
@@ -355,8 +633,76 @@ class User(flask_login.UserMixin, db.Model):
         return blood_alcohol_concentration
 
     @property
-    def bac_emoji(self):
-        bac = self.bac
+    def bac(self):
+        cache = bac_cache()
+        if cache is not None and self.id in cache:
+            flask.g.bac_cache_hits += 1
+            return cache[self.id]
+
+        if self.bac_state is not None:
+            bac = self.bac_from_alcohol(self.bac_state.alcohol,
+                                        self.bac_state.timestamp)
+        else:
+            # No state persisted yet (no streques since it was introduced),
+            # fall back to replaying the streques.
+            bac = self.bac_from_alcohol(*self.replay_streques())
+
+        if cache is not None:
+            flask.g.bac_cache_misses += 1
+            cache[self.id] = bac
+
+        return bac
+
+    def invalidate_bac(self):
+        """Forget the BAC cached for this request, see bac_cache."""
+        cache = bac_cache()
+        if cache is not None:
+            cache.pop(self.id, None)
+
+    @staticmethod
+    def bac_for_users(users, now=None):
+        """Return a dict of user id -> BAC for many users at once.
+
+        Users with a persisted alcohol state need no query at all, the
+        streques of the rest are fetched with a single query and replayed
+        with the array functions in flasquelistan.alcohol.
+        """
+        now = now or datetime.datetime.utcnow()
+        users = {user.id: user for user in users}
+
+        in_body = {}
+        missing = []
+        for user_id, user in users.items():
+            if user.bac_state is not None:
+                in_body[user_id] = (user.bac_state.alcohol,
+                                    user.bac_state.timestamp)
+            else:
+                missing.append(user_id)
+
+        if missing:
+            # Fetch the timestamps as the strings SQLite stores, which
+            # numpy parses much faster than SQLAlchemy creates datetimes.
+            streques = (alcoholic_streques_query(now)
+                        .with_entities(Streque.user_id,
+                                       db.cast(Streque.timestamp, db.String),
+                                       Streque.standardglas)
+                        .filter(Streque.user_id.in_(missing))
+                        .order_by(Streque.user_id, Streque.timestamp)
+                        .all())
+
+            if streques:
+                user_ids, timestamps, standardglas = zip(*streques)
+                in_body.update(alcohol.alcohol_for_users(
+                    user_ids, timestamps, standardglas))
+
+        return {
+            user_id: user.bac_from_alcohol(*in_body.get(user_id, (0, None)),
+                                           now=now)
+            for user_id, user in users.items()
+        }
+
+    @staticmethod
+    def emoji_for_bac(bac):
         if bac < 0.1:
             return None
         elif bac < 0.3:
@@ -380,6 +726,10 @@ class User(flask_login.UserMixin, db.Model):
         else:
             return '🇫🇮'
 
+    @property
+    def bac_emoji(self):
+        return self.emoji_for_bac(self.bac)
+
     @property
     def emoji(self):
         # md5-hash based on user id
@@ -424,6 +774,24 @@ class User(flask_login.UserMixin, db.Model):
         return f"User {self.first_name} {self.last_name} <{self.email}>"
 
 
+class BacState(db.Model):
+    """Alcohol in a user's body as of the last alcoholic streque.
+
+    Lets User.bac apply the burn-off since `timestamp` instead of replaying
+    a week of streques on every read. Kept up to date by User.strequa and
+    Transaction.void_and_refund.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    alcohol = db.Column(db.Float, nullable=False, default=0)  # kg
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    user = db.relationship('User', back_populates='bac_state')
+
+    def __repr__(self):
+        return f"BacState {self.user_id}: {self.alcohol} kg @ {self.timestamp}"
+
+
 class RegistrationRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(254))
@@ -508,8 +876,59 @@ class ProfilePicture(db.Model):
     timestamp = db.Column(db.DateTime, nullable=False,
                           default=datetime.datetime.utcnow)
 
+    thumbnails = db.relationship('ProfilePictureThumbnail',
+                                 cascade='all, delete-orphan',
+                                 order_by='ProfilePictureThumbnail.width')
+    # Joined, since pages show whether the picture is processing
+    processing_job = db.relationship('ImageProcessingJob', uselist=False,
+                                     cascade='all, delete-orphan',
+                                     lazy='joined')
+
+    __table_args__ = (
+        # The galleries, newest first, and the page of a picture in them
+        db.Index('ix_profile_picture_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_profile_picture_user_id_timestamp_id',
+                 'user_id', 'timestamp', 'id'),
+    )
+
     def __str__(self):
         return f"{self.user_id}: {self.filename}"
 
     def __repr__(self):
         return f"ProfilePicture {self.filename} {self.user_id}"
+
+    @property
+    def is_processing(self):
+        """Whether the picture is still waiting to be processed, see
+        flasquelistan/imageprocessing.py."""
+        return self.processing_job is not None and \
+            not self.processing_job.failed
+
+    def thumbnail(self, width):
+        """Return the filename of the thumbnail of width, or None if there
+        is none."""
+        for thumbnail in self.thumbnails:
+            if thumbnail.width == width:
+                return thumbnail.filename
+        return None
+
+
+class ProfilePictureThumbnail(db.Model):
+    """A smaller copy of a profile picture, see flasquelistan/thumbnails.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    profile_picture_id = db.Column(db.Integer,
+                                   db.ForeignKey('profile_picture.id'),
+                                   nullable=False, index=True)
+    width = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(256), nullable=False)
+
+
+class ImageProcessingJob(db.Model):
+    """A profile picture waiting to be processed, or that could not be, see
+    flasquelistan/imageprocessing.py."""
+    profile_picture_id = db.Column(db.Integer,
+                                   db.ForeignKey('profile_picture.id'),
+                                   primary_key=True)
+    failed = db.Column(db.Boolean, nullable=False, default=False)
+    timestamp = db.Column(db.DateTime, nullable=False,
+                          default=datetime.datetime.utcnow)
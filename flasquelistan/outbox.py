@@ -0,0 +1,178 @@
+"""Emit SocketIO events in the background.
+
+Building an event can take queries of its own (the BAC emoji of a balance
+change, the text of a notification), and emitting it sends it to every
+connected client, or to the message queue. Instead of doing that before
+responding, util.emit_* put a small event in the app's outbox, and a
+background task builds and emits the events.
+
+The event payload is built in a fresh app context with a request context for
+the URL of the original request, so that url_for(_external=True) works. The
+database is read when the payload is built, after the write path has
+committed, so anything that must reflect the moment of the write (like the
+new balance) has to be part of the event itself.
+
+Events are emitted in batches: the events of a `with batched():` block, and
+whatever else is in the outbox when the background task gets to it, after
+waiting EVENT_BATCH_WINDOW seconds for more. Events with the same name and
+merge key in a batch are merged into one. A room that gets more than one
+event of a batch gets them as a single 'batch' event, see the format in
+views/api.py.
+
+With EMIT_EVENTS_IN_BACKGROUND set to False, events are emitted right away
+instead (still batched within `with batched():`), which is simpler to test.
+Events still in the outbox when the process exits are lost.
+"""
+import collections
+import contextlib
+
+import flask
+
+from flasquelistan import background
+from flasquelistan.factory import socketio
+
+# build(**args) returns the data to emit to the rooms in to, or None to emit
+# nothing. to=None emits to every client. A later event with the same name
+# and key (unless None) in a batch replaces an earlier one, with the args
+# merge(earlier.args, later.args).
+Event = collections.namedtuple(
+    'Event', ['name', 'build', 'args', 'to', 'base_url', 'key', 'merge'])
+
+
+class Outbox(background.BackgroundQueue):
+    def put(self, events):
+        """Emit a list of events together."""
+        if not self.app.config.get('EMIT_EVENTS_IN_BACKGROUND', True):
+            self.emit(events)
+            return
+
+        self.put_in_queue(events)
+
+    def get_items(self):
+        """Wait for a batch of events, then take whatever else comes within
+        EVENT_BATCH_WINDOW seconds too."""
+        empty = socketio.server.eio.get_queue_empty_exception()
+        batches = [self.queue.get()]
+
+        window = self.app.config.get('EVENT_BATCH_WINDOW')
+        if window:
+            socketio.sleep(window)
+        while True:
+            try:
+                batches.append(self.queue.get_nowait())
+            except empty:
+                return batches
+
+    def work(self, batches):
+        self.emit([event for batch in batches for event in batch])
+
+    def work_failed(self, batches):
+        self.app.logger.exception("Could not emit events")
+
+    def emit(self, events):
+        events = merge_events(events)
+
+        with self.app_context():
+            built = []
+            for event in events:
+                try:
+                    with self.app.test_request_context(
+                            base_url=event.base_url):
+                        data = event.build(**event.args)
+                except Exception:
+                    # The change has been committed already, so do not fail
+                    # the request or the rest of the batch
+                    self.app.logger.exception(
+                        "Could not emit %s event", event.name)
+                    continue
+
+                if data is not None:
+                    built.append((event, data))
+
+        if not built:
+            return
+        if len(built) == 1:
+            event, data = built[0]
+            socketio.emit(event.name, data, to=event.to)
+            return
+
+        # Room -> list of (event name, data), in order
+        rooms = collections.defaultdict(list)
+        for event, data in built:
+            if event.to is None:
+                socketio.emit(event.name, data)
+                continue
+            to = [event.to] if isinstance(event.to, str) else event.to
+            for room in to:
+                rooms[room].append((event.name, data))
+
+        for room, room_events in rooms.items():
+            if len(room_events) == 1:
+                name, data = room_events[0]
+                socketio.emit(name, data, to=room)
+            else:
+                socketio.emit('batch', {
+                    'events': [{'event': name, 'data': data}
+                               for name, data in room_events],
+                }, to=room)
+
+
+def merge_events(events):
+    """Merge events with the same name and key, keeping the place of the
+    first."""
+    merged = {}
+    for event in events:
+        if event.key is None:
+            merged[object()] = event
+            continue
+
+        key = (event.name, event.key)
+        earlier = merged.get(key)
+        if earlier is not None:
+            event = event._replace(args=event.merge(earlier.args, event.args))
+        merged[key] = event
+
+    return list(merged.values())
+
+
+def put(name, build, to=None, key=None, merge=None, **args):
+    """Put an event in the current app's outbox. build(**args) is called
+    later to get the data to emit, so args should be plain values like ids,
+    not model instances. to is a room or list of rooms to emit to."""
+    if flask.has_request_context():
+        base_url = flask.request.url_root
+    else:
+        base_url = None
+
+    event = Event(name, build, args, to, base_url, key, merge)
+
+    batch = flask.g.get('event_batch')
+    if batch is not None:
+        batch.append(event)
+    else:
+        flask.current_app.extensions['event_outbox'].put([event])
+
+
+@contextlib.contextmanager
+def batched():
+    """Emit all events put within the block together when it ends.
+
+    Nested blocks are part of the outermost one. The events are emitted even
+    if the block raises, since events are only put after their changes have
+    been committed.
+    """
+    if flask.g.get('event_batch') is not None:
+        yield
+        return
+
+    flask.g.event_batch = events = []
+    try:
+        yield
+    finally:
+        flask.g.event_batch = None
+        if events:
+            flask.current_app.extensions['event_outbox'].put(events)
+
+
+def setup_outbox(app):
+    app.extensions['event_outbox'] = Outbox(app)
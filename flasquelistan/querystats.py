@@ -0,0 +1,137 @@
+"""Count and time the SQL statements run while handling each request.
+
+Every request gets a QueryStats in flask.g, filled in by SQLAlchemy engine
+events. When the response goes out, the totals are logged at debug level,
+and added as a Server-Timing header (visible in the browser's developer
+tools) in debug mode, for admins, or for everyone with SERVER_TIMING_HEADER.
+If QUERY_COUNT_THRESHOLD is set, requests running more statements than that
+are logged as warnings, to find views that query once per row.
+"""
+import heapq
+import time
+
+import flask
+import flask_login
+import sqlalchemy as sqla
+
+# Number of slowest statements kept per request
+SLOWEST_COUNT = 3
+
+# Statements are cut to this length in log lines
+STATEMENT_LOG_LENGTH = 200
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0  # Seconds
+        # Min-heap of (duration, statement), the slowest SLOWEST_COUNT
+        self._slowest = []
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+
+        if len(self._slowest) < SLOWEST_COUNT:
+            heapq.heappush(self._slowest, (duration, statement))
+        else:
+            heapq.heappushpop(self._slowest, (duration, statement))
+
+    @property
+    def slowest(self):
+        """List of (duration, statement), slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+    @property
+    def server_timing(self):
+        return 'db;dur={:.1f};desc="{} queries"'.format(
+            self.total_time * 1000, self.count)
+
+    def __str__(self):
+        text = "{} queries in {:.1f} ms".format(
+            self.count, self.total_time * 1000)
+        for duration, statement in self.slowest:
+            text += "\n  {:.1f} ms: {}".format(
+                duration * 1000,
+                ' '.join(statement.split())[:STATEMENT_LOG_LENGTH]
+            )
+        return text
+
+
+def current_stats():
+    """Return the QueryStats of the current request, or None outside of
+    requests."""
+    if not flask.has_request_context():
+        return None
+    return flask.g.get('query_stats')
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = conn.info['query_start_time'].pop()
+    stats = current_stats()
+    if stats is not None:
+        stats.record(statement, time.perf_counter() - start)
+
+
+def handle_error(exception_context):
+    # after_cursor_execute is not run for failed statements
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start_time'):
+        conn.info['query_start_time'].pop()
+
+
+def reset_query_stats():
+    # flask.g may outlive a request (see setup_flask_babel in factory.py)
+    flask.g.query_stats = QueryStats()
+
+
+def show_server_timing(app):
+    """Whether to add the Server-Timing header, which tells how much work a
+    request was, to the response."""
+    if app.debug or app.config.get('SERVER_TIMING_HEADER'):
+        return True
+    user = flask_login.current_user
+    return user.is_authenticated and user.is_admin
+
+
+def report_query_stats(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+
+    app = flask.current_app
+
+    if show_server_timing(app):
+        response.headers.add('Server-Timing', stats.server_timing)
+
+    if stats.count:
+        app.logger.debug("%s", stats)
+
+    threshold = app.config.get('QUERY_COUNT_THRESHOLD')
+    if threshold is not None and stats.count > threshold:
+        app.logger.warning(
+            "View %s ran %d queries, more than %d",
+            flask.request.endpoint, stats.count, threshold
+        )
+
+    return response
+
+
+def setup_query_stats(app):
+    from flasquelistan import models
+
+    with app.app_context():
+        engine = models.db.engine
+
+    sqla.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    sqla.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    sqla.event.listen(engine, 'handle_error', handle_error)
+
+    app.before_request(reset_query_stats)
+    app.after_request(report_query_stats)
@@ -0,0 +1,172 @@
+"""Time the busiest views with the Flask test client.
+
+Meant to be run against a database filled by syntheticdata.populate. Every
+view is requested a number of times as the first admin user, and the
+median and 95th percentile response times are reported together with the
+number of SQL queries per request. Note that /strequa adds streques, so do
+not run this against a database you care about.
+
+With --bac, the ways of computing the BAC of every user are timed instead,
+as if no user had a persisted alcohol state: replaying the streques of one
+user at a time, replaying them from one query, and User.bac_for_users.
+"""
+import datetime
+import itertools
+import statistics
+import time
+
+import click
+import flask
+import sqlalchemy as sqla
+
+from flasquelistan import alcohol, models
+from flasquelistan.models.user import alcoholic_streques_query
+
+
+def percentile(samples, percent):
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method='inclusive')[percent - 1]
+
+
+def benchmark_view(client, name, request, rounds):
+    """Run request(client) rounds times. Return a row for the report."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = models.db.engine
+    times = []
+    queries = []
+    sqla.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        for _ in range(rounds):
+            statements.clear()
+            start = time.perf_counter()
+            response = request(client)
+            times.append(time.perf_counter() - start)
+            queries.append(len(statements))
+
+            if response.status_code >= 400:
+                raise click.ClickException(
+                    f"{name} responded with {response.status}")
+    finally:
+        sqla.event.remove(engine, 'before_cursor_execute',
+                          before_cursor_execute)
+
+    return (name,
+            percentile(times, 50) * 1000,
+            percentile(times, 95) * 1000,
+            max(queries))
+
+
+def run(rounds=20):
+    app = flask.current_app
+    # The benchmark posts forms without tokens
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    admin = (models.User.query
+             .filter_by(is_admin=True)
+             .order_by(models.User.id)
+             .first())
+    if admin is None:
+        raise click.ClickException(
+            "No admin user, run populatesyntheticdb first.")
+
+    api_key = models.ApiKey.query.filter_by(name='benchmark').first()
+    key = models.ApiKey.generate_key()
+    if api_key is None:
+        api_key = models.ApiKey(name='benchmark', user_id=admin.id,
+                                has_admin_privileges=True)
+        models.db.session.add(api_key)
+    api_key.api_key = key
+    models.db.session.commit()
+
+    article = models.Article.query.filter_by(is_active=True).first()
+
+    views = [
+        ("strequelistan.index",
+         lambda c: c.get('/')),
+        ("/strequa",
+         lambda c: c.post('/strequa', data={'user_id': admin.id,
+                                            'article_id': article.id})),
+        ("/api/v1/transactions?limit=100",
+         lambda c: c.get('/api/v1/transactions?limit=100',
+                         headers={'Authorization': f'Bearer {key}'})),
+        ("/admin/stats",
+         lambda c: c.get('/admin/stats')),
+        ("/profile/<id>/history",
+         lambda c: c.get(f'/profile/{admin.id}/history')),
+    ]
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin.id)
+        session['_fresh'] = True
+
+    click.echo(f"{'view':<32} {'p50 (ms)':>10} {'p95 (ms)':>10} "
+               f"{'queries':>8}")
+    for name, request in views:
+        row = benchmark_view(client, name, request, rounds)
+        click.echo("{:<32} {:>10.1f} {:>10.1f} {:>8}".format(*row))
+
+
+def time_rounds(func, rounds):
+    """Call func rounds times. Return a row for the report."""
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return percentile(times, 50) * 1000, percentile(times, 95) * 1000
+
+
+def replay_per_user(users, now):
+    return {user.id: user.bac_from_alcohol(*user.replay_streques(), now=now)
+            for user in users}
+
+
+def replay_one_query(users, now):
+    streques = (alcoholic_streques_query(now)
+                .order_by(models.Streque.user_id, models.Streque.timestamp)
+                .all())
+    in_body = {
+        user_id: alcohol.replay_alcohol((timestamp, standardglas)
+                                        for _, timestamp, standardglas in rows)
+        for user_id, rows in itertools.groupby(streques, lambda row: row[0])
+    }
+    return {user.id: user.bac_from_alcohol(*in_body.get(user.id, (0, None)),
+                                           now=now)
+            for user in users}
+
+
+def run_bac(rounds=20):
+    now = datetime.datetime.utcnow()
+    streque_count = alcoholic_streques_query(now).count()
+    if not streque_count:
+        raise click.ClickException(
+            "No alcoholic streques within the BAC window, run "
+            "populatesyntheticdb first.")
+
+    # Forget the persisted alcohol states, rolled back below
+    models.BacState.query.delete()
+    users = models.User.query.all()
+    try:
+        expected = replay_per_user(users, now)
+        methods = [
+            ("replay per user", replay_per_user),
+            ("replay from one query", replay_one_query),
+            ("User.bac_for_users", models.User.bac_for_users),
+        ]
+
+        click.echo(f"{len(users)} users, {streque_count} alcoholic streques")
+        click.echo(f"{'method':<32} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+        for name, method in methods:
+            if method(users, now) != expected:
+                raise click.ClickException(f"{name} gives other BACs")
+            row = time_rounds(lambda: method(users, now), rounds)
+            click.echo("{:<32} {:>10.1f} {:>10.1f}".format(name, *row))
+    finally:
+        models.db.session.rollback()
@@ -0,0 +1,184 @@
+"""Fill the database with a large amount of generated data.
+
+testdata.populate adds a handful of hand-written users, which is nice to
+click around with but far too little to notice slow views. This adds
+hundreds of users with years of transactions, for benchmarking (see
+benchmark.py). Rows are inserted in bulk with Core inserts instead of the
+ORM, which would take far too long for a million transactions.
+"""
+import datetime
+import random
+
+import click
+import sqlalchemy as sqla
+
+from flasquelistan import models
+
+CHUNK_SIZE = 10000
+
+FIRST_NAMES = ['Anna', 'Erik', 'Maria', 'Lars', 'Karin', 'Johan', 'Sara',
+               'Anders', 'Emma', 'Per', 'Elin', 'Nils', 'Lina', 'Olof']
+LAST_NAMES = ['Andersson', 'Johansson', 'Karlsson', 'Nilsson', 'Eriksson',
+              'Larsson', 'Olsson', 'Persson', 'Svensson', 'Gustafsson']
+WORDS = ['sjung', 'kör', 'stämma', 'ton', 'takt', 'fika', 'sexa', 'öl',
+         'sång', 'visa', 'bas', 'tenor', 'alt', 'sopran', 'dirigent']
+
+# Spread transactions over this long back in time
+TIME_SPAN = datetime.timedelta(days=3 * 365)
+
+
+def insert_chunked(table, rows):
+    """Insert an iterable of row dicts, CHUNK_SIZE rows per statement."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            models.db.session.execute(sqla.insert(table), chunk)
+            chunk = []
+    if chunk:
+        models.db.session.execute(sqla.insert(table), chunk)
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def populate(users=500, transactions=1000000, notifications=50000,
+             quotes=10000, profile_pictures=20000, seed=0):
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+
+    def timestamp():
+        # Evenly spread out, so some are recent enough to count towards the
+        # BAC, about as many per week as a busy term
+        return now - TIME_SPAN * rng.random()
+
+    groups = [models.Group(name=name, weight=weight, active=True)
+              for name, weight in [('Sopran', 40), ('Alt', 30),
+                                   ('Tenor', 20), ('Bas', 10)]]
+    groups.append(models.Group(name='Gamlingar', weight=0))
+    articles = [
+        models.Article(name='Öl', value=1600, weight=50, standardglas=1),
+        models.Article(name='Cider', value=1500, weight=40, standardglas=1),
+        models.Article(name='Vin', value=1400, weight=30, standardglas=1),
+        models.Article(name='4 cl', value=1300, weight=20, standardglas=1),
+        models.Article(name='Alkfritt', value=1200, weight=10,
+                       standardglas=0),
+    ]
+    models.db.session.add_all(groups + articles)
+    models.db.session.flush()
+
+    # Continue after any existing users, so this can be run more than once
+    first = (models.db.session.query(sqla.func.max(models.User.id)).scalar()
+             or 0) + 1
+    user_ids = list(range(first, first + users))
+
+    click.echo(f"Adding {users} users...")
+    insert_chunked(models.User.__table__, (
+        {
+            'id': user_id,
+            'email': f'user{user_id}@example.com',
+            'first_name': rng.choice(FIRST_NAMES),
+            'last_name': rng.choice(LAST_NAMES),
+            'nickname': sentence(rng, 2) if rng.random() < 0.5 else None,
+            'birthday': datetime.date(rng.randint(1950, 2005),
+                                      rng.randint(1, 12), rng.randint(1, 28)),
+            'phone': '+4670{:07d}'.format(user_id),
+            'balance': 0,
+            'is_admin': user_id == first,
+            'active': rng.random() < 0.6,
+            'group_id': rng.choice(groups).id,
+            'body_mass': rng.choice([None, 55, 70, 90]),
+            'y_chromosome': rng.choice([None, True, False]),
+        }
+        for user_id in user_ids
+    ))
+
+    click.echo(f"Adding {transactions} transactions...")
+    streque_articles = [(article.value, article.standardglas)
+                        for article in articles]
+
+    def transaction(user_id):
+        kind = rng.random()
+        row = {
+            'user_id': user_id,
+            'created_by_id': user_id,
+            'timestamp': timestamp(),
+            'voided': rng.random() < 0.02,
+            'standardglas': None,
+        }
+        if kind < 0.85:
+            value, standardglas = rng.choice(streque_articles)
+            row.update(type='streque', value=-value, text='Streque',
+                       standardglas=standardglas)
+        elif kind < 0.95:
+            row.update(type='admin_transaction',
+                       value=rng.choice([10000, 20000, 50000]),
+                       text='Insättning')
+        else:
+            row.update(type='user_transaction',
+                       value=rng.choice([-1, 1]) * rng.randint(100, 10000),
+                       text=sentence(rng, 3))
+        return row
+
+    insert_chunked(models.Transaction.__table__, (
+        transaction(rng.choice(user_ids)) for _ in range(transactions)
+    ))
+
+    click.echo(f"Adding {notifications} notifications...")
+    insert_chunked(models.Notification.__table__, (
+        {
+            'text': sentence(rng, 6),
+            'user_id': rng.choice(user_ids),
+            'is_sent': True,
+            'is_acknowledged': rng.random() < 0.9,
+            'timestamp': timestamp(),
+        }
+        for _ in range(notifications)
+    ))
+
+    click.echo(f"Adding {quotes} quotes...")
+    insert_chunked(models.Quote.__table__, (
+        {
+            'text': sentence(rng, rng.randint(3, 15)),
+            'who': sentence(rng, 2) if rng.random() < 0.8 else None,
+            'timestamp': timestamp(),
+        }
+        for _ in range(quotes)
+    ))
+
+    click.echo(f"Adding {profile_pictures} profile pictures...")
+    insert_chunked(models.ProfilePicture.__table__, (
+        {
+            'filename': f'synthetic{i}.jpg',
+            'user_id': rng.choice(user_ids),
+            'timestamp': timestamp(),
+        }
+        for i in range(profile_pictures)
+    ))
+
+    click.echo("Updating balances and profile pictures...")
+    user_table = models.User.__table__
+    transaction_table = models.Transaction.__table__
+    picture_table = models.ProfilePicture.__table__
+    models.db.session.execute(
+        sqla.update(user_table)
+        .where(user_table.c.id.between(user_ids[0], user_ids[-1]))
+        .values(
+            balance=sqla.select(
+                sqla.func.coalesce(sqla.func.sum(transaction_table.c.value), 0)
+            ).where(
+                transaction_table.c.user_id == user_table.c.id,
+                transaction_table.c.voided.is_(False)
+            ).scalar_subquery(),
+            # The latest picture, if any
+            profile_picture_id=sqla.select(
+                sqla.func.max(picture_table.c.id)
+            ).where(
+                picture_table.c.user_id == user_table.c.id
+            ).scalar_subquery(),
+        )
+    )
+
+    models.db.session.commit()
+    click.echo("Done.")
@@ -0,0 +1,117 @@
+"""Smaller copies of uploaded profile pictures.
+
+Pages show profile pictures at the widths in THUMBNAIL_WIDTHS (see
+macros.html). Instead of nginx resizing the full picture for every request,
+copies of those widths are saved in THUMBNAIL_FORMAT in a directory next to
+the pictures when they are uploaded, and recorded as
+ProfilePictureThumbnail rows. util.url_for_profile_picture links to them,
+and to the nginx resized picture for pictures without thumbnails, like
+animated ones. `flask makethumbnails` makes thumbnails for pictures
+uploaded before.
+"""
+import os
+
+import flask
+from PIL import Image, ImageOps
+
+from flasquelistan import models, util
+
+THUMBNAIL_DIR = 'thumbnails'
+
+# Format -> (Pillow format, extension, modes it can save)
+FORMATS = {
+    'webp': ('WEBP', 'webp', ('RGB', 'RGBA')),
+    'jpeg': ('JPEG', 'jpg', ('RGB', 'L')),
+}
+
+# What Pillow raises for pictures it cannot or will not read. Pictures larger
+# than Image.MAX_IMAGE_PIXELS raise DecompressionBombError, which is not an
+# OSError.
+IMAGE_ERRORS = (OSError, Image.DecompressionBombError)
+
+
+def thumbnail_settings(config):
+    """Return the THUMBNAIL_* settings of config, for save_thumbnails."""
+    return {
+        'widths': config['THUMBNAIL_WIDTHS'],
+        'format': config['THUMBNAIL_FORMAT'],
+        'quality': config['THUMBNAIL_QUALITY'],
+    }
+
+
+def save_thumbnails(directory, filename, settings):
+    """Save thumbnails of the picture filename in directory. Return a list
+    of (width, thumbnail filename), empty for animated pictures. Raises one
+    of IMAGE_ERRORS if the picture cannot be read.
+
+    The thumbnails are named after the whole filename, extension included,
+    since a.jpg and a.png can both be uploaded.
+
+    Needs no app context, so that it can run in a thread of its own.
+    """
+    pil_format, extension, modes = FORMATS[settings['format']]
+    with Image.open(os.path.join(directory, filename)) as img:
+        if getattr(img, 'is_animated', False):
+            return []
+
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in modes:
+            img = img.convert('RGBA' if 'RGBA' in modes and
+                              img.has_transparency_data else 'RGB')
+
+        os.makedirs(os.path.join(directory, THUMBNAIL_DIR), exist_ok=True)
+
+        thumbnails = []
+        for width in settings['widths']:
+            thumbnail_filename = (
+                f'{THUMBNAIL_DIR}/{filename}.{width}.{extension}')
+
+            thumbnail = img.copy()
+            # Keeps the aspect ratio, and never makes the picture larger
+            thumbnail.thumbnail((width, img.height))
+            thumbnail.save(os.path.join(directory, thumbnail_filename),
+                           format=pil_format, quality=settings['quality'])
+
+            thumbnails.append((width, thumbnail_filename))
+
+    return thumbnails
+
+
+def make_thumbnails(profile_picture):
+    """Save thumbnails of profile_picture and add them to it, not
+    committed. Return the thumbnails, none for animated pictures. Raises
+    one of IMAGE_ERRORS if the picture cannot be read."""
+    thumbnails = [
+        models.ProfilePictureThumbnail(width=width, filename=filename)
+        for width, filename in save_thumbnails(
+            util.profile_pictures.config.destination,
+            profile_picture.filename,
+            thumbnail_settings(flask.current_app.config))
+    ]
+    profile_picture.thumbnails.extend(thumbnails)
+    return thumbnails
+
+
+def make_missing_thumbnails():
+    """Make thumbnails for every picture without any, except those still
+    waiting to be processed, which get theirs then. Return the number of
+    pictures done and failed."""
+    pending = models.ProfilePicture.processing_job.has(
+        models.ImageProcessingJob.failed.is_(False))
+    pictures = (models.ProfilePicture.query
+                .filter(~models.ProfilePicture.thumbnails.any(), ~pending)
+                .order_by(models.ProfilePicture.id)
+                .all())
+
+    done = failed = 0
+    for picture in pictures:
+        try:
+            if make_thumbnails(picture):
+                done += 1
+        except IMAGE_ERRORS:
+            flask.current_app.logger.exception(
+                "Could not make thumbnails of %s", picture.filename)
+            failed += 1
+        models.db.session.commit()
+
+    return done, failed
@@ -1,17 +1,16 @@
 import base64
+import collections
 import datetime
 import email
 import hashlib
-import smtplib
-import ssl
-import threading
+import time
 from urllib.parse import urljoin, urlparse
 
 import flask
 import flask_uploads
 import phonenumbers
-from PIL import Image, ImageOps
-from flasquelistan.factory import socketio
+import sqlalchemy as sqla
+from flasquelistan import outbox
 
 image_uploads = flask_uploads.UploadSet('images',
                                         flask_uploads.IMAGES)
@@ -19,6 +18,12 @@ image_uploads = flask_uploads.UploadSet('images',
 profile_pictures = flask_uploads.UploadSet('profilepictures',
                                            flask_uploads.IMAGES)
 
+# Signed image URLs, keyed by everything that goes into them, see
+# url_for_image. The least recently used are dropped when there are more
+# than IMAGE_URL_CACHE_SIZE.
+image_url_cache = collections.OrderedDict()
+IMAGE_URL_CACHE_SIZE = 10000
+
 
 def generate_secure_path_hash(expires, url, secret):
     data = f"{expires}{url}{flask.request.remote_addr} {secret}"
@@ -27,7 +32,27 @@ def generate_secure_path_hash(expires, url, secret):
     return nginx_hash
 
 
+def image_url_window():
+    """Return the number of the current IMAGE_URL_WINDOW. Image URLs stay the
+    same within a window."""
+    return int(time.time() // flask.current_app.config['IMAGE_URL_WINDOW'])
+
+
 def url_for_image(filename, imagetype, width=None):
+    """Return a signed URL for an uploaded image, valid for at least
+    IMAGE_EXPIRY seconds.
+
+    The expiry is counted from the end of the current IMAGE_URL_WINDOW, so
+    that the URL, and the image cached by the browser, stays the same for
+    the whole window instead of changing every second.
+    """
+    window = image_url_window()
+    key = (filename, imagetype, width, window, flask.request.remote_addr)
+    url = image_url_cache.get(key)
+    if url is not None:
+        image_url_cache.move_to_end(key)
+        return url
+
     if imagetype == 'profilepicture':
         url = profile_pictures.config.base_url
     elif imagetype == 'image':
@@ -40,27 +65,44 @@ def url_for_image(filename, imagetype, width=None):
 
     url = urljoin(url, filename)
 
-    secret = flask.current_app.config['IMAGE_SECRET']
-    expiry = flask.current_app.config['IMAGE_EXPIRY']
-    expires = int(datetime.datetime.now().timestamp() + expiry)
-    md5 = generate_secure_path_hash(expires, url, secret)
+    config = flask.current_app.config
+    expires = (window + 1) * config['IMAGE_URL_WINDOW'] + config['IMAGE_EXPIRY']
+    md5 = generate_secure_path_hash(expires, url, config['IMAGE_SECRET'])
+    url = f"{url}?md5={md5}&expires={expires}"
 
-    return f"{url}?md5={md5}&expires={expires}"
+    image_url_cache[key] = url
+    if len(image_url_cache) > IMAGE_URL_CACHE_SIZE:
+        image_url_cache.popitem(last=False)
 
+    return url
+
+
+def url_for_profile_picture(picture, width=None):
+    """Return a URL for picture, for its thumbnail of width if it has one
+    and otherwise for the picture resized by nginx."""
+    filename = picture.thumbnail(width) if width else None
+    if filename:
+        return url_for_image(filename, 'profilepicture')
+    return url_for_image(picture.filename, 'profilepicture', width)
 
-def send_email(fromaddr, toaddr, subject, body):
-    """Send an email with SMTP & STARTTLS.
 
-    Uses the best security defaults according to the python documentation at
-    the time of writing:
-    https://docs.python.org/3/library/ssl.html#ssl-security
+def between_dates(column, from_date, to_date):
+    """Return a filter for a timestamp column being on any day from
+    from_date up to and including to_date.
 
-    "[ssl.create_default_context()] will load the system’s trusted CA
-    certificates, enable certificate validation and hostname checking, and try
-    to choose reasonably secure protocol and cipher settings."
+    Compares the column to the half-open range [from_date, to_date + 1 day)
+    instead of converting every timestamp to a date, which would keep the
+    database from using an index on the column.
     """
-    config = flask.current_app.config
+    start = datetime.datetime.combine(from_date, datetime.time())
+    end = datetime.datetime.combine(to_date + datetime.timedelta(days=1),
+                                    datetime.time())
+    return sqla.and_(column >= start, column < end)
+
 
+def send_email(fromaddr, toaddr, subject, body):
+    """Queue an email to be sent in the background, see
+    flasquelistan/mail.py."""
     msg = email.message.EmailMessage()
     msg.set_content(body)
 
@@ -69,36 +111,7 @@ def send_email(fromaddr, toaddr, subject, body):
     msg['To'] = toaddr
     msg['Date'] = email.utils.formatdate(localtime=True)
 
-    @flask.copy_current_request_context
-    def thread_func():
-        if flask.current_app.debug:
-            print("\n===== DEBUG: Did not send the "
-                  "following email message: =====\n")
-            print(msg)
-            print("===== DEBUG: Content is: =====\n")
-            print(msg.get_content())
-            print("===== END DEBUG =====\n")
-            return
-
-        with smtplib.SMTP(config['SMTP_MAILSERVER'],
-                          port=config['SMTP_PORT']
-                          ) as smtp:
-
-            if config.get('SMTP_USE_STARTTLS'):
-                context = ssl.create_default_context()
-                smtp.starttls(context=context)
-
-            username = config.get('SMTP_USERNAME')
-            password = config.get('SMTP_PASSWORD')
-            if username and password:
-                smtp.login(username, password)
-
-            smtp.send_message(msg)
-
-    thread = threading.Thread(target=thread_func)
-
-    with flask.current_app.app_context():
-        thread.start()
+    flask.current_app.extensions['mailer'].put(msg)
 
 
 def is_safe_url(target):
@@ -129,13 +142,6 @@ def get_redirect_target():
             return target
 
 
-def rotate_jpeg(filename):
-    img = Image.open(filename)
-    if 'exif' in img.info:
-        rotated = ImageOps.exif_transpose(img)
-        rotated.save(filename, exif=rotated.info.get('exif'))
-
-
 def format_phone_number(phone, e164=False):
     """Returns formatted number or False if not a valid number."""
     try:
@@ -157,21 +163,80 @@ def format_phone_number(phone, e164=False):
     return formatted
 
 
+# SocketIO clients subscribe to events by joining rooms, see api.connect.
+# Every event type has a room per user, for the events concerning that user,
+# and a room for the events of all users.
+EVENT_TYPES = ('balance_change', 'notification')
+
+
+def event_room(event, user_id=None):
+    """Return the SocketIO room for event concerning user_id, or concerning
+    all users if user_id is None."""
+    if user_id is None:
+        return f'{event}:all'
+    return f'{event}:user:{user_id}'
+
+
+def event_rooms(event, user_id):
+    """Return the rooms to emit event concerning user_id to."""
+    return [event_room(event, user_id), event_room(event)]
+
+
+def batched_events():
+    """Context manager emitting the events of the block together, see
+    outbox.batched."""
+    return outbox.batched()
+
+
 def emit_balance_change_event(user, old_balance):
-    socketio.emit('balance_change', {
+    """Emit a balance_change event in the background, see outbox.py.
+
+    Balance changes of the same user in a batch are merged into one, from
+    the first old balance to the last new balance.
+    """
+    outbox.put('balance_change', balance_change_data,
+               to=event_rooms('balance_change', user.id),
+               key=user.id, merge=merge_balance_changes, user_id=user.id,
+               old_balance=old_balance, new_balance=user.balance)
+
+
+def merge_balance_changes(earlier, later):
+    return {**later, 'old_balance': earlier['old_balance']}
+
+
+def balance_change_data(user_id, old_balance, new_balance):
+    from flasquelistan import models
+    user = models.db.session.get(models.User, user_id)
+    if user is None:
+        return None
+
+    return {
         'user_id': user.id,
         'discord_user_id': user.discord_user_id,
         'old_balance': old_balance,
-        'new_balance': user.balance,
+        'new_balance': new_balance,
         'new_emoji': user.bac_emoji,
-    })
+    }
 
 
 def emit_notification_event(notification):
+    """Emit a notification event in the background, see outbox.py."""
+    outbox.put('notification', notification_data,
+               to=event_rooms('notification', notification.user_id),
+               notification_id=notification.id)
+
+
+def notification_data(notification_id):
+    from flasquelistan import models
+    notification = models.db.session.get(models.Notification, notification_id)
+    if notification is None:
+        # Removed before it was emitted
+        return None
+
     user = notification.user
-    socketio.emit('notification', {
+    return {
         'notification_id': notification.id,
         'user_id': user.id,
         'discord_user_id': user.discord_user_id,
         'text': notification.formatted_markdown
-    })
+    }
@@ -1,4 +1,5 @@
 import datetime
+import queue
 
 import flask
 import flask_babel
@@ -57,8 +58,7 @@ def transactions():
     form.end.data = to_date
 
     transactions = models.Transaction.query.filter(
-        sqla.func.DATE(models.Transaction.timestamp) >= from_date,
-        sqla.func.DATE(models.Transaction.timestamp) <= to_date,
+        util.between_dates(models.Transaction.timestamp, from_date, to_date),
         sqla.or_(
             # Only include UserTransaction if positive, which means the
             # transaction of the payee. Include 0 too if that somehow
@@ -114,8 +114,7 @@ def streque_stats():
             sqla.func.count(models.Streque.user_id).label('count')
         )
         .filter(
-            sqla.func.DATE(models.Streque.timestamp) >= from_date,
-            sqla.func.DATE(models.Streque.timestamp) <= to_date,
+            util.between_dates(models.Streque.timestamp, from_date, to_date),
             models.Streque.voided.is_(False)
         )
         .group_by(
@@ -238,24 +237,35 @@ def confirm_bulk_transactions():
         if not name.startswith('user'):
             continue
 
-        user_id, field = name.split('-')[1:]
-
-        transactions.setdefault(user_id, {})
-        if field == 'value':
-            transactions[user_id][field] = int(value)
-        elif field == 'text':
-            transactions[user_id][field] = value
-        else:
+        # user-<user id>-<field>
+        try:
+            _, user_id, field = name.split('-')
+            user_id = int(user_id)
+            if field == 'value':
+                value = int(value)
+            elif field != 'text':
+                raise ValueError(field)
+        except ValueError:
             flask.abort(400)
 
-    for user_id, transaction_data in transactions.items():
-        user = models.db.session.get(models.User, user_id)
-        transaction = user.admin_transaction(
-            transaction_data['value'],
-            transaction_data['text'],
-            by_user=current_user
-        )
-        transaction.create_notification()
+        transactions.setdefault(user_id, {})[field] = value
+
+    if any(data.keys() != {'value', 'text'}
+           for data in transactions.values()):
+        flask.abort(400)
+
+    users = {
+        user.id: user for user in
+        models.User.query.filter(models.User.id.in_(transactions.keys()))
+    }
+    if len(users) != len(transactions):
+        flask.abort(400)
+
+    models.User.bulk_admin_transactions(
+        [(users[user_id], data['value'], data['text'])
+         for user_id, data in transactions.items()],
+        by_user=current_user
+    )
 
     flask.flash(_l("Transaktionerna utfördes!"), 'success')
     return flask.redirect(flask.url_for('strequeadmin.bulk_transactions'))
@@ -332,17 +342,40 @@ def spam():
 
     if flask.request.method == 'POST':
         subject = "Hälsning från QM"
+        fromaddr = current_app.config['ADMIN_EMAILADDR']
+        sent = 0
+        skipped = []
         for user in users:
+            if skipped:
+                # The mail queue is full, waiting for room for every
+                # remaining user would only make this slower
+                skipped.append(user)
+                continue
+
             mail = flask.render_template(
                 'strequeadmin/negative_balance_mail.jinja2',
                 user=user
             )
-            fromaddr = current_app.config['ADMIN_EMAILADDR']
-            util.send_email(fromaddr, user.email, subject, mail)
-
-        flask.flash(_("Skickade %(nr)i saldopåminnelser!", nr=users.count()),
+            try:
+                util.send_email(fromaddr, user.email, subject, mail)
+            except queue.Full:
+                skipped.append(user)
+            else:
+                sent += 1
+
+        flask.flash(_("Skickade %(nr)i saldopåminnelser!", nr=sent),
                     'success')
 
+        if skipped:
+            current_app.logger.warning(
+                "Mail queue full, no balance reminder sent to %s",
+                ', '.join(user.email for user in skipped))
+            flask.flash(
+                _("E-postkön är full, inga saldopåminnelser skickades till "
+                  "%(users)s. Försök igen senare.",
+                  users=', '.join(user.full_name for user in skipped)),
+                'error')
+
     return flask.render_template('strequeadmin/spam.html', users=users)
 
 
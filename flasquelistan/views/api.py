@@ -13,14 +13,42 @@
 # To perform a simple test of the API, make a GET request to:
 #     <URL to flasquelistan>/api/v1/users/me
 #
+# Transaction listings are paginated. A response holds at most
+# MAX_PAGE_SIZE transactions (or ?limit=, if smaller). If there are more, the
+# response has a header
+#     Link: <URL of the next page>; rel="next"
+# The URL carries an opaque ?cursor= continuing where the page ended, so
+# transactions added meanwhile are neither skipped nor repeated. To get every
+# transaction in one response instead, add ?format=ndjson. The transactions
+# are then streamed as newline-delimited JSON, one object per line.
+#
 # The API also allows listening to new Notifications and balance changes
 # through a websocket, using SocketIO. Connect to "wss://<url to flasquelistan>/",
-# and make sure to provide {'token': 'your_api_key'} as auth.
+# and make sure to provide {'token': 'your_api_key'} as auth. Use the websocket
+# transport only, long-polling does not work when the server runs more than
+# one worker process.
+#
+# A client only receives the events concerning the owner of its API key. Admin
+# keys receive the events of all users. To only receive some types of events,
+# list them in the auth, for example
+#     {'token': 'your_api_key', 'events': ['notification']}
+# The event types are 'balance_change' and 'notification'.
+#
+# Events happening at about the same time, like the deposits of a bulk
+# transaction, are sent as a single 'batch' event, with the data
+#     {'events': [{'event': 'balance_change', 'data': <event data>}, ...]}
+# The events are in the order they happened, and each has the same data as
+# if it had been sent on its own. Balance changes of the same user in a batch
+# are merged into one, from the first old_balance to the last new_balance.
+
+import base64
+import binascii
+import json
 
 import flask
 from flask import jsonify, request
 from flask_httpauth import HTTPTokenAuth
-from flask_socketio import ConnectionRefusedError
+from flask_socketio import ConnectionRefusedError, join_room
 from sqlalchemy import desc, func
 
 from flasquelistan import models, util
@@ -41,13 +69,23 @@ def current_user(): return current_api_key().user
 # SocketIO authentication.
 @socketio.on('connect')
 def connect(auth):
-    if 'token' not in auth:
+    if not auth or 'token' not in auth:
         raise ConnectionRefusedError("invalid auth string")
 
     api_key = ApiKey.authenticate(auth['token'])
     if api_key is None:
         raise ConnectionRefusedError("unauthorized")
 
+    events = auth.get('events', util.EVENT_TYPES)
+    if (not isinstance(events, (list, tuple))
+            or not set(events) <= set(util.EVENT_TYPES)):
+        raise ConnectionRefusedError("invalid events")
+
+    # Admin keys get the events of all users, other keys only their own
+    user_id = None if api_key.is_admin else api_key.user_id
+    for event in events:
+        join_room(util.event_room(event, user_id))
+
 
 # REST authentication.
 @auth.verify_token
@@ -149,6 +187,58 @@ def add_streque(user_id, article_id):
     return user.strequa(article, current_user(), current_api_key()).api_dict
 
 
+# Most streques in one bulk request
+MAX_BULK_STREQUES = 100
+
+
+@mod.route('/streques/bulk', methods=['POST'])
+@auth.login_required
+def add_streques_bulk():
+    """Add several streques at once, e.g. a round for a whole table.
+
+    Takes a JSON list of {"user_id": ..., "article_id": ...} objects. The
+    streques are added in a single database transaction: if any user or
+    article does not exist, none are added. Return the added streques and
+    the new balance of every user involved.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, list) or not 0 < len(data) <= MAX_BULK_STREQUES:
+        return (f"400 Bad Request: expected a list of 1 to "
+                f"{MAX_BULK_STREQUES} streques.", 400) # HTTP 400 Bad Request
+
+    try:
+        pairs = [(item['user_id'], item['article_id']) for item in data]
+    except (KeyError, TypeError):
+        return "400 Bad Request: invalid streque.", 400 # HTTP 400 Bad Request
+
+    if not all(type(user_id) is int and type(article_id) is int
+               for user_id, article_id in pairs):
+        return "400 Bad Request: invalid streque.", 400 # HTTP 400 Bad Request
+
+    user_ids = {user_id for user_id, _ in pairs}
+    article_ids = {article_id for _, article_id in pairs}
+    users = {user.id: user for user in
+             User.query.filter(User.id.in_(user_ids))}
+    articles = {article.id: article for article in
+                Article.query.filter(Article.id.in_(article_ids))}
+
+    if users.keys() != user_ids or articles.keys() != article_ids:
+        flask.abort(404)  # HTTP 404 Not Found
+
+    streques, new_balances = User.bulk_strequa(
+        [(users[user_id], articles[article_id])
+         for user_id, article_id in pairs],
+        current_user(),
+        current_api_key()
+    )
+
+    return jsonify({
+        'streques': [streque.api_dict for streque in streques],
+        'balances': {user.id: balance
+                     for user, balance in new_balances.items()},
+    })
+
+
 @mod.route('/users/me/transactions', methods=['GET'])
 @auth.login_required
 def get_transactions_me():
@@ -180,6 +270,8 @@ def get_transactions_user(user_id):
     limit = request.args.get('limit', None)
     order = request.args.get('order', "asc")
     min_id = cast_integer_param(request.args.get('min_id', '0'))
+    cursor = request.args.get('cursor', None)
+    stream = request.args.get('format') == 'ndjson'
 
     if min_id is None:
         return "400 Bad Request: invalid min_id.", 400 # HTTP 400 Bad Request
@@ -189,7 +281,8 @@ def get_transactions_user(user_id):
         if limit is None:
             return "400 Bad Request: invalid limit.", 400 # HTTP 400 Bad Request
 
-    return query_transactions(user=user, min_id=min_id, limit=limit, order=order)
+    return query_transactions(user=user, min_id=min_id, limit=limit,
+                              order=order, cursor=cursor, stream=stream)
 
 
 @mod.route('/transactions', methods=['GET'])
@@ -201,6 +294,8 @@ def get_transactions():
     limit = request.args.get('limit', None)
     order = request.args.get('order', "asc")
     min_id = cast_integer_param(request.args.get('min_id', '0'))
+    cursor = request.args.get('cursor', None)
+    stream = request.args.get('format') == 'ndjson'
 
     if min_id is None:
         return "400 Bad Request: invalid min_id.", 400 # HTTP 400 Bad Request
@@ -210,24 +305,98 @@ def get_transactions():
         if limit is None:
             return "400 Bad Request: invalid limit.", 400 # HTTP 400 Bad Request
 
-    return query_transactions(min_id=min_id, limit=limit, order=order)
+    return query_transactions(min_id=min_id, limit=limit, order=order,
+                              cursor=cursor, stream=stream)
 
 
-def query_transactions(user=None, min_id=0, limit=None, order="asc"):
+# Most transactions returned in one response, see the top of this file
+MAX_PAGE_SIZE = 1000
+
+# Transactions loaded from the database at a time when streaming
+STREAM_BATCH_SIZE = 1000
+
+# Query arguments kept in the link to the next page
+NEXT_PAGE_ARGS = ('limit', 'min_id', 'format')
+
+
+def encode_cursor(last_id, order):
+    data = json.dumps({'after': last_id, 'order': order}).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (last_id, order) from a cursor, or None if it is invalid."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        last_id = data['after']
+        order = data['order']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None
+
+    if (not isinstance(last_id, int) or isinstance(last_id, bool)
+            or order not in ("asc", "desc")):
+        return None
+    return last_id, order
+
+
+def query_transactions(user=None, min_id=0, limit=None, order="asc",
+                       cursor=None, stream=False):
     q = Transaction.query
     if user is not None:
         q = q.filter(Transaction.user_id == user.id)
     if min_id > 0:
         q = q.filter(Transaction.id >= min_id)
+
+    if cursor is not None:
+        decoded = decode_cursor(cursor)
+        if decoded is None:
+            return "400 Bad Request: invalid cursor.", 400 # HTTP 400 Bad Request
+        last_id, order = decoded
+        if order == "desc":
+            q = q.filter(Transaction.id < last_id)
+        else:
+            q = q.filter(Transaction.id > last_id)
+
     if order == "desc":
         q = q.order_by(desc(Transaction.id))
     else:
         q = q.order_by(Transaction.id)
-    if limit is not None:
-        q = q.limit(limit)
-    transactions = q.all()
 
-    return jsonify([t.api_dict for t in transactions])
+    if stream:
+        if limit is not None:
+            q = q.limit(limit)
+        return flask.Response(
+            flask.stream_with_context(stream_transactions(q)),
+            mimetype='application/x-ndjson'
+        )
+
+    page_size = MAX_PAGE_SIZE if limit is None else min(limit, MAX_PAGE_SIZE)
+    # One more than fits on the page, to know whether there is a next page
+    transactions = q.limit(page_size + 1).all()
+    has_next_page = len(transactions) > page_size
+    transactions = transactions[:page_size]
+
+    response = jsonify([t.api_dict for t in transactions])
+
+    if has_next_page and transactions:
+        # Only the known arguments, any other could clash with the view's
+        # arguments or those of url_for. The order is in the cursor.
+        args = {name: request.args[name] for name in NEXT_PAGE_ARGS
+                if name in request.args}
+        args['cursor'] = encode_cursor(transactions[-1].id, order)
+        next_url = flask.url_for(request.endpoint,
+                                 **{**request.view_args, **args},
+                                 _external=True)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+
+    return response
+
+
+def stream_transactions(q):
+    """Yield the transactions of q as lines of JSON, loading only
+    STREAM_BATCH_SIZE of them into memory at a time."""
+    for transaction in q.yield_per(STREAM_BATCH_SIZE):
+        yield flask.json.dumps(transaction.api_dict) + '\n'
 
 
 @mod.route('/quotes', methods=['GET'])
@@ -1,5 +1,7 @@
 import flask
+import sqlalchemy as sqla
 from flask_login import login_required
+from sqlalchemy.orm import selectinload
 
 from flasquelistan import models
 
@@ -7,27 +9,35 @@ mod = flask.Blueprint('gallery', __name__)
 mod.before_request(login_required(lambda: None))
 
 
-def gallery_page_for_image(image, user=None):
-    images = (
-        models.ProfilePicture
-        .query
-        .order_by(models.ProfilePicture.timestamp.desc())
-    )
+PER_PAGE = 20
 
-    if user:
-        images = images.filter(models.ProfilePicture.user_id.is_(user.id))
 
-    pagination = images.paginate(per_page=20)
+def newest_first():
+    """The order of the galleries. The id breaks ties, so that every picture
+    has a fixed place."""
+    return (models.ProfilePicture.timestamp.desc(),
+            models.ProfilePicture.id.desc())
 
-    if not pagination.has_next:
-        return pagination.page
 
-    while pagination.has_next:
-        pagination = pagination.next()
-        if image in pagination.items:
-            return pagination.page
+def newer_than(newer, image):
+    """Return a filter for the pictures in newer that are shown before
+    image."""
+    return sqla.or_(
+        newer.timestamp > image.timestamp,
+        sqla.and_(newer.timestamp == image.timestamp, newer.id > image.id)
+    )
+
+
+def gallery_page_for_image(image, user=None):
+    """Return the page of the gallery, or of user's gallery, that image is
+    on, counting the pictures before it instead of paging through them."""
+    newer = models.db.session.query(sqla.func.count(models.ProfilePicture.id))
+    newer = newer.filter(newer_than(models.ProfilePicture, image))
+
+    if user:
+        newer = newer.filter(models.ProfilePicture.user_id == user.id)
 
-    return None
+    return newer.scalar() // PER_PAGE + 1
 
 
 @mod.route('/gallery/')
@@ -36,10 +46,11 @@ def gallery(page=1):
     image_query = (
         models.ProfilePicture
         .query
-        .order_by(models.ProfilePicture.timestamp.desc())
+        .options(selectinload(models.ProfilePicture.thumbnails))
+        .order_by(*newest_first())
         .paginate(
             page=page,
-            per_page=20
+            per_page=PER_PAGE
         )
     )
 
@@ -64,10 +75,11 @@ def user_gallery(user_id, page=1):
         .filter(
             models.ProfilePicture.user_id.is_(user.id)
         )
-        .order_by(models.ProfilePicture.timestamp.desc())
+        .options(selectinload(models.ProfilePicture.thumbnails))
+        .order_by(*newest_first())
         .paginate(
             page=page,
-            per_page=20,
+            per_page=PER_PAGE,
         )
     )
 
@@ -1,5 +1,4 @@
 import datetime
-import os
 
 import flask
 from flask import abort
@@ -7,7 +6,7 @@ from flask_babel import lazy_gettext as _l
 from flask_login import current_user, login_required
 from flask_uploads import UploadNotAllowed
 
-from flasquelistan import forms, models, util
+from flasquelistan import forms, imageprocessing, models, util
 from flasquelistan.views import auth
 from flasquelistan.discord import DiscordClient
 
@@ -116,9 +115,6 @@ def upload_profile_picture(user_id):
                 flask.url_for('profile.show_profile', user_id=user_id)
             )
 
-        if os.path.splitext(filename)[1].lower() in ('.jpg', '.jpeg'):
-            util.rotate_jpeg(util.profile_pictures.path(filename))
-
         profile_picture = models.ProfilePicture(
             filename=filename,
             user_id=user.id
@@ -129,6 +125,9 @@ def upload_profile_picture(user_id):
         models.db.session.add(profile_picture)
         models.db.session.commit()
 
+        # Rotated, converted and thumbnailed in the background
+        imageprocessing.process_later(profile_picture)
+
         flask.flash(_l("Profilbilden har ändrats!"), 'success')
 
     elif form.is_submitted():
@@ -398,6 +397,7 @@ def edit_api_key(user_id, api_key_id=None):
             user.api_keys.append(api_key)
 
         models.db.session.commit()
+        models.ApiKey.clear_authentication_cache()
 
         if secret:
             flask.flash(
@@ -433,6 +433,7 @@ def delete_api_key(user_id, api_key_id):
 
     models.db.session.delete(api_key)
     models.db.session.commit()
+    models.ApiKey.clear_authentication_cache()
 
     flask.flash(_l("Api-nyckeln \"%(name)s\" är borttagen.", name=api_key.name), 'success')
     return flask.redirect(flask.url_for('profile.api_keys', user_id=user_id))
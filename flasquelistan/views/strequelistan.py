@@ -1,11 +1,16 @@
+import collections
 import datetime
 import hashlib
 
 import flask
+import flask_babel
+import markupsafe
 from flask import current_app
 from flask_babel import gettext as _
 from flask_babel import lazy_gettext as _l
 from flask_login import current_user, login_required
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql.expression import extract, func, not_
 
 from flasquelistan import forms, models, util
@@ -13,12 +18,82 @@ from flasquelistan import forms, models, util
 mod = flask.Blueprint('strequelistan', __name__)
 mod.before_request(login_required(lambda: None))
 
+# Rendered user cards for the index page, keyed by everything that goes into
+# them, see usercard_key. The least recently used cards are dropped when
+# there are more than USERCARD_CACHE_SIZE.
+usercard_cache = collections.OrderedDict()
+USERCARD_CACHE_SIZE = 2000
+
+# Stands in for the csrf token in cached cards, since the token is different
+# for every session.
+CSRF_PLACEHOLDER = '__usercard_csrf_token__'
+
+
+def usercard_key(user, articles, bac, is_birthday):
+    """Return a key that changes whenever the rendered card would."""
+    if user.profile_picture:
+        # Image URLs are signed for the client's address and change with
+        # every window, so only reuse them for the same client and window.
+        picture = (user.profile_picture.filename,
+                   user.profile_picture.is_processing,
+                   tuple(thumbnail.filename
+                         for thumbnail in user.profile_picture.thumbnails),
+                   flask.request.remote_addr,
+                   util.image_url_window())
+    else:
+        picture = None
+
+    return (
+        # The card has translated text
+        str(flask_babel.get_locale()),
+        user.id,
+        user.first_name,
+        user.last_name,
+        user.nickname,
+        user.phone,
+        user.displayname,
+        picture,
+        # The displayed BAC, not the exact value
+        '{:.2f}'.format(bac) if bac >= 0.1 else None,
+        is_birthday,
+        tuple((article.id, article.name) for article in articles),
+    )
+
+
+def render_usercard(user, articles, bac, is_birthday):
+    key = usercard_key(user, articles, bac, is_birthday)
+
+    card = usercard_cache.get(key)
+    if card is None:
+        card = flask.render_template(
+            'usercard.html',
+            user=user,
+            articles=articles,
+            bac=bac,
+            is_birthday=is_birthday,
+            csrf_token=CSRF_PLACEHOLDER,
+        )
+        usercard_cache[key] = card
+        if len(usercard_cache) > USERCARD_CACHE_SIZE:
+            usercard_cache.popitem(last=False)
+    else:
+        usercard_cache.move_to_end(key)
+
+    return markupsafe.Markup(card.replace(CSRF_PLACEHOLDER, generate_csrf()))
+
 
 @mod.route('/')
 def index():
+    # Load the users of all groups in one go instead of one query per group
+    # when the template walks group.users. Profile pictures and BAC state
+    # are joined onto the users by default, the thumbnails are loaded in
+    # one more query.
     groups = (models.Group
               .query
               .filter(models.Group.users.any())  # Only groups with users
+              .options(selectinload(models.Group.users)
+                       .joinedload(models.User.profile_picture)
+                       .selectinload(models.ProfilePicture.thumbnails))
               .order_by(models.Group.weight.desc())
               .all()
               )
@@ -35,18 +110,25 @@ def index():
     )
 
     too_old = datetime.datetime.utcnow() - datetime.timedelta(days=7)
-    users_with_streques = (
-        models.User
-        .query
-        .join(models.User.transactions)
+    # A subquery rather than a join, which would return every user once
+    # per streque.
+    recent_streques = (
+        models.db.select(models.Streque.user_id)
         .filter(
-            models.Transaction.type.is_('streque'),
             models.Streque.voided.is_(False),
             models.Streque.timestamp >= too_old,
             models.Streque.standardglas > 0
         )
+    )
+    users_with_streques = (
+        models.User
+        .query
+        .filter(models.User.id.in_(recent_streques))
         .all()
     )
+    # Calculate the BAC of everyone who might have any at once, instead of
+    # querying the streques of each user card separately.
+    bacs = models.User.bac_for_users(users_with_streques)
 
     current_app.jinja_env.filters['is_active'] = \
         lambda items: [i for i in items if i.active]
@@ -121,14 +203,18 @@ def index():
     else:
         has_pending_nicknames = False
 
+    def usercard(user):
+        return render_usercard(user, articles, bacs.get(user.id, 0),
+                               user in birthdays)
+
     return flask.render_template(
         'strequelistan.html',
+        usercard=usercard,
         groups=groups,
         quote=random_quote,
         articles=articles,
         notification_count=notification_count,
         has_pending_nicknames=has_pending_nicknames,
-        users_with_streques=users_with_streques,
         birthdays=birthdays,
         birthday_emoji=birthday_emoji,
         vip=vip
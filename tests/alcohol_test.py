@@ -0,0 +1,91 @@
+import datetime
+import itertools
+import random
+
+import pytest
+
+from flasquelistan import alcohol, models
+from tests.helpers import make_user
+
+START = datetime.datetime(2024, 11, 2, 18, 0)
+
+
+def random_streques(seed, users=20, max_streques=40):
+    """Columns of (user_id, timestamp, standardglas), sorted like the
+    queries sort them. Gaps vary from seconds to days, so both the burn-off
+    and the floor at zero are exercised."""
+    rng = random.Random(seed)
+    rows = []
+    for user_id in range(1, users + 1):
+        timestamp = START
+        for _ in range(rng.randint(0, max_streques)):
+            timestamp += datetime.timedelta(
+                seconds=rng.choice([1, 30, 600, 3600, 20000, 100000])
+                * rng.random(),
+            )
+            standardglas = rng.choice([0.33, 0.5, 1, 1, 1.5, 2, 4])
+            rows.append((user_id, timestamp, standardglas))
+    return rows
+
+
+def replay_per_user(rows):
+    return {
+        user_id: alcohol.replay_alcohol((t, g) for _, t, g in user_rows)
+        for user_id, user_rows in itertools.groupby(rows, key=lambda r: r[0])
+    }
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_alcohol_for_users_matches_replay(seed):
+    rows = random_streques(seed)
+    expected = replay_per_user(rows)
+
+    result = alcohol.alcohol_for_users(*zip(*rows))
+
+    assert result.keys() == expected.keys()
+    for user_id, (in_body, timestamp) in expected.items():
+        assert result[user_id][0] == pytest.approx(in_body, abs=1e-12)
+        assert result[user_id][1] == timestamp
+
+
+def test_alcohol_for_users_without_streques():
+    assert alcohol.alcohol_for_users([], [], []) == {}
+
+
+def test_alcohol_for_users_does_not_leak_between_users():
+    rows = [
+        (1, START, 10),
+        (2, START + datetime.timedelta(hours=1), 1),
+    ]
+
+    result = alcohol.alcohol_for_users(*zip(*rows))
+
+    assert result[2][0] == pytest.approx(alcohol.STANDARDGLAS_ALCOHOL_CONTENT)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_bac_for_users_matches_bac(app, seed):
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    users = []
+    for i in range(10):
+        user = make_user(email=f'user{i}@pfoj.tld',
+                         body_mass=rng.choice([None, 50, 70, 110]),
+                         y_chromosome=rng.choice([None, True, False]))
+        users.append(user)
+        timestamp = now - datetime.timedelta(hours=rng.uniform(0, 30))
+        while timestamp < now:
+            models.db.session.add(models.Streque(
+                value=-1000,
+                user_id=user.id,
+                standardglas=rng.choice([0.5, 1, 2]),
+                timestamp=timestamp,
+            ))
+            timestamp += datetime.timedelta(minutes=rng.uniform(1, 120))
+    models.db.session.commit()
+
+    bacs = models.User.bac_for_users(users, now=now)
+
+    for user in users:
+        assert bacs[user.id] == user.bac_from_alcohol(*user.replay_streques(),
+                                                      now=now)
@@ -0,0 +1,35 @@
+from flasquelistan import background
+
+
+class Recorder(background.BackgroundQueue):
+    def __init__(self, app):
+        super().__init__(app)
+        self.worked = []
+        self.failed = []
+
+    def work(self, items):
+        if items == ['spam']:
+            raise ValueError(items)
+        self.worked.extend(items)
+
+    def work_failed(self, items):
+        self.failed.extend(items)
+
+
+def test_items_worked_on_in_background(app):
+    worker = Recorder(app)
+    for item in ['eggs', 'bacon']:
+        worker.put_in_queue(item)
+
+    worker.join()
+    assert worker.worked == ['eggs', 'bacon']
+
+
+def test_worker_survives_failure(app):
+    worker = Recorder(app)
+    worker.put_in_queue('spam')
+    worker.put_in_queue('eggs')
+    worker.join()
+
+    assert worker.failed == ['spam']
+    assert worker.worked == ['eggs']
@@ -0,0 +1,95 @@
+import os
+
+import flask
+import pytest
+
+from flasquelistan import cachebust
+
+
+@pytest.fixture
+def static_folder(tmp_path):
+    static = tmp_path / 'static'
+    (static / 'css').mkdir(parents=True)
+    (static / 'uploads').mkdir()
+    (static / 'css' / 'style.css').write_text('body {}')
+    (static / 'uploads' / 'picture.jpg').write_text('not really a jpeg')
+    return static
+
+
+def make_app(static_folder, **config):
+    app = flask.Flask(__name__, static_folder=str(static_folder))
+    app.config.update(config)
+    cachebust.setup_cache_busting(app)
+    return app
+
+
+def test_compute_manifest_excludes(static_folder):
+    manifest = cachebust.compute_manifest(str(static_folder), ['uploads'])
+
+    assert list(manifest) == ['css/style.css']
+    assert manifest['css/style.css']['version'] == \
+        cachebust.file_version(static_folder / 'css' / 'style.css')
+
+
+def test_compute_manifest_only_hashes_changed(static_folder, monkeypatch):
+    previous = cachebust.compute_manifest(str(static_folder))
+    (static_folder / 'uploads' / 'picture.jpg').write_text('a new picture')
+    os.utime(static_folder / 'uploads' / 'picture.jpg', ns=(0, 0))
+
+    hashed = []
+    file_version = cachebust.file_version
+    monkeypatch.setattr(cachebust, 'file_version',
+                        lambda path: hashed.append(path) or file_version(path))
+    manifest = cachebust.compute_manifest(str(static_folder),
+                                          previous=previous)
+
+    assert hashed == [str(static_folder / 'uploads' / 'picture.jpg')]
+    assert manifest['css/style.css'] == previous['css/style.css']
+    assert manifest['uploads/picture.jpg']['version'] != \
+        previous['uploads/picture.jpg']['version']
+
+
+def test_urls_from_manifest(static_folder, tmp_path):
+    manifest_path = tmp_path / 'cachebust.json'
+    manifest = cachebust.compute_manifest(str(static_folder), ['uploads'])
+    manifest['css/style.css']['version'] = 'cmanifest'
+    cachebust.write_manifest(manifest_path, manifest)
+
+    app = make_app(static_folder, CACHE_BUST_MANIFEST=manifest_path)
+
+    with app.test_request_context():
+        assert flask.url_for('static', filename='css/style.css') == \
+            '/static/cmanifest/css/style.css'
+    response = app.test_client().get('/static/cmanifest/css/style.css')
+    assert response.data == b'body {}'
+    response.close()
+
+
+def test_urls_without_manifest(static_folder, tmp_path):
+    app = make_app(static_folder,
+                   CACHE_BUST_MANIFEST=tmp_path / 'cachebust.json',
+                   CACHE_BUST_EXCLUDE=['uploads'])
+    version = cachebust.file_version(static_folder / 'css' / 'style.css')
+
+    with app.test_request_context():
+        assert flask.url_for('static', filename='css/style.css') == \
+            f'/static/{version}/css/style.css'
+        assert flask.url_for('static', filename='uploads/picture.jpg') == \
+            '/static/uploads/picture.jpg'
+
+
+def test_cachebust_command(app, tmp_path, monkeypatch):
+    manifest_path = tmp_path / 'cachebust.json'
+    monkeypatch.setitem(app.config, 'CACHE_BUST_MANIFEST', manifest_path)
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=['cachebust'])
+    assert result.exit_code == 0, result.output
+    manifest = cachebust.read_manifest(manifest_path)
+    assert 'css/style.css' in manifest
+    assert not any(filename.startswith('uploads/') for filename in manifest)
+    assert result.output.startswith(f"Hashed {len(manifest)} of ")
+
+    # Nothing changed since
+    result = runner.invoke(args=['cachebust'])
+    assert result.output.startswith(f"Hashed 0 of {len(manifest)} ")
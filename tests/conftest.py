@@ -34,6 +34,14 @@ BASE_TEST_CONFIG = {
     # Disable CSRF in unit tests.
     'WTF_CSRF_ENABLED': False,
     'TESTING': True,
+    # Emit SocketIO events right away, tests that need the outbox enable it.
+    'EMIT_EVENTS_IN_BACKGROUND': False,
+    # Process uploaded pictures right away, tests that need the queue
+    # enable it.
+    'PROCESS_IMAGES_IN_BACKGROUND': False,
+    # Keep email in app.extensions['mailer'].transport.messages.
+    'MAIL_TRANSPORT': 'memory',
+    'MAIL_RATE_LIMIT': None,
 }
 
 
@@ -1,6 +1,8 @@
 import hashlib
 from contextlib import contextmanager
 
+import sqlalchemy as sqla
+
 from flasquelistan import models
 
 # The app and client pytest fixtures live in tests/conftest.py, where pytest
@@ -28,6 +30,23 @@ def captcha_answer(app, n):
     return hashlib.sha256(s).hexdigest()
 
 
+@contextmanager
+def count_queries():
+    """Collect the SQL statements executed inside the block in a list."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sqla.event.listen(models.db.engine, 'before_cursor_execute',
+                      before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        sqla.event.remove(models.db.engine, 'before_cursor_execute',
+                          before_cursor_execute)
+
+
 @contextmanager
 def logged_in(client):
     """Fixture for a signed in user"""
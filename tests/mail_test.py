@@ -0,0 +1,209 @@
+import email.message
+import queue
+import smtplib
+import threading
+import time
+from unittest import mock
+
+import pytest
+from flask import url_for
+
+from flasquelistan import mail, util
+from tests.helpers import logged_in_admin, make_user
+
+
+def make_message(toaddr='monty@python.tld'):
+    msg = email.message.EmailMessage()
+    msg.set_content('Ni!')
+    msg['To'] = toaddr
+    return msg
+
+
+@pytest.fixture
+def smtp(app, monkeypatch):
+    """Send with the SMTP transport, to a mock of smtplib.SMTP."""
+    monkeypatch.setitem(app.config, 'SMTP_USE_STARTTLS', True)
+    monkeypatch.setitem(app.config, 'SMTP_USERNAME', 'monty')
+    monkeypatch.setitem(app.config, 'SMTP_PASSWORD', 'spam')
+    monkeypatch.setitem(app.config, 'MAIL_RETRY_DELAY', 0)
+    with mock.patch.object(smtplib, 'SMTP') as smtp_class:
+        yield smtp_class
+
+
+@pytest.fixture
+def mailer(app, smtp):
+    return mail.Mailer(app, mail.SMTPTransport(app.config))
+
+
+def test_send_email_is_queued(app, client):
+    mailer = app.extensions['mailer']
+    mailer.transport.messages.clear()
+    make_user(email='negative@python.tld', balance=-1000)
+    make_user(email='positive@python.tld', balance=1000)
+
+    with logged_in_admin(client):
+        response = client.post(url_for('strequeadmin.spam'))
+    assert response.status_code == 200
+
+    mailer.join()
+    assert [msg['To'] for msg in mailer.transport.messages] == [
+        'negative@python.tld']
+
+
+def test_spam_with_full_queue(app, client, monkeypatch):
+    sent = []
+
+    def send_email(fromaddr, toaddr, subject, message):
+        if sent:
+            raise queue.Full
+        sent.append(toaddr)
+
+    monkeypatch.setattr(util, 'send_email', send_email)
+    make_user(email='negative@python.tld', first_name='Negative',
+              balance=-2000)
+    make_user(email='more.negative@python.tld', first_name='More',
+              balance=-1000)
+    make_user(email='positive@python.tld', balance=1000)
+
+    with logged_in_admin(client):
+        response = client.post(url_for('strequeadmin.spam'))
+    text = response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert sent == ['negative@python.tld']
+    assert 'Skickade 1 saldopåminnelser!' in text
+    assert 'E-postkön är full' in text
+    assert 'More Python' in text
+
+
+def test_connection_is_reused(mailer, smtp):
+    for i in range(5):
+        mailer.put(make_message(f'user{i}@python.tld'))
+    mailer.join()
+
+    smtp.assert_called_once()
+    connection = smtp.return_value
+    connection.starttls.assert_called_once()
+    connection.login.assert_called_once_with('monty', 'spam')
+    assert connection.send_message.call_count == 5
+
+
+def test_connection_closed_when_idle(app, mailer, smtp, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_IDLE_TIMEOUT', 0.01)
+    mailer.put(make_message())
+    mailer.join()
+    time.sleep(0.1)
+
+    smtp.return_value.quit.assert_called_once()
+
+    mailer.put(make_message())
+    mailer.join()
+    assert smtp.call_count == 2
+
+
+def test_temporary_error_retried(mailer, smtp):
+    connection = smtp.return_value
+    connection.send_message.side_effect = [
+        smtplib.SMTPServerDisconnected(),
+        smtplib.SMTPResponseException(421, b'Busy'),
+        None,
+    ]
+
+    mailer.put(make_message())
+    mailer.join()
+
+    assert connection.send_message.call_count == 3
+    # A new connection after every failure
+    assert smtp.call_count == 3
+
+
+def test_retries_give_up(app, mailer, smtp, monkeypatch, caplog):
+    monkeypatch.setitem(app.config, 'MAIL_RETRIES', 2)
+    connection = smtp.return_value
+    connection.send_message.side_effect = smtplib.SMTPServerDisconnected()
+
+    mailer.put(make_message())
+    mailer.join()
+
+    assert connection.send_message.call_count == 3
+    assert "Could not send email to monty@python.tld" in caplog.text
+
+
+def test_permanent_error_not_retried(mailer, smtp, caplog):
+    connection = smtp.return_value
+    connection.send_message.side_effect = [
+        smtplib.SMTPRecipientsRefused(
+            {'spam@python.tld': (550, b'No such user')}),
+        None,
+    ]
+
+    mailer.put(make_message('spam@python.tld'))
+    mailer.put(make_message('eggs@python.tld'))
+    mailer.join()
+
+    assert connection.send_message.call_count == 2
+    assert "Could not send email to spam@python.tld" in caplog.text
+
+
+def test_rate_limit(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_RATE_LIMIT', 20)
+    mailer = mail.Mailer(app, mail.MemoryTransport())
+
+    start = time.monotonic()
+    for _ in range(3):
+        mailer.put(make_message())
+    mailer.join()
+
+    assert len(mailer.transport.messages) == 3
+    assert time.monotonic() - start >= 2 / 20
+
+
+class BlockingTransport(mail.MemoryTransport):
+    def __init__(self):
+        super().__init__()
+        self.sending = threading.Event()
+        self.unblock = threading.Event()
+
+    def send(self, msg):
+        self.sending.set()
+        self.unblock.wait()
+        super().send(msg)
+
+
+def test_queue_is_bounded(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_QUEUE_SIZE', 1)
+    monkeypatch.setitem(app.config, 'MAIL_QUEUE_TIMEOUT', 0.01)
+    transport = BlockingTransport()
+    mailer = mail.Mailer(app, transport)
+
+    mailer.put(make_message())
+    transport.sending.wait()
+    mailer.put(make_message())
+    with pytest.raises(queue.Full):
+        mailer.put(make_message())
+
+    transport.unblock.set()
+    mailer.join()
+    assert len(transport.messages) == 2
+
+
+def test_is_temporary():
+    assert mail.is_temporary(ConnectionRefusedError())
+    assert mail.is_temporary(smtplib.SMTPServerDisconnected())
+    assert mail.is_temporary(smtplib.SMTPResponseException(451, b''))
+    assert not mail.is_temporary(smtplib.SMTPAuthenticationError(535, b''))
+    assert not mail.is_temporary(ValueError())
+
+
+def test_send_email_builds_message(app):
+    mailer = app.extensions['mailer']
+    mailer.transport.messages.clear()
+
+    util.send_email('system@python.tld', 'monty@python.tld', 'Spam', 'Eggs')
+    mailer.join()
+
+    [msg] = mailer.transport.messages
+    assert msg['From'] == 'system@python.tld'
+    assert msg['To'] == 'monty@python.tld'
+    assert msg['Subject'] == 'Spam'
+    assert msg.get_content().strip() == 'Eggs'
@@ -0,0 +1,94 @@
+import time
+
+import pytest
+import socketio
+
+from flasquelistan import factory, messagequeue, util
+from tests.conftest import BASE_TEST_CONFIG, fresh_database
+from tests.helpers import make_user
+
+CHANNEL = 'messagequeue_test'
+
+
+@pytest.fixture(scope='module')
+def _app():
+    # The SocketIO server is shared by all apps, and the Flask-SocketIO test
+    # client used by other tests does not work with a message queue
+    server = factory.socketio.server
+    yield factory.create_app({
+        **BASE_TEST_CONFIG,
+        'SOCKETIO_MESSAGE_QUEUE': 'local://',
+        'SOCKETIO_CHANNEL': CHANNEL,
+    })
+    factory.socketio.server = server
+
+
+@pytest.fixture
+def app(_app):
+    with fresh_database(_app) as app:
+        yield app
+
+
+@pytest.fixture
+def received(app, monkeypatch):
+    """Connect a client to this worker's SocketIO server and return the list
+    of (event, data) sent to it.
+
+    The Flask-SocketIO test client refuses to work with a message queue, so
+    the client is added to the server's client manager directly.
+    """
+    server = factory.socketio.server
+    events = []
+
+    def send_eio_packet(eio_sid, eio_packet):
+        event, data = socketio.packet.Packet(encoded_packet=eio_packet.data).data
+        events.append((event, data))
+
+    monkeypatch.setattr(server, '_send_eio_packet', send_eio_packet)
+    if not server.manager_initialized:
+        server.manager_initialized = True
+        server.manager.initialize()
+
+    sid = server.manager.connect('test_eio_sid', '/')
+    for event in util.EVENT_TYPES:
+        server.manager.enter_room(sid, '/', util.event_room(event))
+    yield events
+    server.manager.disconnect(sid, '/', ignore_queue=True)
+
+
+def wait_for(events, count, timeout=1):
+    """Let the queue listener run until there are count events."""
+    deadline = time.monotonic() + timeout
+    while len(events) < count and time.monotonic() < deadline:
+        factory.socketio.sleep(0.01)
+
+
+def test_emit_reaches_client_once(app, received):
+    user = make_user(balance=1000)
+    util.emit_balance_change_event(user, 500)
+
+    wait_for(received, 1)
+    assert [event for event, data in received] == ['balance_change']
+    assert received[0][1]['new_balance'] == 1000
+
+    # Our own message coming back through the queue is not sent again
+    wait_for(received, 2, timeout=0.1)
+    assert len(received) == 1
+
+
+def test_emit_from_other_worker(app, received):
+    # Stands in for another worker process publishing on the same queue
+    other_worker = messagequeue.LocalManager(channel=CHANNEL, write_only=True)
+    other_worker.emit('notification', {'user_id': 1, 'text': 'Hej'})
+
+    wait_for(received, 1)
+    assert received == [('notification', {'user_id': 1, 'text': 'Hej'})]
+
+
+def test_no_queue_configured(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'SOCKETIO_MESSAGE_QUEUE', None)
+    assert messagequeue.client_manager(app) is None
+
+    monkeypatch.setitem(app.config, 'SOCKETIO_MESSAGE_QUEUE', 'local://')
+    assert isinstance(messagequeue.client_manager(app),
+                      messagequeue.LocalManager)
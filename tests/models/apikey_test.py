@@ -1,6 +1,29 @@
+import datetime
+
+import pytest
+
 from flasquelistan import models
+from flasquelistan.models import apikey
+
+from tests.helpers import count_queries, make_user
+
 
-from tests.helpers import make_user
+def make_api_key(is_enabled=True):
+    user = make_user()
+    key = models.ApiKey.generate_key()
+    api_key = models.ApiKey(name='test', user_id=user.id,
+                            is_enabled=is_enabled)
+    api_key.api_key = key
+    models.db.session.add(api_key)
+    models.db.session.commit()
+    return api_key, key
+
+
+@pytest.fixture(autouse=True)
+def empty_caches(monkeypatch):
+    # Key ids are reused between tests, since every test gets a new database
+    monkeypatch.setattr(apikey, '_authentication_cache', {})
+    monkeypatch.setattr(apikey, '_last_used_written', {})
 
 
 class TestApiKeyAuthenticate:
@@ -26,3 +49,69 @@ class TestApiKeyAuthenticate:
         models.db.session.commit()
 
         assert models.ApiKey.authenticate(key) is None
+
+
+class TestApiKeyCache:
+    def test_cached_key_needs_no_queries(self, app):
+        api_key, key = make_api_key()
+        models.ApiKey.authenticate(key)
+
+        with count_queries() as statements:
+            assert models.ApiKey.authenticate(key) == api_key
+        assert statements == []
+
+    def test_cached_key_in_new_session(self, app):
+        api_key, key = make_api_key()
+        api_key_id = api_key.id
+        models.ApiKey.authenticate(key)
+        models.db.session.remove()
+
+        with count_queries() as statements:
+            cached = models.ApiKey.authenticate(key)
+        assert statements == []
+        assert cached.id == api_key_id
+        assert cached.name == 'test'
+        assert cached.user.first_name == 'Monty'
+
+    def test_cache_expires(self, app, monkeypatch):
+        monkeypatch.setattr(apikey, 'AUTHENTICATION_CACHE_TTL', 0)
+        api_key, key = make_api_key()
+        models.ApiKey.authenticate(key)
+
+        api_key.is_enabled = False
+        models.db.session.commit()
+
+        assert models.ApiKey.authenticate(key) is None
+
+    def test_clear_cache(self, app):
+        api_key, key = make_api_key()
+        models.ApiKey.authenticate(key)
+
+        api_key.is_enabled = False
+        models.db.session.commit()
+        models.ApiKey.clear_authentication_cache()
+
+        assert models.ApiKey.authenticate(key) is None
+
+    def test_last_used_written_once_per_interval(self, app):
+        api_key, key = make_api_key()
+
+        models.ApiKey.authenticate(key)
+        first_use = api_key.last_used_timestamp
+        assert first_use is not None
+
+        with count_queries() as statements:
+            models.ApiKey.authenticate(key)
+        assert statements == []
+        assert api_key.last_used_timestamp == first_use
+
+    def test_last_used_written_after_interval(self, app):
+        api_key, key = make_api_key()
+        models.ApiKey.authenticate(key)
+
+        apikey._last_used_written[api_key.id] -= datetime.timedelta(
+            seconds=apikey.LAST_USED_INTERVAL)
+        before = datetime.datetime.utcnow()
+        models.ApiKey.authenticate(key)
+
+        assert api_key.last_used_timestamp >= before
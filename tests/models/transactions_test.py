@@ -1,12 +1,34 @@
 #!/usr/bin/env python3
 
 import datetime
+from unittest import mock
+
+import pytest
 
 from flasquelistan import models
 
 from tests.helpers import make_user
 
 
+def spend_elsewhere(user, value):
+    """Lower user's balance behind the session's back, like a concurrent
+    request would."""
+    with models.db.engine.begin() as connection:
+        connection.execute(
+            models.db.update(models.User)
+            .where(models.User.id == user.id)
+            .values(balance=models.User.balance - value)
+        )
+
+
+def stored_balance(user):
+    with models.db.engine.connect() as connection:
+        return connection.execute(
+            models.db.select(models.User.balance)
+            .where(models.User.id == user.id)
+        ).scalar_one()
+
+
 def test_admintransaction_model(app):
     admin_tx = models.AdminTransaction(
         value=100
@@ -148,6 +170,38 @@ class TestVoidAndRefund:
         assert transaction.void_and_refund() is False
         assert user.balance == 1000
 
+    def test_void_concurrently_voided(self, app):
+        user = make_user()
+        transaction = models.Transaction(value=-1000, user_id=user.id)
+        models.db.session.add(transaction)
+        models.db.session.commit()
+        assert not transaction.voided
+
+        # Voided by another worker process after this one loaded it
+        models.db.session.execute(
+            models.db.update(models.Transaction)
+            .where(models.Transaction.id == transaction.id)
+            .values(voided=True)
+            .execution_options(synchronize_session=False)
+        )
+
+        assert transaction.void_and_refund() is False
+        assert transaction.voided
+        assert stored_balance(user) == 0
+
+    def test_refund_keeps_concurrent_change(self, app):
+        user = make_user()
+        transaction = models.Transaction(value=-1000, user_id=user.id)
+        models.db.session.add(transaction)
+        models.db.session.commit()
+        assert user.balance == 0
+
+        spend_elsewhere(user, 300)
+        transaction.void_and_refund()
+
+        assert user.balance == 700
+        assert stored_balance(user) == 700
+
 
 class TestCreditTransfer:
     def test_create_rejects_non_positive_value(self, app):
@@ -235,6 +289,25 @@ class TestCreditTransfer:
         assert payer.balance == 10000
         assert payee.balance == 0
 
+    def test_create_keeps_concurrent_change(self, app):
+        payer = make_user(balance=10000)
+        payee = make_user(email='brian@pfoj.tld', first_name='Brian',
+                          last_name='Smith')
+        assert payer.balance == 10000
+
+        spend_elsewhere(payer, 3000)
+        models.CreditTransfer.create(
+            payer=payer,
+            payee=payee,
+            created_by=payer,
+            value=1000,
+            message=None,
+        )
+
+        assert payer.balance == 6000
+        assert stored_balance(payer) == 6000
+        assert stored_balance(payee) == 1000
+
 
 class TestAdminTransactionNotification:
     def test_deposit_notification(self, app):
@@ -267,6 +340,118 @@ class TestAdminTransactionNotification:
         user.admin_transaction(500, 'insättning', by_user=user)
         assert user.balance == 1200
 
+    def test_admin_transaction_keeps_concurrent_change(self, app):
+        user = make_user(balance=1000)
+        assert user.balance == 1000
+
+        spend_elsewhere(user, 400)
+        user.admin_transaction(500, 'insättning', by_user=user)
+
+        assert user.balance == 1100
+        assert stored_balance(user) == 1100
+
+
+class TestBulkAdminTransactions:
+    def make_users(self, count):
+        return [make_user(email=f'user{i}@python.tld', balance=1000)
+                for i in range(count)]
+
+    def test_bulk_admin_transactions(self, app):
+        admin = make_user(is_admin=True)
+        monty, brian = self.make_users(2)
+
+        transactions = models.User.bulk_admin_transactions(
+            [(monty, 500, 'insättning'), (brian, -300, 'uttag')],
+            by_user=admin
+        )
+
+        assert [(t.user_id, t.value, t.text, t.created_by_id)
+                for t in transactions] == [
+            (monty.id, 500, 'insättning', admin.id),
+            (brian.id, -300, 'uttag', admin.id),
+        ]
+        assert (monty.balance, brian.balance) == (1500, 700)
+        assert stored_balance(monty) == 1500
+        assert stored_balance(brian) == 700
+
+        notifications = models.Notification.query.order_by('id').all()
+        assert [(n.user_id, n.reference) for n in notifications] == [
+            (monty.id, str(transactions[0].id)),
+            (brian.id, str(transactions[1].id)),
+        ]
+        assert notifications[0].text.startswith('Insättning!')
+        assert notifications[1].text.startswith('Uttag!')
+
+    def test_same_user_twice(self, app):
+        admin = make_user(is_admin=True)
+        monty, = self.make_users(1)
+
+        models.User.bulk_admin_transactions(
+            [(monty, 500, 'insättning'), (monty, 200, 'insättning')],
+            by_user=admin
+        )
+
+        assert monty.balance == 1700
+        assert models.AdminTransaction.query.count() == 2
+
+    def test_keeps_concurrent_change(self, app):
+        admin = make_user(is_admin=True)
+        monty, brian = self.make_users(2)
+
+        spend_elsewhere(monty, 400)
+        models.User.bulk_admin_transactions(
+            [(monty, 500, 'insättning'), (brian, 500, 'insättning')],
+            by_user=admin
+        )
+
+        assert monty.balance == 1100
+        assert stored_balance(monty) == 1100
+
+    def test_all_or_nothing(self, app):
+        admin = make_user(is_admin=True)
+        users = self.make_users(3)
+
+        notification_values = models.AdminTransaction.notification_values
+        calls = []
+
+        def fail_on_last(transaction):
+            calls.append(transaction)
+            if len(calls) == len(users):
+                raise RuntimeError
+            return notification_values(transaction)
+
+        with mock.patch.object(models.AdminTransaction, 'notification_values',
+                               fail_on_last):
+            with pytest.raises(RuntimeError):
+                models.User.bulk_admin_transactions(
+                    [(user, 500, 'insättning') for user in users],
+                    by_user=admin
+                )
+        models.db.session.rollback()
+
+        assert [stored_balance(user) for user in users] == [1000] * 3
+        assert models.AdminTransaction.query.count() == 0
+        assert models.Notification.query.count() == 0
+
+    def test_events_emitted_after_commit(self, app):
+        admin = make_user(is_admin=True)
+        monty, brian = self.make_users(2)
+
+        with mock.patch('flasquelistan.util.emit_balance_change_event') \
+                as emit_balance_change, \
+                mock.patch('flasquelistan.util.emit_notification_event') \
+                as emit_notification:
+            models.User.bulk_admin_transactions(
+                [(monty, 500, 'insättning'), (brian, -300, 'uttag')],
+                by_user=admin
+            )
+
+        assert [call.args for call in emit_balance_change.call_args_list] \
+            == [(monty, 1000), (brian, 1000)]
+        assert [call.args[0].user_id
+                for call in emit_notification.call_args_list] \
+            == [monty.id, brian.id]
+
 
 class TestStreque:
     def test_too_old_boundary(self, app):
@@ -303,6 +488,21 @@ class TestStreque:
         assert streque.created_by_id == user.id
         assert streque.api_key_id is None
 
+    def test_strequa_keeps_concurrent_change(self, app):
+        user = make_user(balance=1000)
+        article = models.Article(name='Öl', value=400, is_active=True)
+        models.db.session.add(article)
+        models.db.session.commit()
+        assert user.balance == 1000
+
+        # Another worker strequar in between loading the user and this
+        # streque; its change must not be overwritten.
+        spend_elsewhere(user, 500)
+        user.strequa(article, by_user=user)
+
+        assert user.balance == 100
+        assert stored_balance(user) == 100
+
     def test_api_dict_includes_standardglas(self, app):
         user = make_user()
         streque = models.Streque(value=-400, user_id=user.id, standardglas=1.5)
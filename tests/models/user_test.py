@@ -3,6 +3,9 @@
 import datetime
 from unittest import mock
 
+import flask
+import pytest
+
 from flasquelistan import models
 
 from tests.helpers import make_user
@@ -184,6 +187,197 @@ def test_bac_ignores_non_alcoholic_streques(app):
     assert user.bac == 0
 
 
+def make_article(standardglas=1):
+    article = models.Article(name='Öl', value=400, standardglas=standardglas)
+    models.db.session.add(article)
+    models.db.session.commit()
+    return article
+
+
+def test_strequa_updates_bac_state(app):
+    user = make_drinker()
+    article = make_article(standardglas=2)
+
+    user.strequa(article, by_user=user)
+    first = user.bac_state.alcohol
+    assert first == pytest.approx(2 * 0.012)
+
+    user.strequa(article, by_user=user)
+    assert user.bac_state.alcohol > first
+
+    # The incremental state matches replaying all streques.
+    alcohol, timestamp = user.replay_streques()
+    assert user.bac_state.alcohol == pytest.approx(alcohol)
+    assert user.bac_state.timestamp == timestamp
+
+
+def test_strequa_non_alcoholic_leaves_bac_state_alone(app):
+    user = make_drinker()
+    user.strequa(make_article(standardglas=0), by_user=user)
+
+    assert user.bac_state is None
+    assert user.bac == 0
+
+
+def test_bac_burns_off_since_bac_state_timestamp(app):
+    user = make_drinker()
+    user.bac_state = models.BacState(
+        alcohol=0.024,
+        timestamp=datetime.datetime.utcnow() - datetime.timedelta(hours=1),
+    )
+    models.db.session.commit()
+
+    # 1.667e-06 kg/s for an hour, 70 kg male
+    expected = 1000 * (0.024 - 1.667e-06 * 3600) / (70 * 0.7)
+    assert user.bac == pytest.approx(expected, abs=0.01)
+
+
+def test_bac_uses_bac_state_instead_of_streques(app):
+    user = make_drinker()
+    user.strequa(make_article(standardglas=2), by_user=user)
+
+    with mock.patch.object(models.User, 'replay_streques') as replay:
+        assert user.bac > 0
+        replay.assert_not_called()
+
+
+def test_strequa_older_than_bac_state_replays(app):
+    user = make_drinker()
+    user.bac_state = models.BacState(
+        alcohol=0, timestamp=datetime.datetime.utcnow())
+    models.db.session.commit()
+
+    earlier = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+    streque = add_streque(user, standardglas=2, timestamp=earlier)
+    user.absorb_streque(streque)
+    models.db.session.commit()
+
+    assert user.bac_state.alcohol == pytest.approx(2 * 0.012)
+    assert user.bac_state.timestamp == earlier
+
+
+def test_absorb_streque_burns_since_bac_state(app):
+    user = make_drinker()
+    an_hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    user.bac_state = models.BacState(alcohol=0.024, timestamp=an_hour_ago)
+    models.db.session.commit()
+
+    streque = add_streque(user, standardglas=1)
+    user.absorb_streque(streque)
+
+    expected = 0.024 - 1.667e-06 * (streque.timestamp
+                                    - an_hour_ago).total_seconds() + 0.012
+    assert user.bac_state.alcohol == pytest.approx(expected)
+    assert user.bac_state.timestamp == streque.timestamp
+
+
+def test_absorb_streque_keeps_concurrent_update(app):
+    user = make_drinker()
+    user.strequa(make_article(standardglas=2), by_user=user)
+    assert user.bac_state.alcohol == pytest.approx(2 * 0.012)
+
+    # Another worker process absorbs a streque meanwhile, after this one
+    # loaded the state
+    models.db.session.execute(
+        models.db.update(models.BacState)
+        .where(models.BacState.user_id == user.id)
+        .values(alcohol=models.BacState.alcohol + 0.012)
+        .execution_options(synchronize_session=False)
+    )
+
+    user.strequa(make_article(standardglas=2), by_user=user)
+
+    assert user.bac_state.alcohol == pytest.approx(5 * 0.012, rel=1e-3)
+
+
+def test_void_and_refund_rebuilds_bac_state(app):
+    user = make_drinker()
+    article = make_article(standardglas=2)
+    user.strequa(article, by_user=user)
+    streque = user.strequa(article, by_user=user)
+
+    streque.void_and_refund()
+
+    assert user.bac_state.alcohol == pytest.approx(2 * 0.012)
+
+
+def test_bac_for_users_matches_bac(app):
+    monty = make_drinker()
+    brian = make_drinker(email='brian@pfoj.tld')
+    sober = make_drinker(email='sober@pfoj.tld')
+
+    an_hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    add_streque(monty, standardglas=2, timestamp=an_hour_ago)
+    add_streque(monty, standardglas=1)
+    add_streque(brian, standardglas=3)
+    # Brian's state is persisted, Monty's has to be replayed.
+    brian.rebuild_bac_state()
+    models.db.session.commit()
+
+    now = datetime.datetime.utcnow()
+    expected = {
+        monty.id: monty.bac_from_alcohol(*monty.replay_streques(), now=now),
+        brian.id: brian.bac_from_alcohol(brian.bac_state.alcohol,
+                                         brian.bac_state.timestamp, now=now),
+        sober.id: 0,
+    }
+
+    bacs = models.User.bac_for_users([monty, brian, sober], now=now)
+
+    assert bacs == expected
+    assert bacs[monty.id] > 0
+    assert bacs[brian.id] > 0
+    assert bacs[sober.id] == 0
+
+
+def test_emoji_for_bac_matches_bac_emoji(app):
+    user = make_drinker()
+    add_streque(user, standardglas=5)
+
+    assert user.bac_emoji == models.User.emoji_for_bac(user.bac)
+    assert user.bac_emoji is not None
+
+
+def test_bac_cached_within_request(app):
+    user = make_drinker()
+    add_streque(user, standardglas=2)
+
+    with app.test_request_context():
+        models.user.reset_bac_cache()
+        with mock.patch.object(models.User, 'replay_streques',
+                               wraps=user.replay_streques) as replay:
+            first = user.bac
+            assert user.bac == first
+            assert user.bac_emoji == models.User.emoji_for_bac(first)
+            assert replay.call_count == 1
+
+        assert flask.g.bac_cache_hits == 2
+        assert flask.g.bac_cache_misses == 1
+
+
+def test_bac_cache_invalidated_by_strequa(app):
+    user = make_drinker()
+    article = make_article(standardglas=2)
+
+    with app.test_request_context():
+        models.user.reset_bac_cache()
+        assert user.bac == 0
+        user.strequa(article, by_user=user)
+        assert user.bac > 0
+
+        streque = user.transactions.first()
+        streque.void_and_refund()
+        assert user.bac == 0
+
+
+def test_bac_not_cached_outside_requests(app):
+    user = make_drinker()
+    assert user.bac == 0
+
+    add_streque(user, standardglas=2)
+    assert user.bac > 0
+
+
 def test_poke_and_poke_back(app):
     monty = make_drinker()
     brian = make_drinker(email='brian@pfoj.tld')
@@ -0,0 +1,171 @@
+import logging
+from unittest import mock
+
+import pytest
+from flask import url_for
+
+from flasquelistan import factory, models, outbox, util
+from tests.helpers import logged_in, make_user
+
+
+@pytest.fixture
+def emitted(app, monkeypatch):
+    """Emit events in the background, and return a mock of socketio.emit."""
+    monkeypatch.setitem(app.config, 'EMIT_EVENTS_IN_BACKGROUND', True)
+    with mock.patch.object(factory.socketio, 'emit') as emit:
+        yield emit
+        join(app)
+
+
+def join(app):
+    app.extensions['event_outbox'].join()
+
+
+def test_strequa_emits_after_responding(app, client, emitted):
+    article = models.Article(name='Öl', value=400, is_active=True)
+    models.db.session.add(article)
+    models.db.session.commit()
+
+    with logged_in(client):
+        user = models.User.query.one()
+        response = client.post(url_for('strequelistan.add_streque'),
+                               data={'user_id': user.id,
+                                     'article_id': article.id})
+        assert response.status_code == 302
+        emitted.assert_not_called()
+
+        join(app)
+
+    emitted.assert_called_once_with('balance_change', {
+        'user_id': user.id,
+        'discord_user_id': None,
+        'old_balance': 0,
+        'new_balance': -400,
+        'new_emoji': mock.ANY,
+    }, to=[f'balance_change:user:{user.id}', 'balance_change:all'])
+
+
+def test_balance_is_from_when_event_was_put(app, emitted):
+    user = make_user(balance=1000)
+    util.emit_balance_change_event(user, 500)
+    user.balance = 0
+    models.db.session.commit()
+
+    join(app)
+
+    data = emitted.call_args.args[1]
+    assert (data['old_balance'], data['new_balance']) == (500, 1000)
+
+
+def test_removed_notification_not_emitted(app, emitted):
+    user = make_user()
+    notification = models.Notification(text='Hej', user_id=user.id)
+    models.db.session.add(notification)
+    models.db.session.commit()
+
+    util.emit_notification_event(notification)
+    models.db.session.delete(notification)
+    models.db.session.commit()
+
+    join(app)
+    emitted.assert_not_called()
+
+
+def test_failing_event_does_not_stop_outbox(app, emitted, caplog):
+    def fail():
+        raise RuntimeError("oops")
+
+    with app.test_request_context():
+        outbox.put('broken', fail)
+        outbox.put('working', lambda: {'ok': True})
+
+    with caplog.at_level(logging.ERROR):
+        join(app)
+
+    emitted.assert_called_once_with('working', {'ok': True}, to=None)
+    assert any(record.getMessage() == "Could not emit broken event"
+               for record in caplog.records)
+
+
+def test_emitted_at_once_when_disabled(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'EMIT_EVENTS_IN_BACKGROUND', False)
+    with mock.patch.object(factory.socketio, 'emit') as emit:
+        outbox.put('event', lambda answer: {'answer': answer}, to='room',
+                   answer=42)
+        emit.assert_called_once_with('event', {'answer': 42}, to='room')
+
+
+def balance_change(user_id, old_balance, new_balance):
+    return {'event': 'balance_change',
+            'data': {'user_id': user_id, 'discord_user_id': None,
+                     'old_balance': old_balance, 'new_balance': new_balance,
+                     'new_emoji': None}}
+
+
+def test_batched_events(app):
+    monty = make_user(balance=100)
+    brian = make_user(email='brian@pfoj.tld', balance=200)
+
+    with mock.patch.object(factory.socketio, 'emit') as emit:
+        with util.batched_events():
+            util.emit_balance_change_event(monty, 0)
+            util.emit_balance_change_event(brian, 0)
+            emit.assert_not_called()
+
+    assert emit.call_args_list == [
+        mock.call('balance_change', balance_change(monty.id, 0, 100)['data'],
+                  to=f'balance_change:user:{monty.id}'),
+        mock.call('batch', {'events': [balance_change(monty.id, 0, 100),
+                                       balance_change(brian.id, 0, 200)]},
+                  to='balance_change:all'),
+        mock.call('balance_change', balance_change(brian.id, 0, 200)['data'],
+                  to=f'balance_change:user:{brian.id}'),
+    ]
+
+
+def test_batched_balance_changes_merged(app):
+    user = make_user()
+
+    with mock.patch.object(factory.socketio, 'emit') as emit:
+        with util.batched_events():
+            for balance in (100, 300, 600):
+                old_balance = user.balance
+                user.balance = balance
+                models.db.session.commit()
+                util.emit_balance_change_event(user, old_balance)
+
+    emit.assert_called_once_with(
+        'balance_change', balance_change(user.id, 0, 600)['data'],
+        to=[f'balance_change:user:{user.id}', 'balance_change:all'])
+
+
+def test_batched_events_emitted_on_error(app):
+    user = make_user()
+
+    with mock.patch.object(factory.socketio, 'emit') as emit:
+        with pytest.raises(RuntimeError):
+            with util.batched_events():
+                util.emit_balance_change_event(user, 100)
+                raise RuntimeError
+
+    emit.assert_called_once()
+    # The batch is over
+    with mock.patch.object(factory.socketio, 'emit') as emit:
+        util.emit_balance_change_event(user, 100)
+    emit.assert_called_once()
+
+
+def test_events_batched_in_background(app, emitted, monkeypatch):
+    monkeypatch.setitem(app.config, 'EVENT_BATCH_WINDOW', 0.01)
+
+    with app.test_request_context():
+        for number in range(3):
+            outbox.put('event', lambda number: {'number': number}, to='room',
+                       number=number)
+
+    join(app)
+
+    emitted.assert_called_once_with('batch', {'events': [
+        {'event': 'event', 'data': {'number': number}}
+        for number in range(3)
+    ]}, to='room')
@@ -0,0 +1,85 @@
+import logging
+
+import pytest
+from flask import url_for
+
+from flasquelistan import querystats
+from tests.helpers import count_queries, logged_in, logged_in_admin
+
+
+def test_server_timing_header_for_admins(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'DEBUG', False)
+    with logged_in_admin(client):
+        with count_queries() as statements:
+            response = client.get(url_for('strequelistan.index'))
+
+    header = response.headers['Server-Timing']
+    assert header.startswith('db;dur=')
+    assert header.endswith(f'desc="{len(statements)} queries"')
+
+
+def test_no_server_timing_header_by_default(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'DEBUG', False)
+    with logged_in(client):
+        response = client.get(url_for('strequelistan.index'))
+
+    assert 'Server-Timing' not in response.headers
+
+
+def test_server_timing_header_in_debug_mode(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'DEBUG', True)
+    with logged_in(client):
+        response = client.get(url_for('strequelistan.index'))
+
+    assert 'Server-Timing' in response.headers
+
+
+def test_server_timing_header_when_enabled(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'DEBUG', False)
+    monkeypatch.setitem(app.config, 'SERVER_TIMING_HEADER', True)
+    with logged_in(client):
+        response = client.get(url_for('strequelistan.index'))
+
+    assert 'Server-Timing' in response.headers
+
+
+def test_stats_logged(client, caplog):
+    with logged_in(client):
+        with caplog.at_level(logging.DEBUG):
+            client.get(url_for('strequelistan.index'))
+
+    assert any(' queries in ' in record.getMessage()
+               for record in caplog.records)
+
+
+def test_query_count_threshold(app, client, caplog, monkeypatch):
+    monkeypatch.setitem(app.config, 'QUERY_COUNT_THRESHOLD', 1)
+    with logged_in(client):
+        client.get(url_for('strequelistan.index'))
+
+    warnings = [record.getMessage() for record in caplog.records
+                if record.levelno == logging.WARNING]
+    assert any(message.startswith('View strequelistan.index ran ')
+               for message in warnings)
+
+
+def test_query_count_below_threshold(app, client, caplog, monkeypatch):
+    monkeypatch.setitem(app.config, 'QUERY_COUNT_THRESHOLD', 1000)
+    with logged_in(client):
+        client.get(url_for('strequelistan.index'))
+
+    assert not any(record.levelno == logging.WARNING
+                   for record in caplog.records)
+
+
+def test_slowest_statements():
+    stats = querystats.QueryStats()
+    for i, duration in enumerate([0.003, 0.001, 0.005, 0.002, 0.004]):
+        stats.record(f'SELECT {i}', duration)
+
+    assert stats.count == 5
+    assert stats.total_time == pytest.approx(0.015)
+    assert stats.slowest == [(0.005, 'SELECT 2'),
+                             (0.004, 'SELECT 4'),
+                             (0.003, 'SELECT 0')]
+    assert stats.server_timing == 'db;dur=15.0;desc="5 queries"'
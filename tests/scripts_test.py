@@ -0,0 +1,64 @@
+import sqlalchemy as sqla
+
+from flasquelistan import models
+from flasquelistan.scripts import benchmark, syntheticdata
+
+
+def test_populate_synthetic_data(app):
+    syntheticdata.populate(users=10, transactions=300, notifications=20,
+                           quotes=5, profile_pictures=15)
+
+    assert models.User.query.count() == 10
+    assert models.Transaction.query.count() == 300
+    assert models.Notification.query.count() == 20
+    assert models.Quote.query.count() == 5
+    assert models.ProfilePicture.query.count() == 15
+
+    for user in models.User.query:
+        assert user.balance == sum(t.value for t in user.transactions
+                                   if not t.voided)
+        if user.profile_pictures:
+            assert user.profile_picture in user.profile_pictures
+
+
+def test_benchmark(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'IMAGE_SECRET', 'secret')
+    monkeypatch.setitem(app.config, 'IMAGE_EXPIRY', 3600)
+    syntheticdata.populate(users=10, transactions=300, notifications=20,
+                           quotes=5, profile_pictures=15)
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['benchmark', '--rounds', '2'])
+
+    assert result.exit_code == 0, result.output
+    for view in ['strequelistan.index', '/strequa', '/admin/stats']:
+        assert view in result.output
+
+
+def test_percentile():
+    samples = list(range(1, 101))
+    assert benchmark.percentile(samples, 50) == 50.5
+    assert benchmark.percentile(samples, 95) == 95.05
+    assert benchmark.percentile([7], 95) == 7
+
+
+def transaction_indexes():
+    inspector = sqla.inspect(models.db.engine)
+    return {index['name'] for index in inspector.get_indexes('transaction')}
+
+
+def test_createindexes(app):
+    with models.db.engine.begin() as connection:
+        connection.exec_driver_sql('DROP INDEX ix_transaction_user_id_timestamp')
+    assert 'ix_transaction_user_id_timestamp' not in transaction_indexes()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['createindexes'])
+    assert result.exit_code == 0, result.output
+    assert 'ix_transaction_user_id_timestamp' in result.output
+    assert 'ix_transaction_user_id_timestamp' in transaction_indexes()
+
+    # Nothing left to do the second time
+    result = runner.invoke(args=['createindexes'])
+    assert result.exit_code == 0, result.output
+    assert result.output == ''
@@ -1,7 +1,11 @@
+import datetime
+from unittest import mock
+
 import pytest
 import werkzeug.exceptions
 
-from flasquelistan import util
+from flasquelistan import models, util
+from tests.helpers import make_user
 
 
 class TestIsSafeUrl:
@@ -119,3 +123,84 @@ class TestUrlForImage:
         with app.test_request_context('/'):
             with pytest.raises(werkzeug.exceptions.InternalServerError):
                 util.url_for_image('monty.jpg', 'not-a-type')
+
+    @pytest.fixture
+    def signed(self, app, monkeypatch):
+        """Sign image URLs with an hour of expiry and ten minute windows,
+        and return a mock of generate_secure_path_hash."""
+        monkeypatch.setitem(app.config, 'IMAGE_SECRET', 'not a secret')
+        monkeypatch.setitem(app.config, 'IMAGE_EXPIRY', 3600)
+        monkeypatch.setitem(app.config, 'IMAGE_URL_WINDOW', 600)
+        monkeypatch.setattr(util.time, 'time', lambda: 6000.0)
+        util.image_url_cache.clear()
+        with mock.patch.object(util, 'generate_secure_path_hash',
+                               wraps=util.generate_secure_path_hash) as sign:
+            yield sign
+
+    def test_stable_within_window(self, app, signed, monkeypatch):
+        with app.test_request_context('/'):
+            url = util.url_for_image('monty.jpg', 'profilepicture', 200)
+            monkeypatch.setattr(util.time, 'time', lambda: 6599.0)
+            assert util.url_for_image('monty.jpg', 'profilepicture', 200) == url
+
+        # From the end of the window
+        assert url.endswith('&expires=10200')
+        signed.assert_called_once()
+
+    def test_changes_with_window(self, app, signed, monkeypatch):
+        with app.test_request_context('/'):
+            url = util.url_for_image('monty.jpg', 'profilepicture')
+            monkeypatch.setattr(util.time, 'time', lambda: 6600.0)
+            assert util.url_for_image('monty.jpg', 'profilepicture') != url
+
+    def test_cached_per_client_and_image(self, app, signed):
+        with app.test_request_context('/'):
+            url = util.url_for_image('monty.jpg', 'profilepicture')
+            assert util.url_for_image('arthur.jpg', 'profilepicture') != url
+            assert util.url_for_image('monty.jpg', 'image') != url
+        with app.test_request_context(
+                '/', environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            assert util.url_for_image('monty.jpg', 'profilepicture') != url
+
+        assert signed.call_count == 4
+
+    def test_cache_size_bounded(self, app, signed, monkeypatch):
+        monkeypatch.setattr(util, 'IMAGE_URL_CACHE_SIZE', 2)
+        with app.test_request_context('/'):
+            for filename in ['a.jpg', 'b.jpg', 'c.jpg']:
+                util.url_for_image(filename, 'image')
+
+        assert [key[0] for key in util.image_url_cache] == ['b.jpg', 'c.jpg']
+
+
+class TestBetweenDates:
+    def test_whole_days_included(self, app):
+        user = make_user()
+        timestamps = [
+            datetime.datetime(2024, 10, 31, 23, 59, 59, 999999),
+            datetime.datetime(2024, 11, 1, 0, 0),
+            datetime.datetime(2024, 11, 2, 12, 0),
+            datetime.datetime(2024, 11, 3, 23, 59, 59, 999999),
+            datetime.datetime(2024, 11, 4, 0, 0),
+        ]
+        for timestamp in timestamps:
+            models.db.session.add(models.Transaction(
+                value=100, user_id=user.id, timestamp=timestamp))
+        models.db.session.commit()
+
+        found = models.Transaction.query.filter(util.between_dates(
+            models.Transaction.timestamp,
+            datetime.date(2024, 11, 1),
+            datetime.date(2024, 11, 3),
+        )).order_by(models.Transaction.timestamp)
+
+        assert [t.timestamp for t in found] == timestamps[1:4]
+
+    def test_does_not_wrap_column_in_function(self, app):
+        condition = util.between_dates(models.Transaction.timestamp,
+                                       datetime.date(2024, 11, 1),
+                                       datetime.date(2024, 11, 3))
+        sql = str(condition.compile(models.db.engine))
+
+        assert sql == ('"transaction".timestamp >= ? '
+                       'AND "transaction".timestamp < ?')
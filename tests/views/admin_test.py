@@ -5,11 +5,16 @@ from flask import url_for
 from flask_login import current_user
 
 import datetime
+from unittest import mock
 
-from flasquelistan import models
+import pytest
 
+from flasquelistan import factory, models
+
+from tests.helpers import count_queries
 from tests.helpers import logged_in
 from tests.helpers import logged_in_admin
+from tests.helpers import make_user
 
 
 class TestAdminPage:
@@ -361,6 +366,89 @@ class TestConfirmBulkTransactionPage:
             response = client.post(url_for('strequeadmin.confirm_bulk_transactions'))
             assert response.status_code == 302
 
+    def test_events_batched(self, client):
+        with logged_in_admin(client):
+            users = [make_user(email=f'user{i}@python.tld') for i in range(3)]
+            data = {}
+            for user in users:
+                data[f'user-{user.id}-value'] = 10000
+                data[f'user-{user.id}-text'] = 'Insättning'
+
+            with mock.patch.object(factory.socketio, 'emit') as emit:
+                response = client.post(
+                    url_for('strequeadmin.confirm_bulk_transactions'),
+                    data=data)
+            assert response.status_code == 302
+
+        # One message per room: a batch of all events to each all-users room,
+        # and each user's own events to their rooms
+        rooms = [call.kwargs['to'] for call in emit.call_args_list]
+        assert len(rooms) == len(set(rooms)) == 2 + 2 * len(users)
+        batches = {call.kwargs['to']: call.args[1]['events']
+                   for call in emit.call_args_list if call.args[0] == 'batch'}
+        assert {room: len(events) for room, events in batches.items()} == {
+            'balance_change:all': 3,
+            'notification:all': 3,
+        }
+
+    def confirm_query_count(self, app, client, emails):
+        users = [make_user(email=email) for email in emails]
+        data = {}
+        for user in users:
+            data[f'user-{user.id}-value'] = 10000
+            data[f'user-{user.id}-text'] = 'Insättning'
+
+        with count_queries() as statements:
+            response = client.post(
+                url_for('strequeadmin.confirm_bulk_transactions'), data=data)
+        # Events are built outside of the request
+        app.extensions['event_outbox'].join()
+        assert response.status_code == 302
+        assert [user.balance for user in users] == [10000] * len(users)
+        return len(statements)
+
+    def test_query_count_independent_of_users(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, 'EMIT_EVENTS_IN_BACKGROUND', True)
+        with logged_in_admin(client), mock.patch.object(factory.socketio,
+                                                        'emit'):
+            few = self.confirm_query_count(
+                app, client, [f'few{i}@python.tld' for i in range(2)])
+            many = self.confirm_query_count(
+                app, client, [f'many{i}@python.tld' for i in range(10)])
+
+        assert few == many
+
+    def test_unknown_user(self, client):
+        with logged_in_admin(client):
+            response = client.post(
+                url_for('strequeadmin.confirm_bulk_transactions'),
+                data={'user-1337-value': 100, 'user-1337-text': 'Ni!'})
+            assert response.status_code == 400
+
+    def test_zero_padded_user_id(self, client):
+        with logged_in_admin(client):
+            user = make_user(email='padded@python.tld')
+            response = client.post(
+                url_for('strequeadmin.confirm_bulk_transactions'),
+                data={f'user-0{user.id}-value': 100,
+                      f'user-0{user.id}-text': 'Ni!'})
+            assert response.status_code == 302
+            assert user.balance == 100
+
+    @pytest.mark.parametrize('data', [
+        {'user-spam-value': 100, 'user-spam-text': 'Ni!'},
+        {'user-1-value': 'spam', 'user-1-text': 'Ni!'},
+        {'user-1-value': 100},
+        {'user-1-text': 'Ni!'},
+        {'user-1-value-text': 'Ni!'},
+        {'user-1-spam': 'Ni!'},
+    ])
+    def test_bad_fields(self, client, data):
+        with logged_in_admin(client):
+            response = client.post(
+                url_for('strequeadmin.confirm_bulk_transactions'), data=data)
+            assert response.status_code == 400
+
     def test_not_logged_in(self, client):
         with client:
             response = client.post('http://localhost/admin/transactions/bulk/confirm')
@@ -1,6 +1,13 @@
 import datetime
+import json
+import re
+from unittest import mock
 
-from flasquelistan import models
+import pytest
+
+from flasquelistan import factory, models, util
+from flasquelistan.views import api
+from tests.helpers import count_queries
 
 
 def make_api_user(email='monty@python.tld', admin=False, key_admin=None,
@@ -244,6 +251,118 @@ class TestStreque:
         assert response.status_code == 404
 
 
+class TestBulkStreque:
+    def test_bulk_streque(self, client):
+        user, api_key, key = make_api_user()
+        other, _, _ = make_api_user(email='brian@pfj.tld')
+        beer = make_article(name='Beer', value=1600)
+        cider = make_article(name='Cider', value=1500)
+
+        with mock.patch('flasquelistan.util.emit_balance_change_event') \
+                as emit:
+            response = client.post(
+                '/api/v1/streques/bulk',
+                json=[
+                    {'user_id': user.id, 'article_id': beer.id},
+                    {'user_id': other.id, 'article_id': cider.id},
+                    {'user_id': user.id, 'article_id': cider.id},
+                ],
+                headers=auth_header(key))
+
+        assert response.status_code == 200
+        streques = response.json['streques']
+        assert [(s['user_id'], s['value']) for s in streques] == \
+            [(user.id, -1600), (other.id, -1500), (user.id, -1500)]
+        assert all(s['api_key_id'] == api_key.id for s in streques)
+        assert response.json['balances'] == {str(user.id): -3100,
+                                             str(other.id): -1500}
+        assert user.balance == -3100
+        assert other.balance == -1500
+        # Both of the user's drinks, 2 standardglas each
+        assert user.bac_state.alcohol == pytest.approx(4 * 0.012)
+
+        # One event per user, from the balance before to after the round
+        events = {call.args[0]: call.args[1] for call in emit.call_args_list}
+        assert events == {user: 0, other: 0}
+
+    def round_query_count(self, client, key, users, article):
+        body = [{'user_id': user.id, 'article_id': article.id}
+                for user in users]
+        # The first round adds the BAC states
+        client.post('/api/v1/streques/bulk', json=body,
+                    headers=auth_header(key))
+
+        with count_queries() as statements:
+            response = client.post('/api/v1/streques/bulk', json=body,
+                                   headers=auth_header(key))
+        # Events are built outside of the request
+        client.application.extensions['event_outbox'].join()
+        assert response.status_code == 200
+        assert response.json['balances'] == {
+            str(user.id): -2 * article.value for user in users}
+        return len(statements)
+
+    def test_bulk_streque_query_count(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, 'EMIT_EVENTS_IN_BACKGROUND', True)
+        _, _, key = make_api_user()
+        article = make_article()
+        users = [make_api_user(email=f'user{i}@pfj.tld')[0]
+                 for i in range(22)]
+
+        with mock.patch.object(factory.socketio, 'emit'):
+            few = self.round_query_count(client, key, users[:2], article)
+            many = self.round_query_count(client, key, users[2:], article)
+
+        assert few == many
+        # Added to the state of the first round
+        assert users[0].bac_state.alcohol == pytest.approx(4 * 0.012,
+                                                           rel=1e-3)
+
+    def test_bulk_streque_all_or_nothing(self, client):
+        user, _, key = make_api_user()
+        article = make_article()
+
+        response = client.post(
+            '/api/v1/streques/bulk',
+            json=[
+                {'user_id': user.id, 'article_id': article.id},
+                {'user_id': 1337, 'article_id': article.id},
+            ],
+            headers=auth_header(key))
+
+        assert response.status_code == 404
+        assert models.Streque.query.count() == 0
+        assert user.balance == 0
+
+    def test_bulk_streque_unknown_article(self, client):
+        user, _, key = make_api_user()
+
+        response = client.post(
+            '/api/v1/streques/bulk',
+            json=[{'user_id': user.id, 'article_id': 1337}],
+            headers=auth_header(key))
+
+        assert response.status_code == 404
+
+    def test_bulk_streque_invalid(self, client):
+        user, _, key = make_api_user()
+        article = make_article()
+
+        for body in [
+            {'user_id': user.id, 'article_id': article.id},
+            [],
+            [{'user_id': user.id}],
+            [{'user_id': str(user.id), 'article_id': article.id}],
+            [user.id, article.id],
+            [{'user_id': user.id, 'article_id': article.id}] * 101,
+        ]:
+            response = client.post('/api/v1/streques/bulk', json=body,
+                                   headers=auth_header(key))
+            assert response.status_code == 400
+
+        assert models.Streque.query.count() == 0
+
+
 class TestArticles:
     def test_only_active_articles_ordered_by_weight(self, client):
         _, _, key = make_api_user()
@@ -384,6 +503,128 @@ class TestTransactions:
         assert response.status_code == 400
 
 
+def next_page_url(response):
+    """The URL of the next page from the Link header, or None."""
+    match = re.fullmatch(r'<(.*)>; rel="next"', response.headers.get('Link', ''))
+    return match and match.group(1)
+
+
+class TestTransactionPages:
+    def follow_pages(self, client, url, key):
+        ids = []
+        while url:
+            response = client.get(url, headers=auth_header(key))
+            assert response.status_code == 200
+            ids += [t['id'] for t in response.json]
+            url = next_page_url(response)
+        return ids
+
+    def test_page_size_enforced(self, client, monkeypatch):
+        monkeypatch.setattr(api, 'MAX_PAGE_SIZE', 2)
+        user, _, key = make_api_user(admin=True)
+        transactions = make_transactions(user, 3)
+
+        response = client.get('/api/v1/transactions?limit=10',
+                              headers=auth_header(key))
+        assert [t['id'] for t in response.json] == \
+            [t.id for t in transactions[:2]]
+        assert next_page_url(response)
+
+    def test_follow_next_pages(self, client, monkeypatch):
+        monkeypatch.setattr(api, 'MAX_PAGE_SIZE', 2)
+        user, _, key = make_api_user(admin=True)
+        transactions = make_transactions(user, 5)
+
+        ids = self.follow_pages(client, '/api/v1/transactions', key)
+        assert ids == [t.id for t in transactions]
+
+    def test_follow_next_pages_desc(self, client):
+        user, _, key = make_api_user(admin=True)
+        transactions = make_transactions(user, 5)
+
+        ids = self.follow_pages(
+            client, '/api/v1/transactions?order=desc&limit=2', key)
+        assert ids == [t.id for t in reversed(transactions)]
+
+    def test_follow_next_pages_of_user(self, client):
+        user, _, key = make_api_user()
+        transactions = make_transactions(user, 3)
+        other, _, _ = make_api_user(email='brian@pfj.tld')
+        make_transactions(other, 3)
+
+        ids = self.follow_pages(
+            client, f'/api/v1/users/{user.id}/transactions?limit=1', key)
+        assert ids == [t.id for t in transactions]
+
+    @pytest.mark.parametrize('extra', ['user_id=5', 'endpoint=api.index',
+                                       '_external=0', 'spam=eggs'])
+    def test_next_page_ignores_other_args(self, client, extra):
+        user, _, key = make_api_user()
+        transactions = make_transactions(user, 3)
+
+        ids = self.follow_pages(
+            client, f'/api/v1/users/{user.id}/transactions?limit=1&{extra}',
+            key)
+        assert ids == [t.id for t in transactions]
+
+    def test_no_next_page_on_last_page(self, client):
+        user, _, key = make_api_user(admin=True)
+        make_transactions(user, 2)
+
+        response = client.get('/api/v1/transactions?limit=2',
+                              headers=auth_header(key))
+        assert 'Link' not in response.headers
+
+    def test_invalid_cursor(self, client):
+        _, _, key = make_api_user(admin=True)
+
+        for cursor in ['banana', api.encode_cursor('1', 'asc'),
+                       api.encode_cursor(1, 'sideways')]:
+            response = client.get(f'/api/v1/transactions?cursor={cursor}',
+                                  headers=auth_header(key))
+            assert response.status_code == 400
+
+    def test_stream_ndjson(self, client, monkeypatch):
+        monkeypatch.setattr(api, 'MAX_PAGE_SIZE', 2)
+        monkeypatch.setattr(api, 'STREAM_BATCH_SIZE', 2)
+        user, _, key = make_api_user(admin=True)
+        transactions = make_transactions(user, 5)
+
+        response = client.get('/api/v1/transactions?format=ndjson',
+                              headers=auth_header(key))
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line)['id'] for line in lines] == \
+            [t.id for t in transactions]
+
+    def test_stream_ndjson_with_limit(self, client):
+        user, _, key = make_api_user(admin=True)
+        transactions = make_transactions(user, 5)
+
+        response = client.get('/api/v1/transactions?format=ndjson&limit=3',
+                              headers=auth_header(key))
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line)['id'] for line in lines] == \
+            [t.id for t in transactions[:3]]
+
+    def test_query_count_independent_of_page_size(self, client):
+        user, _, key = make_api_user(admin=True)
+        article = make_article()
+        for _ in range(2):
+            user.strequa(article, user)
+
+        # Authenticate once, so both requests find the key in the cache
+        client.get('/api/v1/articles', headers=auth_header(key))
+
+        with count_queries() as few:
+            client.get('/api/v1/transactions?limit=1', headers=auth_header(key))
+        with count_queries() as many:
+            client.get('/api/v1/transactions', headers=auth_header(key))
+
+        assert len(few) == len(many)
+
+
 class TestNotifications:
     def make_notification(self, user):
         notification = models.Notification(text='Fetchez la vache!',
@@ -446,6 +687,75 @@ class TestNotifications:
         assert response.status_code == 404
 
 
+class TestSocketIO:
+    def connect(self, app, key, **auth):
+        return factory.socketio.test_client(app, auth={'token': key, **auth})
+
+    def received(self, client):
+        return [(event['name'], event['args'][0]['user_id'])
+                for event in client.get_received()]
+
+    def emit_events(self, *users):
+        for user in users:
+            util.emit_balance_change_event(user, 0)
+            notification = models.Notification(text='Ni!', user_id=user.id)
+            models.db.session.add(notification)
+            models.db.session.commit()
+            util.emit_notification_event(notification)
+
+    def test_invalid_auth_refused(self, app):
+        _, _, key = make_api_user()
+
+        for auth in [{}, {'token': 'garbage'}]:
+            client = factory.socketio.test_client(app, auth=auth)
+            assert not client.is_connected()
+
+        client = self.connect(app, key, events=['poke'])
+        assert not client.is_connected()
+
+    def test_only_own_events(self, app):
+        user, _, key = make_api_user()
+        other, _, _ = make_api_user(email='brian@pfj.tld')
+        client = self.connect(app, key)
+        assert client.is_connected()
+
+        self.emit_events(user, other)
+
+        assert self.received(client) == [('balance_change', user.id),
+                                         ('notification', user.id)]
+
+    def test_admin_key_gets_all_events(self, app):
+        user, _, key = make_api_user(admin=True)
+        other, _, _ = make_api_user(email='brian@pfj.tld')
+        client = self.connect(app, key)
+
+        self.emit_events(user, other)
+
+        assert self.received(client) == [('balance_change', user.id),
+                                         ('notification', user.id),
+                                         ('balance_change', other.id),
+                                         ('notification', other.id)]
+
+    def test_admin_key_of_non_admin_gets_own_events(self, app):
+        user, _, key = make_api_user(key_admin=True)
+        other, _, _ = make_api_user(email='brian@pfj.tld')
+        client = self.connect(app, key)
+
+        self.emit_events(user, other)
+
+        assert self.received(client) == [('balance_change', user.id),
+                                         ('notification', user.id)]
+
+    def test_subscribe_to_event_types(self, app):
+        user, _, key = make_api_user(admin=True)
+        client = self.connect(app, key, events=['notification'])
+        assert client.is_connected()
+
+        self.emit_events(user)
+
+        assert self.received(client) == [('notification', user.id)]
+
+
 class TestQuotes:
     def make_quotes(self):
         quotes = []
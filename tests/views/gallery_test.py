@@ -1,4 +1,8 @@
-from tests.helpers import logged_in
+import datetime
+
+from flasquelistan import models
+from flasquelistan.views import gallery
+from tests.helpers import count_queries, logged_in, make_user
 
 
 class TestGalleryViews:
@@ -19,3 +23,58 @@ class TestGalleryViews:
         response = client.get('/gallery/')
         assert response.status_code == 302
         assert '/login' in response.headers['Location']
+
+
+class TestGalleryPageForImage:
+    def add_pictures(self):
+        """Add 45 pictures of one user and 5 of another, some of them at the
+        same time."""
+        monty = make_user(email='monty.pictures@python.tld')
+        arthur = make_user(email='arthur@python.tld')
+        now = datetime.datetime(2024, 11, 1)
+        pictures = []
+        for i in range(50):
+            pictures.append(models.ProfilePicture(
+                filename=f'{i}.jpg',
+                user_id=arthur.id if i % 10 == 0 else monty.id,
+                timestamp=now + datetime.timedelta(minutes=i // 3),
+            ))
+        models.db.session.add_all(pictures)
+        models.db.session.commit()
+        return monty, pictures
+
+    def expected_pages(self, pictures):
+        newest_first = sorted(pictures, key=lambda p: (p.timestamp, p.id),
+                              reverse=True)
+        return {picture: i // gallery.PER_PAGE + 1
+                for i, picture in enumerate(newest_first)}
+
+    def test_page_in_gallery(self, app):
+        _, pictures = self.add_pictures()
+        expected = self.expected_pages(pictures)
+
+        for picture in pictures:
+            with count_queries() as statements:
+                page = gallery.gallery_page_for_image(picture)
+            assert page == expected[picture]
+            assert len(statements) == 1
+
+    def test_page_in_user_gallery(self, app):
+        monty, pictures = self.add_pictures()
+        monty_pictures = [p for p in pictures if p.user_id == monty.id]
+        expected = self.expected_pages(monty_pictures)
+
+        for picture in monty_pictures:
+            assert gallery.gallery_page_for_image(picture, monty) == \
+                expected[picture]
+
+    def test_page_matches_view(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, 'IMAGE_SECRET', 'secret')
+        monkeypatch.setitem(app.config, 'IMAGE_EXPIRY', 3600)
+        with logged_in(client):
+            monty, pictures = self.add_pictures()
+            picture = [p for p in pictures if p.user_id == monty.id][-1]
+            page = gallery.gallery_page_for_image(picture, monty)
+
+            response = client.get(f'/gallery/user/{monty.id}/{page}')
+            assert picture.filename in response.get_data(as_text=True)
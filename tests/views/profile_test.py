@@ -8,7 +8,7 @@ from PIL import Image
 
 from flask import url_for
 
-from flasquelistan import factory, models
+from flasquelistan import factory, models, util
 
 from tests import helpers
 from tests.conftest import BASE_TEST_CONFIG, fresh_database
@@ -463,6 +463,25 @@ class TestApiKeys:
             assert response.status_code == 400
             assert models.ApiKey.query.count() == 0
 
+    def test_disabled_api_key_stops_working_at_once(self, client):
+        with logged_in(client) as user:
+            key = models.ApiKey.generate_key()
+            api_key = models.ApiKey(name='Dead parrot', api_key=key,
+                                    user_id=user.id)
+            models.db.session.add(api_key)
+            models.db.session.commit()
+            assert models.ApiKey.authenticate(key) == api_key
+
+            client.post(
+                url_for('profile.edit_api_key', user_id=user.id,
+                        api_key_id=api_key.id),
+                data={'name': 'Dead parrot'},
+            )
+
+            # As if authenticating in another request
+            models.db.session.expunge(api_key)
+            assert models.ApiKey.authenticate(key) is None
+
     def test_delete_api_key(self, client):
         with logged_in(client) as user:
             api_key = models.ApiKey(
@@ -687,10 +706,10 @@ class TestUserPages:
             assert response.status_code == 200
 
 
-def make_jpeg():
+def make_jpeg(size=(8, 8)):
     """Create a small JPEG image in memory."""
     stream = io.BytesIO()
-    image = Image.new('RGB', (8, 8), color=(255, 0, 0))
+    image = Image.new('RGB', size, color=(255, 0, 0))
     image.save(stream, format='JPEG')
     stream.seek(0)
     return stream
@@ -725,6 +744,253 @@ class TestProfilePictures:
             )
             assert os.path.isfile(path)
 
+    def test_upload_makes_thumbnails(self, app, client):
+        with logged_in(client) as user:
+            client.post(
+                url_for('profile.upload_profile_picture', user_id=user.id),
+                data={'upload': (make_jpeg((1000, 500)), 'avatar.jpg')},
+                content_type='multipart/form-data',
+            )
+
+            picture = user.profile_picture
+            assert [t.width for t in picture.thumbnails] == [200, 600, 800]
+            for thumbnail in picture.thumbnails:
+                path = util.profile_pictures.path(thumbnail.filename)
+                with Image.open(path) as image:
+                    assert image.format == 'WEBP'
+                    assert image.size == (thumbnail.width,
+                                          thumbnail.width // 2)
+
+            # The profile page shows the 600 wide one
+            response = client.get(
+                url_for('profile.show_profile', user_id=user.id))
+            assert picture.thumbnail(600) in response.get_data(as_text=True)
+
+    def test_thumbnails_not_enlarged(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, 'THUMBNAIL_FORMAT', 'jpeg')
+        with logged_in(client) as user:
+            client.post(
+                url_for('profile.upload_profile_picture', user_id=user.id),
+                data={'upload': (make_jpeg(), 'avatar.jpg')},
+                content_type='multipart/form-data',
+            )
+
+            for thumbnail in user.profile_picture.thumbnails:
+                assert thumbnail.filename.endswith('.jpg')
+                path = util.profile_pictures.path(thumbnail.filename)
+                with Image.open(path) as image:
+                    assert image.size == (8, 8)
+
+    def test_no_thumbnails_of_animations(self, client):
+        stream = io.BytesIO()
+        frames = [Image.new('RGB', (8, 8), color) for color in ('red', 'blue')]
+        frames[0].save(stream, format='GIF', save_all=True,
+                       append_images=frames[1:])
+        stream.seek(0)
+
+        with logged_in(client) as user:
+            response = client.post(
+                url_for('profile.upload_profile_picture', user_id=user.id),
+                data={'upload': (stream, 'spinning.gif')},
+                content_type='multipart/form-data',
+                follow_redirects=True
+            )
+
+            assert 'Profilbilden har ändrats!' in response.get_data(
+                as_text=True)
+            assert user.profile_picture.thumbnails == []
+            with client.application.test_request_context():
+                url = util.url_for_profile_picture(user.profile_picture, 200)
+            assert user.profile_picture.filename in url
+
+    def test_thumbnails_of_same_stem_kept_apart(self, client):
+        with logged_in(client) as user:
+            self.upload(client, user, make_jpeg(), 'a.jpg')
+            first = user.profile_picture
+
+            stream = io.BytesIO()
+            Image.new('RGB', (8, 8)).save(stream, format='PNG')
+            stream.seek(0)
+            self.upload(client, user, stream, 'a.png')
+            second = user.profile_picture
+
+            assert first.filename == 'a.jpg'
+            assert second.filename == 'a.png'
+            assert not ({t.filename for t in first.thumbnails}
+                        & {t.filename for t in second.thumbnails})
+
+    def test_decompression_bomb_marked_failed(self, client, monkeypatch):
+        monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 100)
+        with logged_in(client) as user:
+            response = self.upload(client, user, make_jpeg((100, 100)),
+                                   'bomb.jpg')
+
+            assert response.status_code == 200
+            assert user.profile_picture.processing_job.failed
+
+    def test_makethumbnails_skips_processing(self, app):
+        user = make_user()
+        picture = make_profile_picture(user, 'waiting.jpg')
+        Image.new('RGB', (400, 400)).save(
+            util.profile_pictures.path('waiting.jpg'))
+        picture.processing_job = models.ImageProcessingJob()
+        models.db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['makethumbnails'])
+
+        assert "Made thumbnails of 0 pictures, 0 failed" in result.output
+        assert picture.thumbnails == []
+
+    def test_makethumbnails_command(self, app, client):
+        user = make_user()
+        with_file = make_profile_picture(user, 'with-file.jpg')
+        Image.new('RGB', (400, 400)).save(
+            util.profile_pictures.path('with-file.jpg'))
+        make_profile_picture(user, 'without-file.jpg')
+
+        result = app.test_cli_runner().invoke(args=['makethumbnails'])
+
+        assert result.exit_code == 0, result.output
+        assert "Made thumbnails of 1 pictures, 1 failed" in result.output
+        models.db.session.refresh(with_file)
+        assert [t.width for t in with_file.thumbnails] == [200, 600, 800]
+
+    def upload(self, client, user, stream, filename):
+        return client.post(
+            url_for('profile.upload_profile_picture', user_id=user.id),
+            data={'upload': (stream, filename)},
+            content_type='multipart/form-data',
+            follow_redirects=True
+        )
+
+    def test_upload_processed_in_background(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, 'PROCESS_IMAGES_IN_BACKGROUND', True)
+        with logged_in(client) as user:
+            response = self.upload(client, user, make_jpeg((1000, 500)),
+                                   'avatar.jpg')
+            assert response.status_code == 200
+
+            picture = user.profile_picture
+            assert picture.is_processing
+            assert picture.thumbnails == []
+            assert 'Profilbilden bearbetas' in response.get_data(as_text=True)
+            assert user.api_dict['profile_picture']['processing']
+
+            app.extensions['image_processor'].join()
+            models.db.session.refresh(picture)
+            assert not picture.is_processing
+            assert picture.processing_job is None
+            assert [t.width for t in picture.thumbnails] == [200, 600, 800]
+
+    def test_jpeg_rotated(self, client):
+        stream = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotated 90°
+        Image.new('RGB', (20, 10)).save(stream, format='JPEG', exif=exif)
+        stream.seek(0)
+
+        with logged_in(client) as user:
+            self.upload(client, user, stream, 'sideways.jpg')
+
+            # A new filename, so that the URL of the picture changes
+            filename = user.profile_picture.filename
+            assert filename == 'sideways_rotated.jpg'
+            with Image.open(util.profile_pictures.path(filename)) as image:
+                assert image.size == (10, 20)
+                assert image.getexif().get(0x0112, 1) == 1
+
+    def test_upright_jpeg_keeps_filename(self, client):
+        with logged_in(client) as user:
+            self.upload(client, user, make_jpeg(), 'upright.jpg')
+
+            assert user.profile_picture.filename == 'upright.jpg'
+
+    def test_gif_converted_to_webp(self, client):
+        stream = io.BytesIO()
+        frames = [Image.new('RGB', (8, 8), color) for color in ('red', 'blue')]
+        frames[0].save(stream, format='GIF', save_all=True,
+                       append_images=frames[1:])
+        stream.seek(0)
+
+        with logged_in(client) as user:
+            self.upload(client, user, stream, 'spinning.gif')
+
+            filename = user.profile_picture.filename
+            assert filename.endswith('.webp')
+            with Image.open(util.profile_pictures.path(filename)) as image:
+                assert image.format == 'WEBP'
+                assert image.n_frames == 2
+
+    def test_picture_deleted_while_processing(self, app, client,
+                                              monkeypatch):
+        from flasquelistan import imageprocessing
+
+        process_picture = imageprocessing.process_picture
+        generated = []
+
+        def process_and_delete(directory, filename, settings):
+            new_filename, saved = process_picture(directory, filename,
+                                                  settings)
+            generated.extend([new_filename] + [t for _, t in saved])
+            with app.app_context():
+                picture = models.ProfilePicture.query.one()
+                picture.user.profile_picture_id = None
+                models.db.session.delete(picture)
+                models.db.session.commit()
+            return new_filename, saved
+
+        monkeypatch.setattr(imageprocessing, 'process_picture',
+                            process_and_delete)
+
+        stream = io.BytesIO()
+        Image.new('RGB', (8, 8)).save(stream, format='GIF')
+        stream.seek(0)
+        with logged_in(client) as user:
+            response = self.upload(client, user, stream, 'gone.gif')
+
+            assert response.status_code == 200
+            assert models.ProfilePicture.query.count() == 0
+            assert generated[0].endswith('.webp')
+            assert not any(os.path.exists(util.profile_pictures.path(f))
+                           for f in generated)
+
+    def test_unreadable_picture_marked_failed(self, client):
+        with logged_in(client) as user:
+            response = self.upload(client, user, io.BytesIO(b'Ni!'),
+                                   'broken.jpg')
+
+            assert 'Profilbilden har ändrats!' in response.get_data(
+                as_text=True)
+            picture = user.profile_picture
+            assert picture.processing_job.failed
+            assert not picture.is_processing
+            assert picture.thumbnails == []
+
+    def test_processimages_command(self, app, client, monkeypatch):
+        from flasquelistan import imageprocessing
+
+        # Room for one picture only
+        monkeypatch.setitem(app.config, 'PROCESS_IMAGES_IN_BACKGROUND', True)
+        monkeypatch.setitem(app.config, 'IMAGE_PROCESSING_QUEUE_SIZE', 1)
+        processor = imageprocessing.ImageProcessor(app)
+        monkeypatch.setitem(app.extensions, 'image_processor', processor)
+
+        with logged_in(client) as user:
+            self.upload(client, user, make_jpeg(), 'first.jpg')
+            self.upload(client, user, make_jpeg(), 'second.jpg')
+            processor.join()
+
+        models.db.session.expire_all()
+        pictures = models.ProfilePicture.query.order_by(
+            models.ProfilePicture.id).all()
+        assert [p.is_processing for p in pictures] == [False, True]
+
+        result = app.test_cli_runner().invoke(args=['processimages'])
+
+        assert result.exit_code == 0, result.output
+        assert "Processed 1 pictures, 0 failed" in result.output
+        assert models.ImageProcessingJob.query.count() == 0
+
     def test_upload_disallowed_file_rejected(self, client):
         with logged_in(client) as user:
             response = client.post(
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
 
+from unittest import mock
+
+import flask
 from flask import url_for
 from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
 
 import datetime
 
 from flasquelistan import models
 
+from tests.helpers import count_queries
 from tests.helpers import logged_in
 from tests.helpers import logged_in_admin
+from tests.helpers import make_user
 
 
 class TestIndexPage():
@@ -31,6 +37,36 @@ class TestIndexPage():
             assert 'Black Knight' in text
 
     class TestGroups():
+        def test_query_count_independent_of_groups_and_users(
+                self, app, client, monkeypatch):
+            """Tests that the index page does not query once per group or
+            user"""
+            monkeypatch.setitem(app.config, 'IMAGE_SECRET', 'secret')
+            monkeypatch.setitem(app.config, 'IMAGE_EXPIRY', 3600)
+
+            def add_group(name, size):
+                group = models.Group(name=name, weight=1000)
+                models.db.session.add(group)
+                for i in range(size):
+                    user = make_user(email=f'{name}{i}@example.com',
+                                     group=group)
+                    user.profile_picture = models.ProfilePicture(
+                        filename=f'{name}{i}.jpg', user_id=user.id)
+                models.db.session.commit()
+
+            with logged_in(client):
+                add_group('knights', 2)
+                with count_queries() as few:
+                    client.get(url_for('strequelistan.index'))
+
+                add_group('peasants', 5)
+                add_group('swallows', 5)
+                with count_queries() as many:
+                    response = client.get(url_for('strequelistan.index'))
+
+                assert 'swallows4.jpg' in response.get_data(as_text=True)
+                assert len(many) == len(few)
+
         def test_group_show_up_on_index_page(self, client):
             """Tests that a group with members shows up on the index page"""
             group = models.Group(
@@ -130,6 +166,85 @@ class TestIndexPage():
                 assert quote.who in text
 
 
+    def test_bac_on_index_page(self, client):
+        article = models.Article(name='Holy Grail', value=10000,
+                                 standardglas=5, is_active=True)
+        models.db.session.add(article)
+        models.db.session.commit()
+
+        with logged_in(client):
+            current_user.body_mass = 70
+            current_user.y_chromosome = True
+            current_user.strequa(article, current_user)
+            text = client.get(url_for('strequelistan.index')).get_data(as_text=True)
+
+            assert 'class="alcometer"' in text
+            assert '{:.2f}'.format(current_user.bac) in text
+            assert current_user.bac_emoji in text
+
+    def test_no_bac_on_index_page_when_sober(self, client):
+        with logged_in(client):
+            text = client.get(url_for('strequelistan.index')).get_data(as_text=True)
+            assert 'class="alcometer"' not in text
+
+
+class TestUsercardCache:
+    def test_usercard_rendered_once(self, client):
+        from flasquelistan.views import strequelistan
+        strequelistan.usercard_cache.clear()
+
+        with logged_in(client):
+            with mock.patch('flask.render_template',
+                            wraps=flask.render_template) as render:
+                client.get(url_for('strequelistan.index'))
+                client.get(url_for('strequelistan.index'))
+
+            usercard_renders = [call for call in render.call_args_list
+                                if call.args[0] == 'usercard.html']
+            assert len(usercard_renders) == 1
+
+    def test_usercard_updated_on_change(self, client):
+        with logged_in(client):
+            client.get(url_for('strequelistan.index'))
+
+            current_user.nickname = "Black Knight"
+            models.db.session.commit()
+
+            text = client.get(url_for('strequelistan.index')).get_data(as_text=True)
+            assert 'Black Knight' in text
+
+    def test_usercard_updated_when_picture_processed(self, app, client,
+                                                     monkeypatch):
+        monkeypatch.setitem(app.config, 'IMAGE_SECRET', 'secret')
+        monkeypatch.setitem(app.config, 'IMAGE_EXPIRY', 3600)
+        with logged_in(client) as user:
+            picture = models.ProfilePicture(filename='grail.jpg',
+                                            user_id=user.id)
+            picture.processing_job = models.ImageProcessingJob()
+            user.profile_picture = picture
+            models.db.session.commit()
+
+            text = client.get(url_for('strequelistan.index')).get_data(as_text=True)
+            assert 'profile-picture processing' in text
+
+            picture.processing_job = None
+            picture.thumbnails = [models.ProfilePictureThumbnail(
+                width=200, filename='thumbnails/grail.jpg.200.webp')]
+            models.db.session.commit()
+
+            text = client.get(url_for('strequelistan.index')).get_data(as_text=True)
+            assert 'profile-picture processing' not in text
+            assert 'thumbnails/grail.jpg.200.webp' in text
+
+    def test_csrf_token_filled_in(self, client):
+        from flasquelistan.views import strequelistan
+
+        with logged_in(client):
+            text = client.get(url_for('strequelistan.index')).get_data(as_text=True)
+            assert strequelistan.CSRF_PLACEHOLDER not in text
+            assert 'name="csrf_token" value="{}"'.format(generate_csrf()) in text
+
+
 class TestStrequa():
     """Test views related to the strequa action"""
 